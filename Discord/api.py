@@ -1,8 +1,16 @@
 import asyncio
+import time
 from aiohttp import ClientSession
 
+from Utils import metrics
+
 API_URL = 'https://discord.com/api'
 API_VERSION = 10
+RATE_LIMIT_RETRIES = 3
+
+REST_LATENCY = metrics.registry.histogram('redtelephone_rest_request_seconds', 'Discord REST API request latency, by route and status.', ('route', 'status'))
+REST_RATE_LIMIT_WAITS = metrics.registry.histogram('redtelephone_rest_rate_limit_wait_seconds', 'Time spent waiting out Discord REST API rate limits, by route.',
+                                                   ('route',), buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
 
 class Api():
     """Manage REST API requests and underlying HTTP session."""
@@ -16,22 +24,50 @@ class Api():
     # TODO add error handling
     async def simple_message_create(self, text, channelID):
         """Create a new text channel message"""
-        resp = await self.session.post(f'channels/{channelID}/messages', data={'content': text})
+        await self._request('POST', 'channels/{channel_id}/messages', f'channels/{channelID}/messages', data={'content': text})
 
     async def get_user_voice_state(self, userID, guildID):
         """Query the current voice state of a user within a guild."""
         try:
-            async with self.session.get(f'guilds/{guildID}/voice-states/{userID}') as resp:
-                result = await resp.json()
-                guildID = result.get('guild_id', None)
-                channelID = result.get('channel_id', None)
+            _, result = await self._request('GET', 'guilds/{guild_id}/voice-states/{user_id}', f'guilds/{guildID}/voice-states/{userID}')
+            guildID = result.get('guild_id', None)
+            channelID = result.get('channel_id', None)
         except:
             guildID, channelID = None, None
 
         return guildID, channelID
-    
+
+    async def get_gateway_bot(self):
+        """Query the recommended shard count and session start limits of the bot, returning None if the request failed."""
+        status, result = await self._request('GET', 'gateway/bot', 'gateway/bot')
+        return result if status == 200 else None
+
+    async def overwrite_global_commands(self, applicationID, commands):
+        """Replace the application's global slash commands, returning whether they were replaced."""
+        status, _ = await self._request('PUT', 'applications/{application_id}/commands', f'applications/{applicationID}/commands', json=commands)
+        return status == 200
+
+    async def create_interaction_response(self, interactionID, interactionToken, response):
+        """Respond to an interaction, which must happen within 3 seconds of receiving it."""
+        await self._request('POST', 'interactions/{interaction_id}/{interaction_token}/callback', f'interactions/{interactionID}/{interactionToken}/callback', json=response)
+
+    async def _request(self, method, route, path, **kwargs):
+        """Send a request, waiting out rate limits, and return the response status and JSON body. Metrics are labelled by the route template."""
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            start = time.monotonic()
+            async with self.session.request(method, path, **kwargs) as resp:
+                body = await resp.json() if resp.content_type == 'application/json' else None
+                REST_LATENCY.labels(route, resp.status).observe(time.monotonic() - start)
+                if resp.status != 429 or attempt == RATE_LIMIT_RETRIES:
+                    return resp.status, body
+
+                retryAfter = float((body or {}).get('retry_after') or resp.headers.get('Retry-After', 1))
+
+            REST_RATE_LIMIT_WAITS.labels(route).observe(retryAfter)
+            await asyncio.sleep(retryAfter)
+
     async def close(self):
         """Gracefully close the REST API session."""
         await self.session.close()
         # Wait 250ms for underlying api connection to close (https://docs.aiohttp.org/en/stable/client_advanced.html#client-session).
-        await asyncio.sleep(0.250)
\ No newline at end of file
+        await asyncio.sleep(0.250)
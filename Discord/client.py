@@ -1,26 +1,50 @@
 # 1st Party
 from Utils.events import EventHandler
-from .gateway import Gateway
+from .gateway import DEFAULT_ENCODING
+from .shard_manager import ShardManager
 from .voice_gateway import VoiceGateway
 from .api import Api
+from Utils import tracing
 
 # Standard Library
 import asyncio
 
+# Slash command placing a call, used instead of mentions when reading messages is not wanted
+CALL_COMMAND = {'name': 'call', 'description': 'Call the hotline from your current voice channel.', 'type': 1, 'contexts': [0]}
+APPLICATION_COMMAND_INTERACTION = 2
+CHANNEL_MESSAGE_RESPONSE = 4
+EPHEMERAL_FLAG = 1 << 6
+
 class Client:
     """Manage user facing interaction with Discord's Gateway, VoiceGateway, and REST API"""
-    def __init__(self, token):
+    def __init__(self, token, encoding=DEFAULT_ENCODING, commands=False, shardCount=None, sessionFile=None, standbyChannel=None):
         self._token: str = token
         self.eventHandler: EventHandler = EventHandler()
         self.gatewayEventHandler: EventHandler = EventHandler()
         self.voiceEventHandler: EventHandler = EventHandler()
-        self.gateway: Gateway = Gateway(self._token, self.gatewayEventHandler.dispatch)
         self.voiceGateway: VoiceGateway = None
+        # (guild ID, voice channel ID) a muted voice connection waits in between calls, so a call there only has to start relaying audio
+        self.standbyChannel: tuple = standbyChannel
+        # Whether the voice connection is idling in the standby channel rather than carrying a call
+        self.standby: bool = False
+        # Whether the slash commands were registered by this process, every shard and re-identify receives its own READY
+        self._commandsRegistered: bool = False
         self.api: Api = Api(token)
+        # Behaves as a single gateway, voice connections use the shard owning their guild
+        self.gateway: ShardManager = ShardManager(self._token, self.gatewayEventHandler.dispatch, self.api, encoding=encoding,
+                                                  hasListener=self.gatewayEventHandler.hasListener, shardCount=shardCount,
+                                                  sessionFile=sessionFile)
         
-        # Register listeners
-        self.gatewayEventHandler.on('message_create', self.on_message_create)
+        # Register listeners, gateway intents are derived from them so a bot using slash commands never receives messages
+        if commands:
+            self.gatewayEventHandler.on('ready', self.on_ready)
+            self.gatewayEventHandler.on('interaction_create', self.on_interaction_create)
+        else:
+            self.gatewayEventHandler.on('message_create', self.on_message_create)
         self.gatewayEventHandler.on('voice_server_update', self.on_voice_server_update)
+        if standbyChannel:
+            self.gatewayEventHandler.on('ready', self.on_session_ready)
+            self.gatewayEventHandler.on('resumed', self.on_session_ready)
         self.gatewayEventHandler.on('guild_create', self.on_guild_create)
         self.voiceEventHandler.on('session_description', self.on_session_description)
 
@@ -44,7 +68,10 @@ class Client:
     # Gateway Events
     # ---------------
     async def on_guild_create(self, data):
-        """When a bot connects/reconnects to a guild, determine if the guild is new (if so dispatch an event)."""
+        """When a bot connects/reconnects to a guild, determine if the guild is new (if so dispatch an event). Enter standby once the standby guild is available."""
+        if self.standbyChannel and data['id'] == self.standbyChannel[0] and not self.voiceGateway:
+            await self.enterStandby()
+
         # TODO implement logic for determining if the guild is new
         await self.eventHandler.dispatch('guild_join', data)
 
@@ -56,12 +83,42 @@ class Client:
                 await self.eventHandler.dispatch('bot_mention', data)
                 break
 
+    async def on_session_ready(self):
+        """When a session is established or resumed, enter standby once the standby guild's shard is ready. A resumed session receives no GUILD_CREATE to enter it from."""
+        if not self.voiceGateway and self.gateway.forGuild(self.standbyChannel[0]).sessionReady:
+            await self.enterStandby()
+
+    async def on_ready(self):
+        """When the first session is established, register the bot's slash commands. A failed registration is retried on the next READY."""
+        if self._commandsRegistered:
+            return
+
+        # Claimed before the request so shards becoming ready together register only once
+        self._commandsRegistered = True
+        registered = False
+        try:
+            registered = await self.api.overwrite_global_commands(self.gateway.applicationID, [CALL_COMMAND])
+        finally:
+            self._commandsRegistered = registered
+
+    async def on_interaction_create(self, data):
+        """When the call command is used, acknowledge it and dispatch the same event as a mention."""
+        if data['type'] != APPLICATION_COMMAND_INTERACTION or data['data']['name'] != CALL_COMMAND['name'] or 'guild_id' not in data:
+            return
+
+        response = {'type': CHANNEL_MESSAGE_RESPONSE, 'data': {'content': '`Placing your call.`', 'flags': EPHEMERAL_FLAG}}
+        await self.api.create_interaction_response(data['id'], data['token'], response)
+        # Listeners read the author, guild and channel of the mentioning message
+        await self.eventHandler.dispatch('bot_mention', {'author': data['member']['user'], 'guild_id': data['guild_id'], 'channel_id': data['channel_id']})
+
     async def on_voice_server_update(self, token, endpoint):
         """When a VOICE_SERVER_UPDATE is received, configure and connect the voice gateway."""
         if endpoint:
             self.voiceGateway.token = token
             self.voiceGateway.endpoint = endpoint
-            asyncio.create_task(self.voiceGateway.connect())
+            # Events arrive outside of the call's context, continue the trace of the call that joined voice
+            tracing.record('voice_server_update', parent=self.voiceGateway.trace, endpoint=endpoint)
+            asyncio.create_task(self.voiceGateway.connect(), context=tracing.contextOf(self.voiceGateway.trace))
         else:
             await self.gateway.updateVoiceChannel(channelID=None)
 
@@ -73,18 +130,51 @@ class Client:
 
     # Gateway API Methods
     # --------------------
-    async def joinVoice(self, guildID, channelID):
-        """Join a new voice channel."""
-        await self.gateway.updateVoiceChannel(channelID, guildID)
-        self.voiceGateway = VoiceGateway(self.gateway, guildID, channelID, self.voiceEventHandler.dispatch)
+    async def joinVoice(self, guildID, channelID, selfMute=False, selfDeaf=False):
+        """Join a new voice channel, replacing any current voice connection."""
+        self.standby = False
+        if self.voiceGateway:
+            # Frees the RTP port for the new connection
+            await self.voiceGateway.disconnect()
+        with tracing.span('join_voice', channel=channelID):
+            await self.gateway.updateVoiceChannel(channelID, guildID, selfMute, selfDeaf)
+        self.voiceGateway = VoiceGateway(self.gateway.forGuild(guildID), guildID, channelID, self.voiceEventHandler.dispatch)
 
     async def leaveVoice(self):
-        """Leave the current voice channel."""
+        """Leave the current voice channel, or return to standby if a standby channel is set."""
+        if self.standbyChannel:
+            await self.enterStandby()
+            return
+
         await self.gateway.updateVoiceChannel(channelID=None)
         if self.voiceGateway:
             await self.voiceGateway.disconnect()
             self.voiceGateway = None
 
+    async def enterStandby(self):
+        """Wait in the standby channel muted and deafened, keeping the voice session (and its keys) negotiated for the next call."""
+        guildID, channelID = self.standbyChannel
+        if self.voiceGateway and (self.voiceGateway.serverID, self.voiceGateway.channelID) == (guildID, channelID):
+            # Stay connected, only stop relaying and speaking
+            if self.voiceGateway.rtpEndpoint:
+                self.voiceGateway.rtpEndpoint.proxyEndpoint = None
+                self.voiceGateway.rtpEndpoint.ctrlProxyEndpoint = None
+            if self.voiceGateway.ready:
+                await self.voiceGateway.updateSpeaking(speaking=0)
+            await self.gateway.updateVoiceChannel(channelID, guildID, selfMute=True, selfDeaf=True)
+        else:
+            await self.joinVoice(guildID, channelID, selfMute=True, selfDeaf=True)
+        self.standby = True
+
+    def standbyReady(self, guildID, channelID):
+        """Return whether a call in the voice channel can be carried by the standby connection."""
+        return bool(self.standby and self.voiceGateway and self.voiceGateway.ready and (self.voiceGateway.serverID, self.voiceGateway.channelID) == (guildID, channelID))
+
+    async def activateStandby(self):
+        """Take the standby connection into use for a call, unmuting it. Changing the bot's mute state does not renegotiate the voice session."""
+        self.standby = False
+        await self.gateway.updateVoiceChannel(self.voiceGateway.channelID, self.voiceGateway.serverID)
+
     # REST API Wrapper Methods
     # -----------------
     def createMessage(self, text, channelID):
@@ -95,13 +185,16 @@ class Client:
     # -----------------
     async def fetchVoiceState(self, userID, targetGuildID=None):
         """Return the current voice state of a user using cached values if they exist or a REST API call."""
-        # Check stored voice state
-        guildID, voiceID = self.gateway.getVoiceState(userID)
-
-        # Query API if no stored voice state found and a target guild was specified
-        if targetGuildID and not guildID:
-            guildID, voiceID = await self.api.get_user_voice_state(userID, targetGuildID)
-            if guildID and voiceID:
-                self.gateway.setVoiceState(userID, (guildID, voiceID))
-            
+        with tracing.span('fetch_voice_state', user=userID, cached=True) as span:
+            # Check stored voice state
+            guildID, voiceID = self.gateway.getVoiceState(userID)
+
+            # Query API if no stored voice state found and a target guild was specified
+            if targetGuildID and not guildID:
+                if span:
+                    span.attributes['cached'] = False
+                guildID, voiceID = await self.api.get_user_voice_state(userID, targetGuildID)
+                if guildID and voiceID:
+                    self.gateway.setVoiceState(userID, (guildID, voiceID))
+
         return guildID, voiceID
\ No newline at end of file
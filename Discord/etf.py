@@ -0,0 +1,168 @@
+# Standard Library
+import struct
+
+FORMAT_VERSION = 131
+NEW_FLOAT_EXT = 70
+SMALL_INTEGER_EXT = 97
+INTEGER_EXT = 98
+FLOAT_EXT = 99
+ATOM_EXT = 100
+SMALL_TUPLE_EXT = 104
+LARGE_TUPLE_EXT = 105
+NIL_EXT = 106
+STRING_EXT = 107
+LIST_EXT = 108
+BINARY_EXT = 109
+SMALL_BIG_EXT = 110
+LARGE_BIG_EXT = 111
+SMALL_ATOM_EXT = 115
+MAP_EXT = 116
+ATOM_UTF8_EXT = 118
+SMALL_ATOM_UTF8_EXT = 119
+
+ATOMS = {'nil': None, 'true': True, 'false': False}
+_INT32 = struct.Struct('>i')
+_UINT32 = struct.Struct('>I')
+_UINT16 = struct.Struct('>H')
+_DOUBLE = struct.Struct('>d')
+
+class EtfError(ValueError):
+    """Raised when a term cannot be encoded or decoded."""
+
+def decode(data):
+    """Decode an External Term Format message. Binaries are decoded as strings and big integers (snowflakes) as decimal strings, matching the JSON encoding."""
+    if not data or data[0] != FORMAT_VERSION:
+        raise EtfError('Unsupported ETF version')
+
+    try:
+        term, offset = _decodeTerm(memoryview(data), 1)
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise EtfError(f'Malformed ETF message: {e}') from e
+
+    return term
+
+def encode(term):
+    """Encode a term in the External Term Format."""
+    buffer = bytearray((FORMAT_VERSION,))
+    _encodeTerm(term, buffer)
+    return bytes(buffer)
+
+def _decodeTerm(data, offset):
+    """Helper method to decode the term at the offset, returning it with the offset of the following term."""
+    tag = data[offset]
+    offset += 1
+
+    match tag:
+        case 97:  # SMALL_INTEGER_EXT
+            return data[offset], offset + 1
+        case 98:  # INTEGER_EXT
+            return _INT32.unpack_from(data, offset)[0], offset + 4
+        case 70:  # NEW_FLOAT_EXT
+            return _DOUBLE.unpack_from(data, offset)[0], offset + 8
+        case 109:  # BINARY_EXT
+            length = _UINT32.unpack_from(data, offset)[0]
+            offset += 4
+            return str(data[offset:offset + length], 'utf-8'), offset + length
+        case 116:  # MAP_EXT
+            arity = _UINT32.unpack_from(data, offset)[0]
+            offset += 4
+            result = {}
+            for _ in range(arity):
+                key, offset = _decodeTerm(data, offset)
+                result[key], offset = _decodeTerm(data, offset)
+            return result, offset
+        case 108:  # LIST_EXT
+            length = _UINT32.unpack_from(data, offset)[0]
+            offset += 4
+            result = []
+            for _ in range(length):
+                item, offset = _decodeTerm(data, offset)
+                result.append(item)
+            # Proper lists end with an empty list tail
+            _, offset = _decodeTerm(data, offset)
+            return result, offset
+        case 106:  # NIL_EXT
+            return [], offset
+        case 119 | 115:  # SMALL_ATOM_UTF8_EXT, SMALL_ATOM_EXT
+            length = data[offset]
+            offset += 1
+            return _atom(str(data[offset:offset + length], 'utf-8' if tag == SMALL_ATOM_UTF8_EXT else 'latin-1')), offset + length
+        case 118 | 100:  # ATOM_UTF8_EXT, ATOM_EXT
+            length = _UINT16.unpack_from(data, offset)[0]
+            offset += 2
+            return _atom(str(data[offset:offset + length], 'utf-8' if tag == ATOM_UTF8_EXT else 'latin-1')), offset + length
+        case 110 | 111:  # SMALL_BIG_EXT, LARGE_BIG_EXT
+            if tag == SMALL_BIG_EXT:
+                length = data[offset]
+                offset += 1
+            else:
+                length = _UINT32.unpack_from(data, offset)[0]
+                offset += 4
+            sign = data[offset]
+            value = int.from_bytes(data[offset + 1:offset + 1 + length], 'little')
+            return str(-value if sign else value), offset + 1 + length
+        case 107:  # STRING_EXT, a list of small integers
+            length = _UINT16.unpack_from(data, offset)[0]
+            offset += 2
+            return list(data[offset:offset + length]), offset + length
+        case 104 | 105:  # SMALL_TUPLE_EXT, LARGE_TUPLE_EXT
+            if tag == SMALL_TUPLE_EXT:
+                arity = data[offset]
+                offset += 1
+            else:
+                arity = _UINT32.unpack_from(data, offset)[0]
+                offset += 4
+            result = []
+            for _ in range(arity):
+                item, offset = _decodeTerm(data, offset)
+                result.append(item)
+            return tuple(result), offset
+        case 99:  # FLOAT_EXT
+            return float(str(data[offset:offset + 31], 'latin-1').rstrip('\x00')), offset + 31
+        case _:
+            raise EtfError(f'Unsupported ETF tag {tag}')
+
+def _atom(name):
+    """Helper method to convert an atom to its Python value."""
+    return ATOMS.get(name, name)
+
+def _encodeTerm(term, buffer):
+    """Helper method to append an encoded term to the buffer."""
+    if term is None or term is True or term is False:
+        name = 'nil' if term is None else str(term).lower()
+        buffer += bytes((SMALL_ATOM_UTF8_EXT, len(name))) + name.encode('utf-8')
+    elif isinstance(term, int):
+        if 0 <= term <= 255:
+            buffer += bytes((SMALL_INTEGER_EXT, term))
+        elif -2 ** 31 <= term < 2 ** 31:
+            buffer.append(INTEGER_EXT)
+            buffer += _INT32.pack(term)
+        else:
+            magnitude = abs(term)
+            digits = magnitude.to_bytes((magnitude.bit_length() + 7) // 8, 'little')
+            if len(digits) > 255:
+                raise EtfError('Integer too large to encode')
+            buffer += bytes((SMALL_BIG_EXT, len(digits), term < 0)) + digits
+    elif isinstance(term, float):
+        buffer.append(NEW_FLOAT_EXT)
+        buffer += _DOUBLE.pack(term)
+    elif isinstance(term, (str, bytes, bytearray)):
+        encoded = term.encode('utf-8') if isinstance(term, str) else term
+        buffer.append(BINARY_EXT)
+        buffer += _UINT32.pack(len(encoded))
+        buffer += encoded
+    elif isinstance(term, dict):
+        buffer.append(MAP_EXT)
+        buffer += _UINT32.pack(len(term))
+        for key, value in term.items():
+            _encodeTerm(key, buffer)
+            _encodeTerm(value, buffer)
+    elif isinstance(term, (list, tuple)):
+        if term:
+            buffer.append(LIST_EXT)
+            buffer += _UINT32.pack(len(term))
+            for item in term:
+                _encodeTerm(item, buffer)
+        buffer.append(NIL_EXT)
+    else:
+        raise EtfError(f'Cannot encode {type(term).__name__} as ETF')
@@ -1,16 +1,31 @@
 # 1st Party
-from .gateway_connection import GatewayConnection, GatewayMessage
+from .gateway_connection import GatewayConnection, GatewayMessage, HeartbeatTimeout, Priorities, ReconnectActions, CODECS
 from Utils.events import EventHandler
+from Utils import metrics
 
 # 3rd Party
 import websockets
 
 # Standard Library
 import asyncio
-from enum import Enum
+import random
+from enum import Enum, IntFlag
 
 DEFAULT_ENDPOINT = 'wss://gateway.discord.gg/'
-DEFAULT_PARAMS = '&encoding=json'
+DEFAULT_ENCODING = 'json'
+# Dispatch events the gateway itself consumes, whatever listeners are registered
+TRACKED_EVENTS = {'READY', 'RESUMED', 'VOICE_STATE_UPDATE', 'VOICE_SERVER_UPDATE'}
+# Guilds with more members than this are sent without offline members in GUILD_CREATE (50 is the smallest Discord accepts)
+LARGE_THRESHOLD = 50
+GUILD_ID_FIELD = b'"guild_id":"'
+# Events a call waits on (or must answer within seconds) are processed ahead of the rest, chat traffic after it
+HIGH_PRIORITY_EVENTS = {'READY', 'RESUMED', 'VOICE_STATE_UPDATE', 'VOICE_SERVER_UPDATE', 'INTERACTION_CREATE'}
+# Bounds (seconds) of the random wait before identifying after an invalid session, as Discord asks
+INVALID_SESSION_DELAY = (1, 5)
+LOW_PRIORITY_EVENTS = {'MESSAGE_CREATE', 'MESSAGE_UPDATE', 'MESSAGE_DELETE', 'MESSAGE_DELETE_BULK', 'MESSAGE_REACTION_ADD', 'MESSAGE_REACTION_REMOVE', 'TYPING_START',
+                       'PRESENCE_UPDATE'}
+
+GUILD_BYTES = metrics.registry.counter('redtelephone_gateway_guild_received_bytes_total', 'Decompressed gateway bytes received, by the guild they concern.', ('guild',))
 
 class OpCodes(Enum):
     """Enum class of sent/received gateway message OpCodes."""
@@ -27,6 +42,44 @@ class OpCodes(Enum):
     HEARTBEAT_ACK = 11
     REQUEST_SOUNDBOURD_SOUNDS = 31
 
+class Intents(IntFlag):
+    """Enum class of gateway intents, each subscribing to a group of events."""
+    GUILDS = 1 << 0
+    GUILD_MEMBERS = 1 << 1
+    GUILD_MODERATION = 1 << 2
+    GUILD_EXPRESSIONS = 1 << 3
+    GUILD_INTEGRATIONS = 1 << 4
+    GUILD_WEBHOOKS = 1 << 5
+    GUILD_INVITES = 1 << 6
+    GUILD_VOICE_STATES = 1 << 7
+    GUILD_PRESENCES = 1 << 8
+    GUILD_MESSAGES = 1 << 9
+    GUILD_MESSAGE_REACTIONS = 1 << 10
+    GUILD_MESSAGE_TYPING = 1 << 11
+    DIRECT_MESSAGES = 1 << 12
+    MESSAGE_CONTENT = 1 << 15
+
+# Intents the gateway needs for its own bookkeeping (guilds and the voice state cache)
+BASE_INTENTS = Intents.GUILDS | Intents.GUILD_VOICE_STATES
+# Intent required by each event, events absent from the map (e.g. interactions) need none
+EVENT_INTENTS = {
+    'guild_member_add': Intents.GUILD_MEMBERS,
+    'guild_member_update': Intents.GUILD_MEMBERS,
+    'guild_member_remove': Intents.GUILD_MEMBERS,
+    'guild_ban_add': Intents.GUILD_MODERATION,
+    'guild_ban_remove': Intents.GUILD_MODERATION,
+    'guild_emojis_update': Intents.GUILD_EXPRESSIONS,
+    'invite_create': Intents.GUILD_INVITES,
+    'invite_delete': Intents.GUILD_INVITES,
+    'presence_update': Intents.GUILD_PRESENCES,
+    'message_create': Intents.GUILD_MESSAGES,
+    'message_update': Intents.GUILD_MESSAGES,
+    'message_delete': Intents.GUILD_MESSAGES,
+    'message_reaction_add': Intents.GUILD_MESSAGE_REACTIONS,
+    'message_reaction_remove': Intents.GUILD_MESSAGE_REACTIONS,
+    'typing_start': Intents.GUILD_MESSAGE_TYPING,
+}
+
 class CloseCodes(Enum):
     """Enum class of gateway close codes."""
     UNKNOWN_ERROR = 4000
@@ -45,20 +98,44 @@ class CloseCodes(Enum):
     DISALLOWED_INTENT = 4014
 
     def reconnectable(self):
-        if self not in [CloseCodes.AUTHENTICATION_FAILED, CloseCodes.INVALID_SHARD, CloseCodes.SHARDING_REQUIRED, CloseCodes.INVALID_API_VERSION,
-                             CloseCodes.INVALID_INTENT, CloseCodes.DISALLOWED_INTENT]:
+        """Returns whether the specified gateway close code allows reconnection."""
+        if self in [CloseCodes.AUTHENTICATION_FAILED, CloseCodes.INVALID_SHARD, CloseCodes.SHARDING_REQUIRED, CloseCodes.INVALID_API_VERSION,
+                    CloseCodes.INVALID_INTENT, CloseCodes.DISALLOWED_INTENT]:
             return False
-        else:
-            return True
+
+        return True
+
+    def resumable(self):
+        """Returns whether the session survives the specified gateway close code."""
+        if self in [CloseCodes.NOT_AUTHENTICATED, CloseCodes.INVALID_SEQ, CloseCodes.SESSION_TIMED_OUT]:
+            return False
+
+        return True
 
 class Gateway(GatewayConnection):
     """Manage gateway state and handling of incoming/outgoing gateway messages."""
-    def __init__(self, token, eventDispatcher):
-        super().__init__(token, DEFAULT_ENDPOINT, DEFAULT_PARAMS)
+    CLOSE_CODES = CloseCodes
+
+    def __init__(self, token, eventDispatcher, compress=True, encoding=DEFAULT_ENCODING, hasListener=None, shard=None, identifyGate=None):
+        # Shards are labelled by their ID, e.g. gateway-3
+        super().__init__(token, DEFAULT_ENDPOINT, f'&encoding={encoding}', compress, CODECS[encoding], name=f'{self.NAME}-{shard[0]}' if shard else None)
+        # [shard_id, num_shards] of a sharded connection, None when the connection receives every guild
+        self.shard: list = shard
+        # Awaited before each IDENTIFY, used to respect the shared identify rate limit of sharded bots
+        self._identifyGate = identifyGate
+        # Close code of the connection if it was closed for good
+        self.closeCode: int = None
         self.userID: int = None
+        self.applicationID: str = None
         self.sessionID: int = None
+        # Whether the current connection's session is established (READY or RESUMED received), i.e. it may send voice state updates
+        self.sessionReady: bool = False
         self._eventDispatcher: EventHandler.dispatch = eventDispatcher
+        # Returns whether an event has listeners, events without any are skipped unparsed (None parses every event)
+        self._hasListener: EventHandler.hasListener = hasListener
         self._voiceState: dict = {}
+        # Size of the message being processed, attributed to its guild once parsed
+        self._messageSize: int = 0
 
     def getVoiceState(self, userID):
         """Retrieve voice state of specified user."""
@@ -69,26 +146,102 @@ class Gateway(GatewayConnection):
         self._voiceState[userID] = value
 
     async def connect(self):
-        """Establish a gateway connection and attempt to reconnect on unexpected websocket close."""
-        # TODO add exponential backoff?
+        """Establish a gateway connection and reconnect whenever it is lost, as paced by the reconnect scheduler."""
         while True:
             try:
                 await self._start()
-            except websockets.exceptions.ConnectionClosedOK:
-                self._stop(clean=True)
-            except websockets.exceptions.ConnectionClosedError as e:
-                if CloseCodes(e.code).reconnectable():
-                    self._stop(clean=False)
-                else:
+                # Stopped by a RECONNECT or INVALID_SESSION, resuming unless the session was invalidated
+                action = ReconnectActions.RESUME if self.sessionID else ReconnectActions.IDENTIFY
+            except (websockets.exceptions.ConnectionClosed, websockets.exceptions.InvalidHandshake, HeartbeatTimeout, OSError, TimeoutError) as e:
+                print(f'Gateway connection lost: {e!r}')
+                action = self.closeAction(e)
+                if action is ReconnectActions.STOP:
+                    # Resharding (4011) is up to the shard manager
+                    self.closeCode = e.rcvd.code
                     self._stop(clean=True)
                     break
 
+            self._stop(clean=action is ReconnectActions.IDENTIFY)
+            self._countReconnect(resume=action is ReconnectActions.RESUME and self.sessionID is not None)
+            if action is ReconnectActions.IDENTIFY:
+                await asyncio.sleep(random.uniform(*INVALID_SESSION_DELAY))
+            await self._reconnect.wait()
+
+    def sessionState(self):
+        """Return what is needed to resume the session from another process, or None if there is no session."""
+        if not self.sessionID:
+            return None
+
+        return {'session_id': self.sessionID, 'seq': self.lastSequence, 'resume_gateway_url': self.endpoint, 'user_id': self.userID,
+                'application_id': self.applicationID}
+
+    def restoreSession(self, state):
+        """Adopt a session saved by sessionState, the next connection will try to resume it (falling back to identifying if it is no longer valid)."""
+        self.sessionID = state['session_id']
+        self.lastSequence = state['seq']
+        self.endpoint = state['resume_gateway_url']
+        # A RESUMED, unlike a READY, doesn't describe the bot
+        self.userID = state['user_id']
+        self.applicationID = state['application_id']
+
+    def forGuild(self, guildID):
+        """Return the connection receiving the guild's events, which is this connection."""
+        return self
+
     def _clean(self):
         """Revert session specific properties."""
         super()._clean()
         self.sessionID = None
+        self.sessionReady = False
         self.endpoint = DEFAULT_ENDPOINT
 
+    def intents(self):
+        """Return the smallest set of intents covering the gateway's bookkeeping and the registered listeners."""
+        intents = BASE_INTENTS
+        for event, intent in EVENT_INTENTS.items():
+            if not self._hasListener or self._hasListener(event):
+                intents |= intent
+
+        return intents.value
+
+    def received(self, data, header):
+        """Attribute a JSON message's size to the guild it concerns. GUILD_CREATE is attributed once parsed, as its guild ID is not a guild_id field."""
+        self._messageSize = len(data)
+        if header is None or header[2] == 'GUILD_CREATE':
+            return
+
+        start = data.find(GUILD_ID_FIELD)
+        if start == -1:
+            GUILD_BYTES.labels('').inc(len(data))
+        else:
+            start += len(GUILD_ID_FIELD)
+            GUILD_BYTES.labels(bytes(data[start:data.find(b'"', start)]).decode('ascii')).inc(len(data))
+
+    def skipPayload(self, op, s, t):
+        """Skip dispatch events that neither the gateway nor any listener consumes."""
+        return op == OpCodes.EVENT_DISPATCH.value and bool(t) and bool(self._hasListener) and t not in TRACKED_EVENTS and not self._hasListener(t.lower())
+
+    def priority(self, msgObj):
+        """Process connection control messages inline and queue dispatch events by how urgently they are needed."""
+        if msgObj.op != OpCodes.EVENT_DISPATCH.value:
+            return None
+        elif msgObj.t in HIGH_PRIORITY_EVENTS:
+            return Priorities.HIGH
+        elif msgObj.t in LOW_PRIORITY_EVENTS:
+            return Priorities.LOW
+
+        return Priorities.NORMAL
+
+    def coalesceKey(self, msgObj):
+        """Only the latest of queued heartbeats, presence updates and voice state updates (per guild) is sent."""
+        match OpCodes(msgObj.op):
+            case OpCodes.HEARTBEAT | OpCodes.PRESENCE_UPDATE:
+                return msgObj.op
+            case OpCodes.VOICE_STATE_UPDATE:
+                return (msgObj.op, msgObj.d['guild_id'])
+
+        return None
+
     async def processMsg(self, msgObj):
         """Process incoming gateway messages."""
         match OpCodes(msgObj.op):
@@ -97,27 +250,32 @@ class Gateway(GatewayConnection):
                 if("heartbeat_interval" in msgObj.d):
                     self.setHeartbeatInterval(msgObj.d["heartbeat_interval"])
 
+                self.sessionReady = False
                 if self.sessionID:
                     # Resume connection
                     data = {'token': self.token, 'session_id': self.sessionID, 'seq': self.lastSequence}
                     opcode = OpCodes.RESUME.value
                 else:
                     # Identify to API
-                    data = {"token": self.token, "properties": {"os": "Linux", "browser": "redTelephone", "device": "redTelephone"}, "intents": (1 << 7) + (1 << 9) + (1 << 0)}
+                    data = {"token": self.token, "properties": {"os": "Linux", "browser": "redTelephone", "device": "redTelephone"}, "intents": self.intents(),
+                            "large_threshold": LARGE_THRESHOLD}
+                    if self.shard:
+                        data['shard'] = self.shard
                     opcode = OpCodes.IDENTIFY.value
+                    if self._identifyGate:
+                        await self._identifyGate(self.shard[0] if self.shard else 0)
                     
                 await self.send(GatewayMessage(opcode, data))
 
             case OpCodes.EVENT_DISPATCH:
-                # Update sequence number
-                if(msgObj.s):
-                    self.lastSequence = msgObj.s
-
                 args = []
                 match msgObj.t:
                     case 'READY':
+                        self.recovered(resumed=False)
+                        self.sessionReady = True
                         self.userID = msgObj.d['user']['id']
-                        self.setEndpoint = msgObj.d['resume_gateway_url']
+                        self.applicationID = msgObj.d.get('application', {}).get('id')
+                        self.endpoint = msgObj.d['resume_gateway_url']
                         self.sessionID = msgObj.d['session_id']
 
                     case 'MESSAGE_CREATE':
@@ -135,9 +293,15 @@ class Gateway(GatewayConnection):
                                 'wss://' + msgObj.d['endpoint']]
                     
                     case 'RESUMED':
+                        self.recovered(resumed=True)
+                        self.sessionReady = True
                         self.attempts = 0
 
                     case 'GUILD_CREATE':
+                        GUILD_BYTES.labels(msgObj.d['id']).inc(self._messageSize)
+                        args = [msgObj.d]
+
+                    case 'INTERACTION_CREATE':
                         args = [msgObj.d]
 
                     case _:
@@ -157,9 +321,8 @@ class Gateway(GatewayConnection):
                 clean = not msgObj.d
                 self._stop(clean)
 
-            # TODO is timer needed to verify heartbeat ack and connection still open?
             case OpCodes.HEARTBEAT_ACK:
-                pass
+                self.heartbeatAcked()
 
             case _:
                 pass
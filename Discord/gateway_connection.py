@@ -1,17 +1,120 @@
+# 1st Party
+from Utils import metrics
+from . import etf
+
 # 3rd Party
 import websockets
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Standard Library
 import asyncio
 from typing import Any
 import json
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
+from enum import Enum, IntEnum
 import logging
 import os
+import random
+import re
+import time
+import zlib
 
 API_VERSION = 10
 
-@dataclass
+HEARTBEAT_RTT = metrics.registry.histogram('redtelephone_gateway_heartbeat_rtt_seconds', 'Time from sending a heartbeat to receiving its ACK, by gateway.',
+                                           ('gateway',), buckets=(0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+LATENCY = metrics.registry.gauge('redtelephone_gateway_latency_seconds', 'Round trip time of the latest acknowledged heartbeat, by gateway.', ('gateway',))
+MISSED_ACKS = metrics.registry.counter('redtelephone_gateway_missed_acks_total', 'Heartbeats that were not acknowledged before the next was due, by gateway.', ('gateway',))
+RECEIVED_BYTES = metrics.registry.counter('redtelephone_gateway_received_bytes_total', 'Bytes received by a gateway, on the wire and once decompressed.',
+                                          ('gateway', 'stage'))
+DECODE_SECONDS = metrics.registry.counter('redtelephone_gateway_decode_seconds_total', 'Time spent decompressing and parsing received gateway messages.', ('gateway',))
+PAYLOADS = metrics.registry.counter('redtelephone_gateway_payloads_total', 'Received gateway messages by event, and whether their payload was parsed or skipped.',
+                                    ('gateway', 'event', 'parsed'))
+QUEUE_DEPTH = metrics.registry.gauge('redtelephone_gateway_queue_depth', 'Messages waiting in a gateway\'s receive queues (by priority) and send queue.', ('gateway', 'queue'))
+QUEUE_DROPPED = metrics.registry.counter('redtelephone_gateway_queue_dropped_total', 'Received messages dropped by a full receive queue\'s overflow policy.', ('gateway', 'queue'))
+SENDS_COALESCED = metrics.registry.counter('redtelephone_gateway_sends_coalesced_total', 'Queued messages not sent because a later message superseded them.', ('gateway',))
+RECONNECTS = metrics.registry.counter('redtelephone_gateway_reconnects_total', 'Gateway reconnection attempts, by gateway and whether the session was resumed.',
+                                      ('gateway', 'resume'))
+RECONNECT_SECONDS = metrics.registry.histogram('redtelephone_gateway_reconnect_seconds', 'Time from losing a gateway connection to its session being ready again, by gateway and whether it was resumed.',
+                                               ('gateway', 'resume'), buckets=(0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+
+# Discord serialises the t, s and op fields ahead of d, so they can be read without parsing the payload
+JSON_HEADER_PATTERN = re.compile(rb'\{\s*"t"\s*:\s*(?:null|"([A-Za-z0-9_]+)")\s*,\s*"s"\s*:\s*(?:null|(\d+))\s*,\s*"op"\s*:\s*(\d+)\s*,')
+
+# Every complete zlib-stream message ends with the Z_SYNC_FLUSH marker
+ZLIB_SUFFIX = b'\x00\x00\xff\xff'
+
+# Closing with 1000 (or 1001) ends the session, any other code keeps it resumable
+NORMAL_CLOSE_CODE = 1000
+GOING_AWAY_CLOSE_CODE = 1001
+# Close code of a connection that ended without a close frame
+ABNORMAL_CLOSE_CODE = 1006
+RESUMABLE_CLOSE_CODE = 4000
+# Seconds to wait for a closing handshake, a connection that stopped acknowledging heartbeats is unlikely to complete one
+CLOSE_TIMEOUT = 1
+# Bounds (seconds) of the delay between consecutive failed reconnection attempts
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+
+class HeartbeatTimeout(ConnectionError):
+    """Raised when a heartbeat is not acknowledged before the next one is due."""
+
+class ReconnectActions(Enum):
+    """Enum class of how a connection recovers from being closed."""
+    RESUME = 'resume'
+    # The session is gone, start a new one
+    IDENTIFY = 'identify'
+    # Reconnecting can't succeed (e.g. invalid credentials)
+    STOP = 'stop'
+
+class ReconnectScheduler():
+    """Pace the reconnection attempts of a connection. The first attempt after losing a connection is immediate, consecutive failures back off with decorrelated jitter."""
+    def __init__(self, name, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+        self.name: str = name
+        self.base: float = base
+        self.cap: float = cap
+        # Consecutive attempts since the connection was last ready
+        self.failures: int = 0
+        self._delay: float = base
+        self._disconnectedAt: float = None
+
+    async def wait(self):
+        """Wait before the next reconnection attempt."""
+        if self._disconnectedAt is None:
+            self._disconnectedAt = time.monotonic()
+
+        if self.failures:
+            # Spreads out clients that lost their connections together, unlike plain exponential backoff
+            self._delay = min(self.cap, random.uniform(self.base, self._delay * 3))
+            print(f'Reconnecting {self.name} in {self._delay:.1f}s (attempt {self.failures + 1}).')
+            await asyncio.sleep(self._delay)
+        self.failures += 1
+
+    def recovered(self, resumed):
+        """Record that the session is ready again, resetting the backoff."""
+        if self._disconnectedAt is not None:
+            RECONNECT_SECONDS.labels(self.name, 'true' if resumed else 'false').observe(time.monotonic() - self._disconnectedAt)
+        self.failures = 0
+        self._delay = self.base
+        self._disconnectedAt = None
+
+class Priorities(IntEnum):
+    """Enum class of receive queue priorities, lower values are processed first."""
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+class OverflowPolicies(Enum):
+    """Enum class of what a full receive queue does with another message."""
+    # Stop receiving until the queue has room (backpressure on the websocket)
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+
+@dataclass(slots=True)
 class GatewayMessage:
     """Data class representing the message format utillized by Discord gateways."""
     op: int
@@ -20,32 +123,128 @@ class GatewayMessage:
     t: str = None
 
     def __str__(self):
-        classDict = asdict(self)
-        jsonString = json.dumps(classDict)
-        return jsonString
+        return json.dumps(self.toDict())
+
+    def toDict(self):
+        """Return the message as a payload dictionary, referencing (not copying) its data."""
+        return {'op': self.op, 'd': self.d, 's': self.s, 't': self.t}
+
+    @staticmethod
+    def fromDict(payload):
+        """Build a message from a decoded payload dictionary."""
+        return GatewayMessage(payload['op'], payload.get('d'), payload.get('s'), payload.get('t'))
 
     @staticmethod
     def fromStr(string):
-        jsonDict = json.loads(string)
-        classObj = GatewayMessage(**jsonDict)
-        return classObj
+        return GatewayMessage.fromDict(json.loads(string))
+
+class JsonCodec():
+    """Encode gateway messages as JSON text frames, using orjson when it is installed."""
+    ENCODING = 'json'
+    TEXT = True
+
+    @staticmethod
+    def encode(msgObj):
+        """Return the message's payload as UTF-8 encoded JSON."""
+        payload = msgObj.toDict()
+        return orjson.dumps(payload) if orjson else json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def decode(data):
+        """Build a message from UTF-8 encoded JSON."""
+        return GatewayMessage.fromDict(orjson.loads(data) if orjson else json.loads(data))
+
+    @staticmethod
+    def peek(data):
+        """Return the (op, s, t) header of a message without parsing its payload, or None if the fields are not in the expected order."""
+        match = JSON_HEADER_PATTERN.match(data)
+        if not match:
+            return None
+
+        event, sequence, op = match.groups()
+        return int(op), int(sequence) if sequence else None, event.decode('ascii') if event else None
+
+class EtfCodec():
+    """Encode gateway messages as External Term Format binary frames."""
+    ENCODING = 'etf'
+    TEXT = False
+
+    @staticmethod
+    def encode(msgObj):
+        """Return the message's payload in the External Term Format."""
+        return etf.encode(msgObj.toDict())
+
+    @staticmethod
+    def decode(data):
+        """Build a message from the External Term Format."""
+        return GatewayMessage.fromDict(etf.decode(data))
+
+    @staticmethod
+    def peek(data):
+        """Terms are not ordered, every message is parsed in full."""
+        return None
+
+CODECS = {codec.ENCODING: codec for codec in (JsonCodec, EtfCodec)}
 
 class GatewayConnection:
     """Manage underlying websocket connection and maintenance."""
-    def __init__(self, token, endpoint, params=''):
+    # Default label of the connection's metrics
+    NAME = 'gateway'
+    # Enum of the connection's close codes, with reconnectable() and resumable() methods
+    CLOSE_CODES = None
+    # Size and overflow policy of each receive queue, messages that must not be lost block instead of being dropped
+    RECV_QUEUES = {
+        Priorities.HIGH: (256, OverflowPolicies.BLOCK),
+        Priorities.NORMAL: (256, OverflowPolicies.BLOCK),
+        Priorities.LOW: (1024, OverflowPolicies.DROP_OLDEST),
+    }
+
+    def __init__(self, token, endpoint, params='', compress=False, codec=JsonCodec, name=None):
         self.token: str = token
+        # Label of this connection's metrics, distinguishing connections of the same kind (e.g. shards)
+        self.name: str = name or self.NAME
         self.lastSequence: int = None
         self.endpoint: str = endpoint
-        self.params: str = params
+        self.params: str = params + ('&compress=zlib-stream' if compress else '')
+        # Messages are sent and received as bytes, without an intermediate str
+        self.codec = codec
+        # Transport compression shares one zlib context across every message of a connection
+        self.compress: bool = compress
+        self._inflator = None
+        self._inflateBuffer: bytearray = bytearray()
         self._heartbeatInterval: float = 1
-        self._sendQueue: asyncio.Queue = asyncio.Queue()
+        # Received messages waiting to be processed, by priority, and the number waiting across all of them
+        self._recvQueues: dict = {}
+        self._recvQueued: asyncio.Semaphore = None
+        self._sendQueue: asyncio.Queue = None
+        self._newQueues()
         self._tasks: asyncio.Future = None
         self._connected: asyncio.Event = asyncio.Event()
         self.attempts: int = 0
+        # Whether the session should stay resumable when the connection is shut down, e.g. so a restarted process can resume it
+        self.keepSession: bool = False
+        self._disconnecting: bool = False
+        self._reconnect: ReconnectScheduler = ReconnectScheduler(self.name)
+        # Send time of the latest heartbeat that has not been acknowledged
+        self._heartbeatSent: float = None
+        self._receivedHello: asyncio.Event = asyncio.Event()
+        # Round trip time (seconds) of the latest acknowledged heartbeat
+        self.latency: float = None
+        self._heartbeatRtt = HEARTBEAT_RTT.labels(self.name)
+        self._latency = LATENCY.labels(self.name)
+        self._missedAcks = MISSED_ACKS.labels(self.name)
+        self._wireBytes = RECEIVED_BYTES.labels(self.name, 'wire')
+        self._decodedBytes = RECEIVED_BYTES.labels(self.name, 'decoded')
+        self._decodeSeconds = DECODE_SECONDS.labels(self.name)
+        self._queueDepths = {priority: QUEUE_DEPTH.labels(self.name, priority.name.lower()) for priority in Priorities}
+        self._queueDropped = {priority: QUEUE_DROPPED.labels(self.name, priority.name.lower()) for priority in Priorities}
+        self._sendQueueDepth = QUEUE_DEPTH.labels(self.name, 'send')
+        self._sendsCoalesced = SENDS_COALESCED.labels(self.name)
 
     def setHeartbeatInterval(self, ms):
-        """Set the interval at which to generate heartbeat messages."""
+        """Set the interval at which to generate heartbeat messages, starting the heartbeat loop."""
         self._heartbeatInterval = ms / 1000
+        self._receivedHello.set()
 
     async def connect(self):
         """Start a gateway connection and specify reconnect behaviour. To be implemented by child class."""
@@ -55,54 +254,253 @@ class GatewayConnection:
         """Disconnect from the gateway after connection is fully established."""
         # TODO Add a timeout to waiting on _connected (in order to prevent queueing a disconnect to be executed much later.)?
         await self._connected.wait()
+        self._disconnecting = True
         self._stop()
 
+    def isConnected(self):
+        """Return whether the connection is fully established."""
+        return self._connected.is_set()
+
     async def _start(self):
-        """Open a websocket connection to Discord and start recv and heartbeat task loops."""
+        """Open a websocket connection to Discord and start recv and heartbeat task loops. Returns normally when the connection was stopped to be restarted."""
         self.attempts += 1
+        self._heartbeatSent = None
+        self._receivedHello.clear()
+        # The compressed stream starts over with every connection
+        self._inflator = zlib.decompressobj() if self.compress else None
+        self._inflateBuffer.clear()
+        # Messages queued for a previous connection (heartbeats, identifies) are meaningless on a new one, received messages are kept
+        while not self._sendQueue.empty():
+            self._sendQueue.get_nowait()
+        self._sendQueueDepth.value = 0
         async with websockets.connect(f'{self.endpoint}?v={API_VERSION}{self.params}', open_timeout=15) as websock:
             self._websock = websock
-            self._tasks = asyncio.gather(self._recvLoop(websock), self._heartbeatLoop())
+            loops = [asyncio.create_task(self._recvLoop(websock)), asyncio.create_task(self._processLoop()), asyncio.create_task(self._sendLoop(websock)),
+                     asyncio.create_task(self._heartbeatLoop())]
+            self._tasks = asyncio.gather(*loops)
             self._connected.set()
-            await self._tasks
+            try:
+                await self._tasks
+            except HeartbeatTimeout:
+                # Don't wait for the operating system to notice the dead connection
+                await self._close(websock, RESUMABLE_CLOSE_CODE, 'Heartbeat ACK not received')
+                raise
+            except asyncio.CancelledError:
+                # Loops are cancelled by _stop, either to restart the connection (RECONNECT, INVALID_SESSION) or to shut it down
+                finished = self._disconnecting or asyncio.current_task().cancelling()
+                await self._close(websock, NORMAL_CLOSE_CODE if finished and not self.keepSession else RESUMABLE_CLOSE_CODE)
+                if finished:
+                    raise
+            finally:
+                # A failed gather leaves the other loop running
+                for task in loops:
+                    task.cancel()
+
+    async def _close(self, websock, code, reason=''):
+        """Close the websocket with the close code, aborting it if the closing handshake does not complete in time."""
+        try:
+            async with asyncio.timeout(CLOSE_TIMEOUT):
+                await websock.close(code=code, reason=reason)
+        except TimeoutError:
+            websock.transport.abort()
+
+    def heartbeatAcked(self):
+        """Record the round trip time of the acknowledged heartbeat."""
+        if self._heartbeatSent is not None:
+            self.latency = time.monotonic() - self._heartbeatSent
+            self._heartbeatRtt.observe(self.latency)
+            self._latency.value = self.latency
+            self._heartbeatSent = None
 
     def _stop(self, clean=True):
         """Close the websocket connection to Discord and cancel task loops. Clean the gateway connection if specified."""
         self._connected.clear()
-        self._tasks.cancel()
+        # Connecting may have failed before any loops started
+        if self._tasks:
+            self._tasks.cancel()
         if clean:
             self._clean()
 
+    def _countReconnect(self, resume):
+        """Count a reconnection attempt."""
+        RECONNECTS.labels(self.name, 'true' if resume else 'false').inc()
+
+    def closeAction(self, error):
+        """Classify how to recover from the exception that ended a connection."""
+        if not isinstance(error, websockets.exceptions.ConnectionClosed):
+            # Missed heartbeat ACKs and failures to connect (e.g. during an outage) leave the session intact
+            return ReconnectActions.RESUME
+
+        code = error.rcvd.code if error.rcvd else ABNORMAL_CLOSE_CODE
+        if code in (NORMAL_CLOSE_CODE, GOING_AWAY_CLOSE_CODE):
+            return ReconnectActions.IDENTIFY
+
+        try:
+            closeCode = self.CLOSE_CODES(code)
+        except ValueError:
+            # Codes outside the gateway's own (e.g. 1006 abnormal closure, 1011 internal error) are transient
+            return ReconnectActions.RESUME
+
+        if not closeCode.reconnectable():
+            return ReconnectActions.STOP
+
+        return ReconnectActions.RESUME if closeCode.resumable() else ReconnectActions.IDENTIFY
+
+    def recovered(self, resumed):
+        """Record that the session is ready, after a READY or RESUMED."""
+        self._reconnect.recovered(resumed)
+
     async def _recvLoop(self, websock):
-        """Receive weboscket messages, convert them into gateway messages and pass into a processing task."""
+        """Receive weboscket messages, convert them into gateway messages and queue them for processing. Messages without a priority are processed inline."""
         while True:
-            msg = await websock.recv()
+            msg = await websock.recv(decode=False)
+            self._wireBytes.value += len(msg)
+            start = time.perf_counter()
+
+            if self._inflator:
+                # A message may span several frames, only its last frame ends with the flush marker
+                self._inflateBuffer.extend(msg)
+                if not msg.endswith(ZLIB_SUFFIX):
+                    continue
+                msg = self._inflator.decompress(self._inflateBuffer)
+                self._inflateBuffer.clear()
+
+            self._decodedBytes.value += len(msg)
+
+            # Messages nobody consumes are dropped on their header alone
+            header = self.codec.peek(msg)
+            self.received(msg, header)
+            if header and self.skipPayload(*header):
+                self._updateSequence(header[1])
+                self._decodeSeconds.value += time.perf_counter() - start
+                PAYLOADS.labels(self.name, header[2] or '', 'false').inc()
+                continue
+
             try:
-                msgObj = GatewayMessage.fromStr(msg)
-            except TypeError as e:
+                msgObj = self.codec.decode(msg)
+            except (TypeError, KeyError, ValueError) as e:
                 print(e)
             else:
-                await self.processMsg(msgObj)
+                self._decodeSeconds.value += time.perf_counter() - start
+                PAYLOADS.labels(self.name, msgObj.t or '', 'true').inc()
+                # Messages may be processed out of order, the sequence is acknowledged as soon as a message is received
+                self._updateSequence(msgObj.s)
+                priority = self.priority(msgObj)
+                if priority is None:
+                    await self.processMsg(msgObj)
+                else:
+                    await self._enqueue(priority, msgObj)
+
+    async def _enqueue(self, priority, msgObj):
+        """Queue a received message for processing, applying the queue's overflow policy when it is full."""
+        queue = self._recvQueues[priority]
+        if queue.full():
+            _, policy = self.RECV_QUEUES[priority]
+            match policy:
+                case OverflowPolicies.BLOCK:
+                    await queue.put(msgObj)
+                    self._recvQueued.release()
+                case OverflowPolicies.DROP_OLDEST:
+                    # Replaces a queued message, the number waiting is unchanged
+                    queue.get_nowait()
+                    queue.put_nowait(msgObj)
+                    self._queueDropped[priority].value += 1
+                case OverflowPolicies.DROP_NEWEST:
+                    self._queueDropped[priority].value += 1
+        else:
+            queue.put_nowait(msgObj)
+            self._recvQueued.release()
+
+        self._queueDepths[priority].value = queue.qsize()
+
+    async def _processLoop(self):
+        """Process queued messages, highest priority first and in order of receipt within a priority."""
+        while True:
+            await self._recvQueued.acquire()
+            for priority, queue in self._recvQueues.items():
+                if not queue.empty():
+                    msgObj = queue.get_nowait()
+                    self._queueDepths[priority].value = queue.qsize()
+                    break
+
+            await self.processMsg(msgObj)
+
+    async def _sendLoop(self, websock):
+        """Write queued messages to the websocket. Of messages sharing a coalesce key that queued up behind a slow write, only the latest is sent."""
+        while True:
+            batch = [await self._sendQueue.get()]
+            while not self._sendQueue.empty():
+                batch.append(self._sendQueue.get_nowait())
+            self._sendQueueDepth.value = 0
+
+            keys = [self.coalesceKey(msgObj) for msgObj in batch]
+            latest = {key: i for i, key in enumerate(keys) if key is not None}
+            for i, msgObj in enumerate(batch):
+                if keys[i] is not None and latest[keys[i]] != i:
+                    self._sendsCoalesced.value += 1
+                    continue
+                await websock.send(self.codec.encode(msgObj), text=self.codec.TEXT)
+
+    def _updateSequence(self, s):
+        """Record the latest sequence number received."""
+        if s and (self.lastSequence is None or s > self.lastSequence):
+            self.lastSequence = s
+
+    def _newQueues(self):
+        """Create empty receive and send queues."""
+        self._recvQueues = {priority: asyncio.Queue(size) for priority, (size, _) in sorted(self.RECV_QUEUES.items())}
+        self._recvQueued = asyncio.Semaphore(0)
+        self._sendQueue = asyncio.Queue()
 
     async def _heartbeatLoop(self):
-        """Send a heartbeat message every heartBeatInterval."""
+        """Send a heartbeat message every heartBeatInterval, raising HeartbeatTimeout if the previous one was not acknowledged in time."""
+        await self._receivedHello.wait()
+        # The first heartbeat is jittered so clients reconnecting together don't heartbeat in lockstep
+        await asyncio.sleep(self._heartbeatInterval * random.random())
         while True:
+            if self._heartbeatSent is not None:
+                self._missedAcks.inc()
+                raise HeartbeatTimeout(f'{self.name} heartbeat not acknowledged within {self._heartbeatInterval}s')
+
             msgObj = self.genHeartBeat()
+            self._heartbeatSent = time.monotonic()
             await self.send(msgObj)
             await asyncio.sleep(self._heartbeatInterval)
 
     async def send(self, msgObj):
-        """Send a gateway message to the websocket endpoint."""
-        await self._websock.send(str(msgObj))
+        """Queue a gateway message to be sent to the websocket endpoint."""
+        self._sendQueue.put_nowait(msgObj)
+        self._sendQueueDepth.value = self._sendQueue.qsize()
 
     def _clean(self):
         """Revert session specific properties to defaults."""
         self.lastSequence = None
         self._heartbeatInterval = 1
-        self._sendQueue = asyncio.Queue()
+        self._newQueues()
+        for priority in Priorities:
+            self._queueDepths[priority].value = 0
+        self._sendQueueDepth.value = 0
         self._tasks = None
         self._connected.clear()
         self.attempts = 0
+        self._heartbeatSent = None
+        self.latency = None
+
+    def received(self, data, header):
+        """Inspect a complete (decompressed) message and its header, if it could be peeked, before it is parsed."""
+        pass
+
+    def skipPayload(self, op, s, t):
+        """Return whether a message can be discarded without parsing its payload, given its header. Nothing is skipped by default."""
+        return False
+
+    def priority(self, msgObj):
+        """Return the receive queue priority of a message, or None to process it inline (connection control messages). Everything is queued as NORMAL by default."""
+        return Priorities.NORMAL
+
+    def coalesceKey(self, msgObj):
+        """Return a key shared by queued messages that supersede each other, or None if the message must always be sent. Nothing is coalesced by default."""
+        return None
 
     async def processMsg(self, msgObj):
         """Process incoming gateway messages. To be implemented by child class."""
@@ -0,0 +1,193 @@
+# 1st Party
+from .gateway import Gateway, CloseCodes, DEFAULT_ENCODING
+from .api import Api
+
+# 3rd Party
+from aiohttp import ClientError
+
+# Standard Library
+import asyncio
+import json
+import os
+import time
+
+# Discord allows one IDENTIFY per rate limit bucket every 5 seconds
+IDENTIFY_INTERVAL = 5
+# Snowflakes hold their creation timestamp above bit 22, which is how guilds are assigned to shards
+SHARD_ID_SHIFT = 22
+# Seconds between resets of the session start limit, when Discord doesn't say
+SESSION_START_RESET = 24 * 60 * 60
+# Seconds between saves of the session file, a resume replays whatever was received since the last save
+SESSION_SAVE_INTERVAL = 30
+
+class IdentifyBuckets():
+    """Space out IDENTIFYs so that each max_concurrency bucket identifies at most once per interval, within the budget of session starts."""
+    def __init__(self, maxConcurrency, remaining=None, total=None, resetAfter=None, interval=IDENTIFY_INTERVAL):
+        self.maxConcurrency: int = max(maxConcurrency, 1)
+        self.interval: float = interval
+        # Session starts left until the budget resets, None when the budget is unknown
+        self.remaining: int = remaining
+        self._total: int = total or remaining
+        self._resetAt: float = time.monotonic() + (resetAfter / 1000 if resetAfter is not None else SESSION_START_RESET)
+        self._locks: list = [asyncio.Lock() for _ in range(self.maxConcurrency)]
+        self._lastIdentify: list = [None] * self.maxConcurrency
+
+    async def acquire(self, shardID):
+        """Wait until the shard's bucket may identify, and until the session start budget resets if it is spent."""
+        bucket = shardID % self.maxConcurrency
+        async with self._locks[bucket]:
+            if self.remaining is not None:
+                if self.remaining <= 0 and (delay := self._resetAt - time.monotonic()) > 0:
+                    print(f'Session start limit reached, waiting {delay:.0f}s.')
+                    await asyncio.sleep(delay)
+                if time.monotonic() >= self._resetAt:
+                    self.remaining = self._total
+                    self._resetAt = time.monotonic() + SESSION_START_RESET
+                self.remaining -= 1
+
+            if self._lastIdentify[bucket] is not None:
+                delay = self._lastIdentify[bucket] + self.interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self._lastIdentify[bucket] = time.monotonic()
+
+class ShardManager():
+    """Run a gateway connection per shard behind the interface of a single Gateway, routing guild specific actions to the owning shard."""
+    def __init__(self, token, eventDispatcher, api, encoding=DEFAULT_ENCODING, hasListener=None, shardCount=None, sessionFile=None):
+        self.token: str = token
+        self.api: Api = api
+        self.encoding: str = encoding
+        # Fixed number of shards, None uses Discord's recommendation
+        self.shardCount: int = shardCount
+        self.shards: list = []
+        # File the shards' sessions are saved to, so a restarted process can resume them instead of identifying
+        self.sessionFile: str = sessionFile
+        self._eventDispatcher = eventDispatcher
+        self._hasListener = hasListener
+
+    @property
+    def userID(self):
+        return self.shards[0].userID if self.shards else None
+
+    @property
+    def applicationID(self):
+        return self.shards[0].applicationID if self.shards else None
+
+    def shardID(self, guildID):
+        """Return the ID of the shard receiving the guild's events."""
+        return (int(guildID) >> SHARD_ID_SHIFT) % len(self.shards)
+
+    def forGuild(self, guildID):
+        """Return the shard receiving the guild's events."""
+        return self.shards[self.shardID(guildID)]
+
+    def getVoiceState(self, userID):
+        """Retrieve voice state of specified user from whichever shard has seen it."""
+        for shard in self.shards:
+            guildID, channelID = shard.getVoiceState(userID)
+            if guildID:
+                return guildID, channelID
+
+        return None, None
+
+    def setVoiceState(self, userID, value):
+        """Set voice state of specified user on the shard owning its guild."""
+        self.forGuild(value[0]).setVoiceState(userID, value)
+
+    async def updateVoiceChannel(self, channelID, guildID=None, selfMute=False, selfDeaf=False):
+        """Send a voice state update through the shard owning the guild. Try to use the bot's current guild ID if one is not provided."""
+        if not guildID:
+            guildID, _ = self.getVoiceState(self.userID)
+
+        if guildID:
+            await self.forGuild(guildID).updateVoiceChannel(channelID, guildID, selfMute, selfDeaf)
+
+    async def connect(self):
+        """Start every shard, starting over with a new shard count if Discord requires more shards."""
+        while True:
+            await self._createShards()
+            tasks = [asyncio.create_task(shard.connect()) for shard in self.shards]
+            saveTask = asyncio.create_task(self._saveLoop()) if self.sessionFile else None
+            try:
+                # A shard only returns once its connection was closed for good
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                if saveTask:
+                    saveTask.cancel()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                # Shards are closed resumably when cancelled, their sessions can be picked up by the next process
+                self.saveSessions()
+
+            if not any(shard.closeCode == CloseCodes.SHARDING_REQUIRED.value for shard in self.shards):
+                break
+            print('Discord requires more shards, resharding.')
+            # A fixed count evidently no longer suffices
+            self.shardCount = None
+
+    async def disconnect(self):
+        """Save the shards' sessions and disconnect every connected shard, shards closed for good have nothing to disconnect."""
+        self.saveSessions()
+        await asyncio.gather(*(shard.disconnect() for shard in self.shards if shard.isConnected()))
+
+    async def _createShards(self):
+        """Create a gateway connection per shard, using the recommended shard count and identify concurrency."""
+        try:
+            gatewayBot = await self.api.get_gateway_bot() or {}
+        except (ClientError, TimeoutError) as e:
+            print(f'Failed to query the recommended shard count: {e!r}')
+            gatewayBot = {}
+
+        saved = self._loadSessions() if self.sessionFile else None
+        limit = gatewayBot.get('session_start_limit', {})
+        # Without a recommendation, fall back to the shard count of the saved sessions, then to a single shard
+        count = self.shardCount or gatewayBot.get('shards') or (saved or {}).get('shard_count') or 1
+
+        # Every IDENTIFY (but not RESUME) uses a session start, including those after a reconnect
+        buckets = IdentifyBuckets(limit.get('max_concurrency', 1), limit.get('remaining'), limit.get('total'), limit.get('reset_after'))
+        # A lone shard identifies without shard information, as an unsharded connection
+        self.shards = [Gateway(self.token, self._eventDispatcher, encoding=self.encoding, hasListener=self._hasListener,
+                               shard=[shardID, count] if count > 1 else None, identifyGate=buckets.acquire) for shardID in range(count)]
+
+        if self.sessionFile:
+            # Sessions belong to a shard of a specific shard count
+            if saved and saved.get('shard_count') == count:
+                for shard, state in zip(self.shards, saved['shards']):
+                    if state:
+                        shard.restoreSession(state)
+            for shard in self.shards:
+                shard.keepSession = True
+
+    def saveSessions(self):
+        """Atomically write the shards' sessions to the session file, a crash mid-write leaves the previous file intact."""
+        if not self.sessionFile or not self.shards:
+            return
+
+        state = {'shard_count': len(self.shards), 'shards': [shard.sessionState() for shard in self.shards]}
+        temporaryFile = f'{self.sessionFile}.tmp'
+        try:
+            with open(temporaryFile, 'w') as file:
+                json.dump(state, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporaryFile, self.sessionFile)
+        except OSError as e:
+            print(f'Failed to save gateway sessions: {e}')
+
+    def _loadSessions(self):
+        """Read the session file, returning None if there is none or it can't be read."""
+        try:
+            with open(self.sessionFile) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f'Failed to load gateway sessions: {e}')
+            return None
+
+    async def _saveLoop(self):
+        """Periodically save the shards' sessions, keeping the sequence number a crashed process resumes from recent."""
+        while True:
+            await asyncio.sleep(SESSION_SAVE_INTERVAL)
+            self.saveSessions()
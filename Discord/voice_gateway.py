@@ -1,20 +1,27 @@
 # 1st Party
-from .gateway_connection import GatewayConnection, GatewayMessage
+from .gateway_connection import GatewayConnection, GatewayMessage, HeartbeatTimeout, Priorities, ReconnectActions
 from .gateway import Gateway
 from Utils.events import EventHandler
-from rtp import RtpEndpoint
+from rtp import RtpEndpoint, PayloadType
+from Utils import tracing, metrics
 
 # 3rd Party
 import websockets
 
 # Standard Library
 import asyncio
+import time
 from os import urandom
 from enum import Enum
 
 DISCORD_RTP_PORT = 5003
 VOICEGATEWAY_DELAY = 0
 RECONNECT_ATTEMPTS = 2
+# Seconds a discovered address is reused for after the last traffic to its voice server, NAT mappings of idle UDP flows expire after 30s or more
+DISCOVERY_TTL = 30
+
+IP_DISCOVERIES = metrics.registry.counter('redtelephone_voice_ip_discovery_total', 'How the public address of a voice RTP endpoint was obtained: reused with the open socket, cached, or discovered.',
+                                          ('result',))
 
 class SpeakingModes(Enum):
     """Enum class of speaking modes for SPEAKING voice gateway messages."""
@@ -71,9 +78,21 @@ class CloseCodes(Enum):
             return False
         
         return True
-        
+
+    def resumable(self):
+        """Returns whether the voice session survives the specified gateway close code, a new one is negotiated through the gateway otherwise."""
+        if self in [CloseCodes.AUTHENTICATION_FAILED, CloseCodes.SESSION_NO_LONGER_VALID, CloseCodes.SESSION_TIMEOUT, CloseCodes.SERVER_NOT_FOUND]:
+            return False
+
+        return True
+
 class VoiceGateway(GatewayConnection):
     """Manage voice gateway state and handling of incoming/outgoing gateway messages."""
+    NAME = 'voice'
+    CLOSE_CODES = CloseCodes
+    # Maps a voice server's (ip, port) to when its discovered public address expires and the address itself, shared by every voice connection
+    _discoveries: dict = {}
+
     def __init__(self, gateway, serverID, channelID, eventDispatcher):
         self.gateway: Gateway = gateway
         self.serverID: str = serverID
@@ -83,50 +102,109 @@ class VoiceGateway(GatewayConnection):
         self.endpoint: str = None
         self.ssrc: int = None
         self.rtpEndpoint: RtpEndpoint = None
+        # Whether the session's secret key has been received, i.e. audio can be relayed
+        self.ready: bool = False
+        # Voice server (ip, port) the RTP endpoint sends to, the endpoint is kept open across resumes and reused while the server is unchanged
+        self._voiceServer: tuple = None
+        # Span of the call that joined the channel, the connection's events are recorded in its trace
+        self.trace: tracing.Span = tracing.current()
         super().__init__(self.token, self.endpoint)
 
     async def connect(self):
-        """Establish a voice gateway connection and attempt to reconnect on unexpected websocket close."""
+        """Establish a voice gateway connection and reconnect whenever it is lost, as paced by the reconnect scheduler."""
         while True:
             try:
                 await self._start()
-            except websockets.exceptions.ConnectionClosedOK:
-                break
-            except websockets.exceptions.ConnectionClosedError as e:                   
-                if CloseCodes(e.code).reconnectable():
-                    # Try to resume the existing voice session
-                    if self.attempts < RECONNECT_ATTEMPTS:
-                        self._stop(clean=False)
-                    # Negotiate a new voice session
-                    else:
-                        self._stop(clean=True)
-                        self.gateway.updateVoiceChannel(self.channelID, self.serverID)
-                        break
-                else:
-                    self._stop(clean=True)
-                    break
+                continue
+            except (websockets.exceptions.ConnectionClosed, websockets.exceptions.InvalidHandshake, HeartbeatTimeout, OSError, TimeoutError) as e:
+                print(f'Voice gateway connection lost: {e!r}')
+                action = self.closeAction(e)
 
-    def _stop(self, clean=True):
-        """Sever the voice gateway connection and voice RTP endpoint."""
-        if self.rtpEndpoint:
-            self.rtpEndpoint.stop()
-            self.rtpEndpoint = None
+            if action is ReconnectActions.STOP:
+                self._stop(clean=True)
+                self._closeRtpEndpoint()
+                break
+            # Negotiate a new voice session, its VOICE_SERVER_UPDATE starts a new connection
+            elif action is ReconnectActions.IDENTIFY or self.attempts >= RECONNECT_ATTEMPTS:
+                self._stop(clean=True)
+                await self.gateway.updateVoiceChannel(self.channelID, self.serverID)
+                break
+            # Try to resume the existing voice session
+            else:
+                self._stop(clean=False)
+                self._countReconnect(resume=True)
+                await self._reconnect.wait()
 
-        super()._stop(clean)
+    async def disconnect(self):
+        """Close the voice RTP endpoint and disconnect from the voice gateway, if a connection was established."""
+        self._closeRtpEndpoint()
+        if self.isConnected():
+            await super().disconnect()
 
     def _clean(self):
-        """Revert session specific properties."""
+        """Revert session specific properties. The RTP endpoint is left open, a new session on the same voice server reuses it."""
         super()._clean()
         self.endpoint = None
         self.ssrc = None
+        self.ready = False
+
+    async def _openRtpEndpoint(self, voiceServer):
+        """Open an RTP endpoint to the voice server and wait for its public address, returning how the address was obtained."""
+        # The open socket's NAT mapping is kept alive by its traffic
+        if self.rtpEndpoint and self._voiceServer == voiceServer:
+            self.rtpEndpoint.ssrc = self.ssrc
+            return 'reused'
+
+        if self.rtpEndpoint:
+            self._closeRtpEndpoint()
+            # The closed transport releases the local port on the next loop iteration
+            await asyncio.sleep(0)
+        cached = VoiceGateway._discoveries.get(voiceServer)
+        publicAddress = cached[1] if cached and cached[0] > time.monotonic() else None
+
+        loop = asyncio.get_event_loop()
+        _, endpoint = await loop.create_datagram_endpoint(
+            lambda: RtpEndpoint(ssrc=self.ssrc, encrypted=True, payloadType=PayloadType.RTP, name='discord', publicAddress=publicAddress),
+            local_addr=("0.0.0.0", DISCORD_RTP_PORT),
+            remote_addr=voiceServer
+        )
+        self.rtpEndpoint = endpoint
+        self._voiceServer = voiceServer
+
+        await self.rtpEndpoint.recvPublicIP.wait()
+        return 'cached' if publicAddress else 'discovered'
+
+    def _closeRtpEndpoint(self):
+        """Close the RTP endpoint, caching its public address while the NAT mapping is likely to outlast the socket."""
+        if not self.rtpEndpoint:
+            return
+
+        now = time.monotonic()
+        for voiceServer in [voiceServer for voiceServer, (expiresAt, _) in VoiceGateway._discoveries.items() if expiresAt <= now]:
+            del VoiceGateway._discoveries[voiceServer]
+        if self.rtpEndpoint.publicIP:
+            VoiceGateway._discoveries[self._voiceServer] = (now + DISCOVERY_TTL, (self.rtpEndpoint.publicIP, self.rtpEndpoint.publicPort))
+
+        self.rtpEndpoint.stop()
         self.rtpEndpoint = None
+        self._voiceServer = None
+
+    def priority(self, msgObj):
+        """Process HELLO and heartbeat ACKs inline, so a slow READY (IP discovery) cannot stall heartbeating. Everything else is part of establishing the call."""
+        if msgObj.op in (OpCodes.HELLO.value, OpCodes.HEARTBEAT_ACK.value):
+            return None
+
+        return Priorities.HIGH
+
+    def coalesceKey(self, msgObj):
+        """Only the latest of queued heartbeats and speaking updates is sent."""
+        if msgObj.op in (OpCodes.HEARTBEAT.value, OpCodes.SPEAKING.value):
+            return msgObj.op
+
+        return None
 
     async def processMsg(self, msgObj):
         """Process incoming gateway messages."""
-        # Update sequence number
-        if(msgObj.s):
-            self.lastSequence = msgObj.s
-
         eventName = OpCodes(msgObj.op).name
         args = []
 
@@ -136,38 +214,43 @@ class VoiceGateway(GatewayConnection):
                 if("heartbeat_interval" in msgObj.d):
                     self.setHeartbeatInterval(msgObj.d["heartbeat_interval"])
                     
-                # Identify to API
-                data = {'server_id': self.serverID, 'user_id': self.gateway.userID, 'session_id': self.gateway.sessionID, 'token': self.token}
-                identifyMsg = GatewayMessage(OpCodes.IDENTIFY.value, data)
-                await self.send(identifyMsg)
+                tracing.record('voice_hello')
+                if self.ssrc is not None:
+                    # Resume the voice session, its RTP endpoint and secret key remain valid
+                    data = {'server_id': self.serverID, 'session_id': self.gateway.sessionID, 'token': self.token, 'seq_ack': self.lastSequence}
+                    await self.send(GatewayMessage(OpCodes.RESUME.value, data))
+                else:
+                    # Identify to API
+                    data = {'server_id': self.serverID, 'user_id': self.gateway.userID, 'session_id': self.gateway.sessionID, 'token': self.token}
+                    identifyMsg = GatewayMessage(OpCodes.IDENTIFY.value, data)
+                    await self.send(identifyMsg)
 
             case OpCodes.READY:
+                self.recovered(resumed=False)
                 self.ssrc = msgObj.d['ssrc']
                 remoteIP = msgObj.d['ip']
                 remotePort = msgObj.d['port']
 
-                # Establish an RTP endpoint for voice data
-                loop = asyncio.get_event_loop()
-                _, endpoint = await loop.create_datagram_endpoint(
-                    lambda: RtpEndpoint(ssrc=self.ssrc, encrypted=True),
-                    local_addr=("0.0.0.0", DISCORD_RTP_PORT),
-                    remote_addr=(remoteIP, remotePort)
-                )
-                self.rtpEndpoint = endpoint
-            
-                await self.rtpEndpoint.recvPublicIP.wait()
-                data = {'protocol': 'udp', 'data': {'address': self.rtpEndpoint.publicIP, 'port': DISCORD_RTP_PORT, 'mode': 'aead_xchacha20_poly1305_rtpsize'}}
+                with tracing.span('ip_discovery', server=f'{remoteIP}:{remotePort}') as span:
+                    # Establish an RTP endpoint for voice data
+                    result = await self._openRtpEndpoint((remoteIP, remotePort))
+                    IP_DISCOVERIES.labels(result).inc()
+                    if span:
+                        span.attributes['result'] = result
+                data = {'protocol': 'udp', 'data': {'address': self.rtpEndpoint.publicIP, 'port': self.rtpEndpoint.publicPort, 'mode': 'aead_xchacha20_poly1305_rtpsize'}}
                 selectMsg = GatewayMessage(OpCodes.SELECT_PROTOCOL.value, data)
                 await self.send(selectMsg)
 
             case OpCodes.SESSION_DESCRIPTION:
+                tracing.record('session_description')
                 self.rtpEndpoint.setSecretKey(msgObj.d['secret_key'])
+                self.ready = True
 
-            # TODO is timer needed to verify heartbeat ack and connection still open?
             case OpCodes.HEARTBEAT_ACK:
-                pass
+                self.heartbeatAcked()
 
             case OpCodes.RESUMED:
+                self.recovered(resumed=True)
                 self.attempts = 0
 
             case _:
@@ -0,0 +1,138 @@
+# 1st Party
+from .sipMessage import SIP_VERSION, StatusCodes
+
+# Standard Library
+import time
+from enum import Enum
+
+# Limits applied to sources outside of the allow list (messages per second)
+SOURCE_RATE = 5
+SOURCE_BURST = 10
+GLOBAL_RATE = 50
+GLOBAL_BURST = 100
+# Generous limit for allow listed sources, only meant to contain a misbehaving handset
+ALLOWED_SOURCE_RATE = 100
+ALLOWED_SOURCE_BURST = 200
+# Cap on the number of 503 responses generated per second while overloaded
+REJECT_RATE = 20
+REJECT_BURST = 20
+RETRY_AFTER = 30
+MAX_TRACKED_SOURCES = 4096
+
+# Headers copied verbatim (full and compact forms) into stateless rejections
+RESPONSE_HEADERS = (b'via', b'v', b'from', b'f', b'to', b't', b'call-id', b'i', b'cseq')
+
+class Verdicts(Enum):
+    """Enum class of admission decisions."""
+    ADMIT = 0
+    DROP = 1
+    REJECT = 2
+
+class OverloadResponses(Enum):
+    """Enum class of responses to traffic exceeding the global rate limit."""
+    DROP = 'drop'
+    REJECT = '503'
+
+class TokenBucket():
+    """Token bucket refilled at 'rate' tokens per second up to 'capacity'."""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.tokens: float = capacity
+        self.updated: float = now
+
+    def take(self, now):
+        """Consume a token if one is available and return whether it succeeded."""
+        tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            return True
+
+        self.tokens = tokens
+        return False
+
+class AdmissionControl():
+    """Decide whether a raw SIP datagram is worth parsing, using only its source address and leading bytes."""
+    def __init__(self, addressFilter, sourceRate=SOURCE_RATE, globalRate=GLOBAL_RATE, overloadResponse=OverloadResponses.REJECT):
+        now = time.monotonic()
+        self.addressFilter = addressFilter
+        self.sourceRate: float = sourceRate
+        self.overloadResponse: OverloadResponses = overloadResponse
+        self._sourceBuckets: dict = {}
+        self._allowedBuckets: dict = {}
+        self._globalBucket: TokenBucket = TokenBucket(globalRate, max(globalRate * 2, GLOBAL_BURST), now)
+        self._rejectBucket: TokenBucket = TokenBucket(REJECT_RATE, REJECT_BURST, now)
+        self.counters: dict = {'admitted': 0, 'admittedAllowed': 0, 'sourceLimited': 0, 'globalLimited': 0, 'rejected': 0}
+
+    def check(self, data, addr):
+        """Return the admission verdict for a datagram received from addr."""
+        ip = addr[0]
+        now = time.monotonic()
+
+        # Allow listed sources bypass the global limit so legitimate calls keep flowing during a flood
+        if self.addressFilter.allowed(ip):
+            bucket = _getBucket(self._allowedBuckets, ip, ALLOWED_SOURCE_RATE, ALLOWED_SOURCE_BURST, now)
+            if bucket.take(now):
+                self.counters['admittedAllowed'] += 1
+                return Verdicts.ADMIT
+
+            self.counters['sourceLimited'] += 1
+            return Verdicts.DROP
+
+        bucket = _getBucket(self._sourceBuckets, ip, self.sourceRate, max(self.sourceRate * 2, SOURCE_BURST), now)
+        if not bucket.take(now):
+            self.counters['sourceLimited'] += 1
+            return Verdicts.DROP
+
+        if not self._globalBucket.take(now):
+            self.counters['globalLimited'] += 1
+            # Never respond to responses or ACKs, and bound the work spent generating rejections
+            if self.overloadResponse == OverloadResponses.REJECT and _isRejectable(data) and self._rejectBucket.take(now):
+                self.counters['rejected'] += 1
+                return Verdicts.REJECT
+
+            return Verdicts.DROP
+
+        self.counters['admitted'] += 1
+        return Verdicts.ADMIT
+
+    def buildRejection(self, data):
+        """Build a stateless '503 Service Unavailable' response from the raw request bytes, or None if the request is malformed."""
+        head, _, _ = data.partition(b'\r\n\r\n')
+        lines = head.split(b'\r\n')
+        code, reasonPhrase = StatusCodes.SERVICE_UNAVAILABLE.value
+        response = [f'{SIP_VERSION} {code} {reasonPhrase}'.encode()]
+
+        for line in lines[1:]:
+            label, sep, _ = line.partition(b':')
+            if sep and label.strip().lower() in RESPONSE_HEADERS:
+                response.append(line)
+
+        # Via, From, To, Call-ID and CSeq are all required to build a valid response
+        if len(response) < 6:
+            return None
+
+        response.append(f'Retry-After: {RETRY_AFTER}'.encode())
+        response.append(b'Content-Length: 0')
+        return b'\r\n'.join(response) + b'\r\n\r\n'
+
+    def stats(self):
+        """Return a copy of the admission counters."""
+        return dict(self.counters, trackedSources=len(self._sourceBuckets))
+
+def _getBucket(buckets, ip, rate, capacity, now):
+    """Helper method to retrieve the token bucket of a source, evicting the oldest source when the table is full."""
+    bucket = buckets.get(ip)
+    if bucket is None:
+        if len(buckets) >= MAX_TRACKED_SOURCES:
+            del buckets[next(iter(buckets))]
+        bucket = buckets[ip] = TokenBucket(rate, capacity, now)
+
+    return bucket
+
+def _isRejectable(data):
+    """Helper method to determine if a raw datagram is a request that may receive a response."""
+    return not data.startswith(b'SIP/2.0') and not data.startswith(b'ACK ')
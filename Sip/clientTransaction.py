@@ -1,5 +1,6 @@
 # 1st Party
-from .sipMessage import SipMessage, SipRequest
+from .sipMessage import SipRequest, SipResponse
+from . import sdp
 from .transaction import Transaction, States
 
 # Standard Library
@@ -30,6 +31,8 @@ class ClientTransaction(Transaction):
         
         self.branch = self._genBranch()
         self.receivedProvisional: asyncio.Event = asyncio.Event()
+        # Latest response received, None if the request was never answered
+        self.lastResponse: SipResponse = None
 
         # If included, override properties with those of an existing transaction (used for cancelling invites)
         if overrideTransaction:
@@ -48,7 +51,9 @@ class ClientTransaction(Transaction):
         if self.requestMethod != 'INVITE':
             raise ValueError('Non-Invite transaction.')
         
-        return ClientTransaction(self.notifyTU, self.sendToTransport, 'CANCEL', (self.localIP, self.localPort), (self.remoteIP, self.remotePort), dialog=None, overrideTransaction=self)
+        cancelTransaction = ClientTransaction(self.notifyTU, self.sendToTransport, 'CANCEL', (self.localIP, self.localPort), (self.remoteIP, self.remotePort), dialog=None, overrideTransaction=self)
+        cancelTransaction.fork = self.fork
+        return cancelTransaction
 
     def buildRequest(self, method):
         """Build a SIP request of the specified method."""
@@ -72,8 +77,7 @@ class ClientTransaction(Transaction):
         # Configure message body
         if method == 'INVITE':
             additionalHeaders['Content-Type'] = 'application/sdp'
-            # TODO replace magic numbers
-            body = SipMessage._buildSDP(self.localIP, 5004)
+            body = sdp.renderOffer(self.localIP, sdp.DEFAULT_MEDIA_PORT)
         else:
             body = ''
 
@@ -91,16 +95,21 @@ class ClientTransaction(Transaction):
             # Send request with exponential back-off until a response is received or transaction timeout reached.
             async with asyncio.timeout(transactionTimeout):
                 attempts = 0
+                sentTime = time.monotonic()
                 while(not response):
-                    # Send/resend request
-                    self.sendToTransport(request, (self.remoteIP, self.remotePort))
-                    retransmitInterval = (pow(2, attempts) * Transaction.T1)
+                    # Send/resend request, reliable transports handle retransmission themselves (RFC 3261 Section 17.1.1.2)
+                    reliable = self.sendToTransport(request, (self.remoteIP, self.remotePort))
+                    retransmitInterval = transactionTimeout if reliable else (pow(2, attempts) * self.t1)
                     try:
                         # Wait (up to) the retransmit interval duration for a response before re-attempting
                         async with asyncio.timeout(retransmitInterval):
                             response = await self.recvQueue.get()
                     except TimeoutError:
                         attempts += 1
+                        self._recordTimeout(attempts)
+
+                self._recordRtt(sentTime, attempts)
+                self.lastResponse = response
 
                 # Await a non-Provisional response
                 if response.statusCode.isProvisional():
@@ -109,6 +118,7 @@ class ClientTransaction(Transaction):
                     while response.statusCode.isProvisional():
                         await self.notifyTU(response)
                         response = await self.recvQueue.get()
+                    self.lastResponse = response
 
                 if response.statusCode.isSuccessful():
                     await self.notifyTU(response)
@@ -132,7 +142,7 @@ class ClientTransaction(Transaction):
     async def nonInvite(self, method):
         """Manage a SIP non-invite request."""
         # Ensure dialog established for Non-Cancel requests
-        if not self.dialog and method != 'Cancel':
+        if not self.dialog and method != 'CANCEL':
             raise ValueError('Missing dialog.')
 
         self.state = States.TRYING
@@ -144,21 +154,26 @@ class ClientTransaction(Transaction):
             # Send request with exponential back-off until a final response is received or transaction timeout reached.
             async with asyncio.timeout(transactionTimeout):
                 attempts = 0
+                sentTime = time.monotonic()
                 while(not response or response.statusCode.isProvisional()):
-                    # Send/resend request
-                    self.sendToTransport(request, (self.remoteIP, self.remotePort))
+                    # Send/resend request, reliable transports handle retransmission themselves (RFC 3261 Section 17.1.2.2)
+                    reliable = self.sendToTransport(request, (self.remoteIP, self.remotePort))
                     # Cap retransmit interval at T2
-                    retransmitInterval = (pow(2, attempts) * Transaction.T1)
-                    retransmitInterval = min(Transaction.T2, retransmitInterval)
+                    retransmitInterval = (pow(2, attempts) * self.t1)
+                    retransmitInterval = transactionTimeout if reliable else min(Transaction.T2, retransmitInterval)
                     try:
                         # Wait (up to) the retransmit interval duration for a final response before re-attempting
                         async with asyncio.timeout(retransmitInterval):
+                            firstResponse = response is None
                             response = await self.recvQueue.get()
+                            if firstResponse:
+                                self._recordRtt(sentTime, attempts)
                             if response.statusCode.isProvisional():
                                 self.state = States.PROCEEDING
                                 await self.notifyTU(response)
                     except TimeoutError:
                         attempts += 1
+                        self._recordTimeout(attempts)
 
                 if response.statusCode.isFinal():
                     self.state = States.COMPLETED
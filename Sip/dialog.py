@@ -1,3 +1,6 @@
+# 1st Party
+from Utils import metrics
+
 class Dialog():
     """Maintains the state of a SIP dialog across multiple transactions."""
     _dialogs: dict = {}
@@ -13,6 +16,8 @@ class Dialog():
         self.remoteURI: str = remoteURI
         self.remoteTarget: str = remoteTarget
         self.secure: bool = False
+        # Negotiated media of the session, set once the offer/answer exchange completes
+        self.media = None
         #self.routeSet = routeSet
 
         # Register new Dialog
@@ -30,4 +35,6 @@ class Dialog():
     @staticmethod
     def getDialog(id):
         """Returns a dialog with matching ID from dialogs list or None if one does not exist."""
-        return Dialog._dialogs.get(id, None)
\ No newline at end of file
+        return Dialog._dialogs.get(id, None)
+
+metrics.registry.gauge('redtelephone_sip_dialogs', 'Live SIP dialogs.', function=lambda: len(Dialog._dialogs))
@@ -0,0 +1,89 @@
+# Standard Library
+import re
+import time
+import hashlib
+import secrets
+from functools import lru_cache
+
+NONCE_LIFETIME = 300
+MAX_NONCES = 1024
+AUTH_PARAM_PATTERN = re.compile(r'(\w+)\s*=\s*(?:"([^"]*)"|([^\s,]+))')
+
+class DigestAuthenticator():
+    """Verify SIP digest credentials (RFC 3261 Section 22.4) against HA1 values precomputed at startup."""
+    def __init__(self, accounts, realm):
+        self.realm: str = realm
+        # HA1 = MD5(username:realm:password) never changes, so only the final response hash is computed per request
+        self._ha1: dict = {username: _md5(f'{username}:{realm}:{password}') for username, password in accounts.items()}
+        # Maps issued nonces to their expiry time and the highest nonce count seen
+        self._nonces: dict = {}
+
+    def challenge(self, stale=False):
+        """Issue a new nonce and return the value of a WWW-Authenticate header."""
+        now = time.monotonic()
+        if len(self._nonces) >= MAX_NONCES:
+            self.sweep(now)
+            # Evict the oldest nonces if all of them are still valid
+            while len(self._nonces) >= MAX_NONCES:
+                del self._nonces[next(iter(self._nonces))]
+
+        nonce = secrets.token_hex(16)
+        self._nonces[nonce] = [now + NONCE_LIFETIME, 0]
+        return f'Digest realm="{self.realm}", nonce="{nonce}", algorithm=MD5, qop="auth"' + (', stale=true' if stale else '')
+
+    def verify(self, method, authorization):
+        """Return the authenticated username and whether the nonce was stale, from the value of an Authorization header."""
+        if not authorization or not authorization.startswith('Digest '):
+            return None, False
+
+        params = {key.lower(): quoted or unquoted for key, quoted, unquoted in AUTH_PARAM_PATTERN.findall(authorization[7:])}
+        username = params.get('username')
+        nonce = params.get('nonce')
+        ha1 = self._ha1.get(username)
+        if ha1 is None or params.get('realm') != self.realm or 'uri' not in params or 'response' not in params:
+            return None, False
+
+        # Unknown or expired nonces are stale, prompting the client to retry with a fresh challenge
+        entry = self._nonces.get(nonce)
+        if entry is None or entry[0] < time.monotonic():
+            return None, True
+
+        ha2 = _ha2(method, params['uri'])
+        qop = params.get('qop')
+        if qop == 'auth':
+            try:
+                nonceCount = int(params.get('nc', ''), 16)
+            except ValueError:
+                return None, False
+            # Reject replayed nonce counts
+            if nonceCount <= entry[1]:
+                return None, True
+
+            expected = _md5(f'{ha1}:{nonce}:{params["nc"]}:{params.get("cnonce", "")}:{qop}:{ha2}')
+        elif qop is None:
+            nonceCount = entry[1]
+            expected = _md5(f'{ha1}:{nonce}:{ha2}')
+        else:
+            return None, False
+
+        # Compared as bytes, comparing strings raises TypeError on non-ASCII input
+        if not secrets.compare_digest(expected.encode(), params['response'].encode()):
+            return None, False
+
+        entry[1] = nonceCount
+        return username, False
+
+    def sweep(self, now=None):
+        """Remove expired nonces from the nonce cache."""
+        now = now or time.monotonic()
+        for nonce in [nonce for nonce, (expiresAt, _) in self._nonces.items() if expiresAt < now]:
+            del self._nonces[nonce]
+
+@lru_cache(maxsize=256)
+def _ha2(method, uri):
+    """Helper method to calculate HA2, which is identical for every request from a client with the same method and URI."""
+    return _md5(f'{method}:{uri}')
+
+def _md5(value):
+    """Helper method to return the hex encoded MD5 digest of a string."""
+    return hashlib.md5(value.encode()).hexdigest()
@@ -0,0 +1,64 @@
+# Standard Library
+import time
+from collections import deque
+from statistics import median
+
+ANSWER_TIME_SAMPLES = 50
+
+class Outcomes():
+    """Possible outcomes of a single forked INVITE."""
+    WON = 'won'
+    LOST = 'lost'
+    CANCELLED = 'cancelled'
+    FAILED = 'failed'
+
+class Fork():
+    """Track a group of parallel INVITE client transactions, where the first to be answered wins."""
+    def __init__(self, transactions):
+        self.transactions: list = transactions
+        self.winner = None
+        self.dialog = None
+        self.cancelled: bool = False
+        self.startTime: float = time.monotonic()
+
+        for transaction in self.transactions:
+            transaction.fork = self
+
+    def answer(self, transaction, dialog):
+        """Record a 2xx response, returning whether the transaction won the fork."""
+        if self.winner or self.cancelled:
+            return False
+
+        self.winner = transaction
+        self.dialog = dialog
+        return True
+
+    def elapsed(self):
+        """Return the time since the INVITEs were sent."""
+        return time.monotonic() - self.startTime
+
+class ForkStats():
+    """Maintain per-target answer statistics across forked calls."""
+    def __init__(self):
+        self._targets: dict = {}
+
+    def record(self, target, outcome, answerTime=None):
+        """Record the outcome of a forked INVITE to the target, and its answer time if it was answered."""
+        ip, port = target
+        targetStats = self._targets.setdefault(f'{ip}:{port}', {Outcomes.WON: 0, Outcomes.LOST: 0, Outcomes.CANCELLED: 0, Outcomes.FAILED: 0,
+                                                                 'answerTimes': deque(maxlen=ANSWER_TIME_SAMPLES)})
+        targetStats[outcome] += 1
+        if answerTime is not None:
+            targetStats['answerTimes'].append(answerTime)
+
+    def stats(self):
+        """Return outcome counts and answer times (seconds) of each target."""
+        result = {}
+        for target, targetStats in self._targets.items():
+            answerTimes = targetStats['answerTimes']
+            result[target] = {Outcomes.WON: targetStats[Outcomes.WON], Outcomes.LOST: targetStats[Outcomes.LOST],
+                              Outcomes.CANCELLED: targetStats[Outcomes.CANCELLED], Outcomes.FAILED: targetStats[Outcomes.FAILED],
+                              'lastAnswerTime': answerTimes[-1] if answerTimes else None,
+                              'medianAnswerTime': median(answerTimes) if answerTimes else None}
+
+        return result
@@ -0,0 +1,95 @@
+# 1st Party
+from .sipMessage import SIP_DEFAULT_PORT
+from Utils.dnsResolver import DnsResolver, DnsError, RecordTypes
+
+# Standard Library
+import asyncio
+import random
+from ipaddress import ip_address
+
+# NAPTR services and SRV prefixes of the transports supported by the SIP transport
+NAPTR_SERVICES = {'SIP+D2U': 'udp', 'SIP+D2T': 'tcp'}
+SRV_PREFIXES = {'udp': '_sip._udp.', 'tcp': '_sip._tcp.'}
+DEFAULT_TRANSPORT = 'udp'
+
+class SipLocator():
+    """Locate the servers of a SIP URI host through NAPTR, SRV and A lookups (RFC 3263 Section 4)."""
+    def __init__(self, resolver=None, transport=DEFAULT_TRANSPORT):
+        self.resolver: DnsResolver = resolver or DnsResolver()
+        # Transport requests are sent over, only its NAPTR services and SRV records are used
+        self.transport: str = transport if transport in SRV_PREFIXES else DEFAULT_TRANSPORT
+
+    async def locate(self, host, port=None):
+        """Return the (address, port) targets of a host in the order they should be tried."""
+        # Numeric hosts and explicit ports skip NAPTR and SRV lookups
+        if _isAddress(host):
+            return [(host, port or SIP_DEFAULT_PORT)]
+        elif port:
+            return [(address, port) for address in await self._addresses(host)]
+
+        srvName = await self._lookupNaptr(host) or SRV_PREFIXES[self.transport] + host
+        srvRecords = await self._records(srvName, RecordTypes.SRV)
+        if not srvRecords:
+            return [(address, SIP_DEFAULT_PORT) for address in await self._addresses(host)]
+
+        # A target of "." indicates the service is unavailable at this domain
+        srvRecords = [srv for srv in _orderSrv(srvRecords) if srv.target not in ('', '.')]
+        results = await asyncio.gather(*[self._addresses(srv.target) for srv in srvRecords], return_exceptions=True)
+        targets = []
+        for srv, addresses in zip(srvRecords, results):
+            if not isinstance(addresses, Exception):
+                targets.extend((address, srv.port) for address in addresses)
+
+        return list(dict.fromkeys(targets))
+
+    async def _lookupNaptr(self, host):
+        """Return the SRV name of the most preferred NAPTR record for the locator's transport, or None if there is none."""
+        records = await self._records(host, RecordTypes.NAPTR)
+        for naptr in sorted(records, key=lambda naptr: (naptr.order, naptr.preference)):
+            if naptr.flags == 's' and NAPTR_SERVICES.get(naptr.service) == self.transport:
+                return naptr.replacement
+
+        return None
+
+    async def _records(self, name, recordType):
+        """Return the data of every record of the specified type, or an empty list if the query fails."""
+        try:
+            answer = await self.resolver.query(name, recordType)
+        except DnsError:
+            return []
+
+        return [record.data for record in answer.records]
+
+    async def _addresses(self, host):
+        """Return the IPv4 addresses of a host (the SIP transport is bound to IPv4)."""
+        addresses = await self._records(host, RecordTypes.A)
+        if not addresses:
+            raise DnsError(f'Failed to resolve {host}.')
+
+        return addresses
+
+def _orderSrv(records):
+    """Helper method to order SRV records by ascending priority, and within a priority by weighted random selection (RFC 2782)."""
+    ordered = []
+    for priority in sorted({srv.priority for srv in records}):
+        group = [srv for srv in records if srv.priority == priority]
+        while group:
+            total = sum(srv.weight for srv in group)
+            threshold = random.uniform(0, total)
+            runningTotal = 0
+            for i, srv in enumerate(group):
+                runningTotal += srv.weight
+                if runningTotal >= threshold:
+                    break
+
+            ordered.append(group.pop(i))
+
+    return ordered
+
+def _isAddress(host):
+    """Helper method to return whether a host is a numeric IP address."""
+    try:
+        ip_address(host.strip('[]'))
+        return True
+    except ValueError:
+        return False
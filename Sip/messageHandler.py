@@ -2,18 +2,23 @@
 from .sipMessage import SipMessage
 from .transaction import Transaction
 from .userAgent import UserAgent
+from .statelessResponder import StatelessResponder
 
 # Standard Library
 import asyncio
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 @dataclass
 class MessageHandler:
     """Interface between the transport layer and transactions/user agent."""
     userAgent: UserAgent
+    statelessResponder: StatelessResponder = field(init=False)
 
-    async def route(self, msgObj, addr):
-        """Route incoming Sip messages to matching transaction or User Agent if no match found"""
+    def __post_init__(self):
+        self.statelessResponder = StatelessResponder(lambda msgObj, addr: self.userAgent.transport.send(msgObj, addr))
+
+    def route(self, msgObj, addr):
+        """Route incoming Sip messages to matching transaction, the stateless responder, or User Agent if neither apply."""
         if not isinstance(msgObj, SipMessage):
             raise ValueError
         
@@ -21,6 +26,7 @@ class MessageHandler:
         transaction = Transaction.getTransaction(transactionID)
 
         if transaction:
-            await transaction.recvQueue.put(msgObj)
-        else:
+            transaction.recvQueue.put_nowait(msgObj)
+        # Only spawn a transaction for messages the stateless responder cannot handle
+        elif not self.statelessResponder.handle(msgObj):
             asyncio.create_task(self.userAgent.createTransaction(msgObj))
\ No newline at end of file
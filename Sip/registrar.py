@@ -0,0 +1,142 @@
+# 1st Party
+from .sipMessage import StatusCodes, parseURI
+from .digest import DigestAuthenticator
+
+# Standard Library
+import asyncio
+import re
+import time
+import heapq
+from dataclasses import dataclass
+from collections.abc import Callable
+
+DEFAULT_REALM = 'redtelephone'
+DEFAULT_EXPIRES = 3600
+MIN_EXPIRES = 60
+MAX_EXPIRES = 7200
+SWEEP_INTERVAL = 30
+CONTACT_PATTERN = re.compile(r'\s*(<[^>]*>|[^;,]+)([^,]*)')
+EXPIRES_PATTERN = re.compile(r';\s*expires\s*=\s*([0-9]+)', re.IGNORECASE)
+
+@dataclass
+class Binding:
+    """Data class representing a registered contact of an address-of-record."""
+    contact: str
+    address: tuple
+    expiresAt: float
+    # Stream connection the registration arrived on, its address is only reachable while it stays open
+    connection: object = None
+
+class Registrar():
+    """Handle REGISTER requests and maintain an in-memory location service keyed by address-of-record (the user part of the To URI)."""
+    def __init__(self, accounts, realm=DEFAULT_REALM, onChange=None):
+        self.authenticator: DigestAuthenticator = DigestAuthenticator(accounts, realm)
+        self.enabled: bool = bool(accounts)
+        self.onChange: Callable = onChange
+        # Maps each address-of-record to a dict of contact URI -> binding
+        self._locations: dict = {}
+        # Min-heap of (expiresAt, aor, contact) used by the sweeper
+        self._expiries: list = []
+
+    async def run(self):
+        """Sweep expired bindings and nonces every SWEEP_INTERVAL seconds."""
+        while self.enabled:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            self.sweep()
+
+    def register(self, request):
+        """Authenticate a REGISTER request and update its bindings. Returns the response status code and additional headers."""
+        if not self.enabled:
+            return StatusCodes.FORBIDDEN, {}
+
+        username, stale = self.authenticator.verify('REGISTER', request.additionalHeaders.get('Authorization'))
+        aor, _, _, _ = parseURI(request.toURI)
+        if username is None:
+            return StatusCodes.UNAUTHORIZED, {'WWW-Authenticate': self.authenticator.challenge(stale)}
+        # Credentials only allow registering the account's own address-of-record
+        elif aor != username:
+            return StatusCodes.FORBIDDEN, {}
+
+        now = time.monotonic()
+        defaultExpires = _parseInt(request.additionalHeaders.get('Expires'), DEFAULT_EXPIRES)
+        contactHeader = request.additionalHeaders.get('Contact', '').strip()
+        changed = False
+
+        # Remove all bindings
+        if contactHeader == '*':
+            if defaultExpires != 0:
+                return StatusCodes.BAD_REQUEST, {}
+            changed = bool(self._locations.pop(aor, None))
+
+        elif contactHeader:
+            bindings = self._locations.setdefault(aor, {})
+            for contact, params in CONTACT_PATTERN.findall(contactHeader):
+                match = EXPIRES_PATTERN.search(params)
+                expires = int(match.group(1)) if match else defaultExpires
+                if expires == 0:
+                    changed |= bindings.pop(contact, None) is not None
+                    continue
+                elif expires < MIN_EXPIRES:
+                    return StatusCodes.INTERVAL_TOO_BRIEF, {'Min-Expires': MIN_EXPIRES}
+
+                expires = min(expires, MAX_EXPIRES)
+                # Prefer the source address over the contact host so handsets behind NAT remain reachable
+                _, host, port, _ = parseURI(contact)
+                address = request.sourceAddress or (host, port or request.viaAddress[1])
+                # Over a stream the source port is ephemeral, requests reach the handset over its connection which is kept open for the registration
+                if request.connection:
+                    request.connection.bind(now + expires)
+                if contact not in bindings or bindings[contact].address != address:
+                    changed = True
+                bindings[contact] = Binding(contact, address, now + expires, request.connection)
+                heapq.heappush(self._expiries, (now + expires, aor, contact))
+
+            if not bindings:
+                del self._locations[aor]
+
+        if changed and self.onChange:
+            self.onChange()
+
+        # Respond with the current bindings of the address-of-record
+        bindings = self._locations.get(aor, {}).values()
+        headers = {'Contact': ', '.join(f'{binding.contact};expires={int(binding.expiresAt - now)}' for binding in bindings)} if bindings else {}
+        return StatusCodes.OK, headers
+
+    def lookup(self, aor):
+        """Return the addresses of every unexpired and reachable contact registered to the address-of-record."""
+        bindings = self._locations.get(aor)
+        if not bindings:
+            return []
+
+        now = time.monotonic()
+        return [binding.address for binding in bindings.values() if binding.expiresAt > now and not (binding.connection and binding.connection.closed)]
+
+    def addresses(self):
+        """Return the IPs of every registered contact."""
+        return {binding.address[0] for bindings in self._locations.values() for binding in bindings.values()}
+
+    def sweep(self):
+        """Remove bindings whose registration has expired."""
+        now = time.monotonic()
+        changed = False
+        while self._expiries and self._expiries[0][0] <= now:
+            expiresAt, aor, contact = heapq.heappop(self._expiries)
+            bindings = self._locations.get(aor, {})
+            # Ignore heap entries superseded by a refreshed registration
+            binding = bindings.get(contact)
+            if binding and binding.expiresAt <= now:
+                del bindings[contact]
+                changed = True
+                if not bindings:
+                    del self._locations[aor]
+
+        self.authenticator.sweep(now)
+        if changed and self.onChange:
+            self.onChange()
+
+def _parseInt(value, default):
+    """Helper method to parse an integer header value, returning the default if it is missing or malformed."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,70 @@
+DEFAULT_T1 = 0.5
+# Bounds on the learned retransmission interval
+MIN_T1 = 0.05
+MAX_T1 = 2.0
+# Smoothing factors and variance multiplier from RFC 6298 Section 2
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+MAX_PEERS = 1024
+
+class PeerRtt():
+    """Smoothed round trip time estimate of a single remote peer."""
+    __slots__ = ('srtt', 'rttvar', 'rto', 'samples')
+
+    def __init__(self):
+        self.srtt: float = None
+        self.rttvar: float = None
+        self.rto: float = DEFAULT_T1
+        self.samples: int = 0
+
+    def update(self, rtt):
+        """Fold a new round trip time sample into the estimate."""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+
+        self.rto = _clamp(self.srtt + K * self.rttvar)
+        self.samples += 1
+
+    def backoff(self):
+        """Double the retransmission interval after a timeout, discarding an estimate that proved too optimistic."""
+        self.rto = _clamp(self.rto * 2)
+
+class RttEstimator():
+    """Track request/response round trip times per remote peer and derive a retransmission T1 from them."""
+    def __init__(self):
+        self._peers: dict = {}
+
+    def getT1(self, peer):
+        """Return the retransmission T1 for the peer, or the RFC 3261 default if it has not been measured."""
+        peerRtt = self._peers.get(peer)
+        return peerRtt.rto if peerRtt else DEFAULT_T1
+
+    def sample(self, peer, rtt):
+        """Record a round trip time measured from a request that was not retransmitted (Karn's algorithm)."""
+        peerRtt = self._peers.get(peer)
+        if peerRtt is None:
+            if len(self._peers) >= MAX_PEERS:
+                del self._peers[next(iter(self._peers))]
+            peerRtt = self._peers[peer] = PeerRtt()
+
+        peerRtt.update(rtt)
+
+    def backoff(self, peer):
+        """Record a retransmission timeout for the peer."""
+        peerRtt = self._peers.get(peer)
+        if peerRtt:
+            peerRtt.backoff()
+
+    def stats(self):
+        """Return the learned timers of each peer."""
+        return {f'{ip}:{port}': {'srtt': peerRtt.srtt, 'rttvar': peerRtt.rttvar, 't1': peerRtt.rto, 'samples': peerRtt.samples}
+                for (ip, port), peerRtt in self._peers.items()}
+
+def _clamp(t1):
+    """Helper method to restrict T1 to safe bounds."""
+    return min(max(t1, MIN_T1), MAX_T1)
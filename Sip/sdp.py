@@ -0,0 +1,202 @@
+# Standard Library
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+DEFAULT_MEDIA_PORT = 5004
+DEFAULT_PTIME = 20
+DIRECTIONS = ('sendrecv', 'sendonly', 'recvonly', 'inactive')
+
+class SdpError(Exception):
+    """Indicates a session description could not be parsed or negotiated."""
+    pass
+
+@dataclass(frozen=True)
+class Codec:
+    """Data class representing an RTP payload format."""
+    name: str
+    clockRate: int
+    channels: int = 1
+
+    def __str__(self):
+        return f'{self.name}/{self.clockRate}' + (f'/{self.channels}' if self.channels > 1 else '')
+
+OPUS = Codec('opus', 48000, 2)
+TELEPHONE_EVENT = Codec('telephone-event', 8000)
+TELEPHONE_EVENT_WIDEBAND = Codec('telephone-event', 48000)
+
+# Payload types offered by the relay, in order of preference. Discord only carries Opus, so audio is never transcoded.
+OFFERED_PAYLOAD_TYPES = {120: OPUS, 101: TELEPHONE_EVENT_WIDEBAND, 100: TELEPHONE_EVENT}
+OFFERED_FMTPS = {120: 'minptime=10;useinbandfec=1', 101: '0-16', 100: '0-16'}
+SUPPORTED_CODECS = (OPUS,)
+SUPPORTED_EVENT_CODECS = (TELEPHONE_EVENT_WIDEBAND, TELEPHONE_EVENT)
+# Static payload types (RFC 3551) may be offered without an rtpmap attribute
+STATIC_PAYLOAD_TYPES = {0: Codec('pcmu', 8000), 3: Codec('gsm', 8000), 8: Codec('pcma', 8000), 9: Codec('g722', 8000), 18: Codec('g729', 8000)}
+
+# Templates compiled once, only the per-call values are substituted when rendering
+SESSION_TEMPLATE = 'v=0\r\no=Hotline {sessionID} {sessionVersion} IN {addressType} {address}\r\ns=SIP Call\r\nc=IN {addressType} {address}\r\nt=0 0\r\n'
+MEDIA_TEMPLATE = 'm=audio {port} RTP/AVP {formats}\r\n{attributes}a=ptime:{ptime}\r\na=sendrecv\r\n'
+
+@dataclass
+class MediaDescription:
+    """Data class representing an SDP media description and its attributes."""
+    media: str
+    port: int
+    protocol: str
+    formats: list
+    connection: str = None
+    rtcpPort: int = None
+    ptime: int = None
+    direction: str = None
+    rtpmaps: dict = field(default_factory=dict)
+    fmtps: dict = field(default_factory=dict)
+
+    def getCodec(self, payloadType):
+        """Return the codec of a payload type from its rtpmap attribute, or its static assignment."""
+        return self.rtpmaps.get(payloadType) or STATIC_PAYLOAD_TYPES.get(payloadType)
+
+@dataclass
+class SessionDescription:
+    """Data class representing an SDP session description."""
+    origin: str = None
+    connection: str = None
+    direction: str = None
+    media: list = field(default_factory=list)
+
+    def getAudio(self):
+        """Return the first enabled audio media description, or None if there is none."""
+        return next((m for m in self.media if m.media == 'audio' and m.port != 0), None)
+
+@dataclass
+class NegotiatedMedia:
+    """Data class representing the outcome of an offer/answer exchange, describing where and how to send media."""
+    address: str
+    rtpPort: int
+    rtcpPort: int
+    payloadType: int
+    codec: Codec
+    fmtp: str = None
+    dtmfPayloadType: int = None
+    dtmfCodec: Codec = None
+    ptime: int = DEFAULT_PTIME
+    direction: str = 'sendrecv'
+
+def parse(body):
+    """Parse every session and media level line of an SDP body in a single pass."""
+    session = SessionDescription()
+    media = None
+
+    for line in body.splitlines():
+        if len(line) < 3 or line[1] != '=':
+            continue
+
+        kind, value = line[0], line[2:].strip()
+        match kind:
+            case 'o':
+                session.origin = value
+            case 'c':
+                # c=<nettype> <addrtype> <address>[/ttl]
+                parts = value.split()
+                if len(parts) != 3:
+                    raise SdpError('Invalid connection line.')
+                address = parts[2].split('/', 1)[0]
+                if media:
+                    media.connection = address
+                else:
+                    session.connection = address
+            case 'm':
+                # m=<media> <port>[/<count>] <proto> <fmt> ...
+                parts = value.split()
+                if len(parts) < 4:
+                    raise SdpError('Invalid media line.')
+                media = MediaDescription(parts[0], int(parts[1].split('/', 1)[0]), parts[2], [int(f) for f in parts[3:] if f.isdigit()])
+                session.media.append(media)
+            case 'a':
+                _parseAttribute(session, media, value)
+            case _:
+                pass
+
+    return session
+
+def _parseAttribute(session, media, value):
+    """Helper method to apply an SDP attribute to the current media description (or the session if none)."""
+    name, _, attrValue = value.partition(':')
+    if name in DIRECTIONS:
+        if media:
+            media.direction = name
+        else:
+            session.direction = name
+        return
+    # The remaining attributes are only meaningful at media level
+    elif media is None:
+        return
+
+    try:
+        match name:
+            case 'rtpmap':
+                payloadType, encoding = attrValue.split(' ', 1)
+                encodingName, clockRate, *channels = encoding.strip().split('/')
+                media.rtpmaps[int(payloadType)] = Codec(encodingName.lower(), int(clockRate), int(channels[0]) if channels else 1)
+            case 'fmtp':
+                payloadType, params = attrValue.split(' ', 1)
+                media.fmtps[int(payloadType)] = params.strip()
+            case 'ptime':
+                media.ptime = int(float(attrValue))
+            case 'rtcp':
+                media.rtcpPort = int(attrValue.split()[0])
+            case _:
+                pass
+    except ValueError:
+        raise SdpError(f'Invalid {name} attribute.')
+
+def negotiate(description, supportedCodecs=SUPPORTED_CODECS):
+    """Select the first mutually supported audio codec (and telephone-event payload type) in the remote party's order of preference."""
+    audio = description.getAudio()
+    if not audio:
+        raise SdpError('No audio media offered.')
+
+    payloadType = next((pt for pt in audio.formats if audio.getCodec(pt) in supportedCodecs), None)
+    if payloadType is None:
+        raise SdpError('No supported codec offered.')
+
+    dtmfPayloadType = next((pt for pt in audio.formats if audio.getCodec(pt) in SUPPORTED_EVENT_CODECS), None)
+    address = audio.connection or description.connection
+    if not address:
+        raise SdpError('Missing connection address.')
+
+    return NegotiatedMedia(address, audio.port, audio.rtcpPort or audio.port + 1, payloadType, audio.getCodec(payloadType), audio.fmtps.get(payloadType),
+                           dtmfPayloadType, audio.getCodec(dtmfPayloadType), audio.ptime or DEFAULT_PTIME, audio.direction or description.direction or 'sendrecv')
+
+def renderOffer(address, port):
+    """Render the relay's SDP offer."""
+    return _renderSession(address) + MEDIA_TEMPLATE.format(port=port, **_offerMedia())
+
+def renderAnswer(address, port, negotiated):
+    """Render an SDP answer accepting the negotiated codec and telephone-event payload types."""
+    return _renderSession(address) + MEDIA_TEMPLATE.format(port=port, **_answerMedia(negotiated.payloadType, negotiated.codec, negotiated.fmtp,
+                                                                                     negotiated.dtmfPayloadType, negotiated.dtmfCodec, negotiated.ptime))
+
+def _renderSession(address):
+    """Helper method to render the session level lines."""
+    # RFC 4566 recommends timestamps for session ID and version (Section 5.2)
+    sessionID = int(time.time())
+    addressType = 'IP6' if ':' in address else 'IP4'
+    return SESSION_TEMPLATE.format(sessionID=sessionID, sessionVersion=sessionID, addressType=addressType, address=address)
+
+@lru_cache(maxsize=1)
+def _offerMedia():
+    """Helper method to build the media formats and attributes of the offer (constant, so built once)."""
+    attributes = ''.join(f'a=rtpmap:{pt} {codec}\r\n' + (f'a=fmtp:{pt} {OFFERED_FMTPS[pt]}\r\n' if pt in OFFERED_FMTPS else '')
+                         for pt, codec in OFFERED_PAYLOAD_TYPES.items())
+    return {'formats': ' '.join(str(pt) for pt in OFFERED_PAYLOAD_TYPES), 'attributes': attributes, 'ptime': DEFAULT_PTIME}
+
+@lru_cache(maxsize=32)
+def _answerMedia(payloadType, codec, fmtp, dtmfPayloadType, dtmfCodec, ptime):
+    """Helper method to build the media formats and attributes of an answer, cached per negotiated outcome."""
+    formats = str(payloadType)
+    attributes = f'a=rtpmap:{payloadType} {codec}\r\n' + (f'a=fmtp:{payloadType} {fmtp}\r\n' if fmtp else '')
+    if dtmfPayloadType is not None:
+        formats += f' {dtmfPayloadType}'
+        attributes += f'a=rtpmap:{dtmfPayloadType} {dtmfCodec}\r\na=fmtp:{dtmfPayloadType} 0-16\r\n'
+
+    return {'formats': formats, 'attributes': attributes, 'ptime': ptime}
@@ -1,9 +1,10 @@
 # 1st Party
-from .sipMessage import SipMessage, SipRequest, SipResponse, StatusCodes
+from .sipMessage import SipRequest, SipResponse, StatusCodes
 from .transaction import Transaction, States
 
 # Standard Library
 import asyncio
+import time
 
 class ServerTransaction(Transaction):
     """Manage the state of a SIP response across many independent messages."""
@@ -22,13 +23,15 @@ class ServerTransaction(Transaction):
         self.fromTag = request.fromParams['tag']
         self.sequence = request.seqNum
         self.request: SipRequest = request
+        # Set when a CANCEL for the request arrives, ending the transaction user's wait for an answer
+        self.cancelled: asyncio.Event = asyncio.Event()
         
         # Register new transaction
         self.id = self.branch + self.remoteIP + str(self.remotePort) + self.requestMethod
         Transaction._transactions[self.id] = self
 
-    def buildResponse(self, statusCode):
-        """Build a SIP response of the specified status code."""
+    def buildResponse(self, statusCode, headers=None, body=''):
+        """Build a SIP response of the specified status code. Optional headers are added to (or override) the defaults, an optional body is sent as SDP."""
         # Configure mandatory headers
         viaAddress = (self.remoteIP, self.remotePort)
         fromURI = f'<sip:IPCall@{self.remoteIP}:{self.remotePort}>'
@@ -44,16 +47,15 @@ class ServerTransaction(Transaction):
             
         # Configure non-mandatory headers
         additionalHeaders = {'Contact': toURI}
+        if headers:
+            additionalHeaders.update(headers)
 
         # Configure message body
-        if self.request.method == 'INVITE' and statusCode == StatusCodes.OK:
+        if body:
             additionalHeaders['Content-Type'] = 'application/sdp'
-            # TODO replace magic numbers
-            body = SipMessage._buildSDP(self.localIP, 5004)
-        else:
-            body = ''
-            
-        return SipResponse(self.request.method, viaAddress, viaParams, fromURI, fromParams, toURI, toParams, self.callID, self.sequence, body, additionalHeaders, statusCode)
+
+        return SipResponse(self.request.method, viaAddress, viaParams, fromURI, fromParams, toURI, toParams, self.callID, self.sequence, body, additionalHeaders, statusCode,
+                           viaTransport=self.request.viaTransport, connection=self.request.connection)
 
     async def invite(self):
         """Manage response to an Invite Sip request."""
@@ -81,19 +83,22 @@ class ServerTransaction(Transaction):
                 async with asyncio.timeout(transactionTimeout):
                     msg = None
                     attempts = 0
+                    sentTime = time.monotonic()
                     while not isinstance(msg, SipRequest) or msg.method != 'ACK':
-                        # Send/resend response
-                        self.sendToTransport(response, (self.remoteIP, self.remotePort))
+                        # Send/resend response, reliable transports handle retransmission themselves (RFC 3261 Section 17.2.1)
+                        reliable = self.sendToTransport(response, (self.remoteIP, self.remotePort))
                         # Cap retransmit interval at T2
-                        retransmitInterval = (pow(2, attempts) * Transaction.T1)
-                        retransmitInterval = min(Transaction.T2, retransmitInterval)
+                        retransmitInterval = (pow(2, attempts) * self.t1)
+                        retransmitInterval = transactionTimeout if reliable else min(Transaction.T2, retransmitInterval)
                         try:
-                            # Wait (up to) the retransmit interval duration for an ACK before re-attempting
+                            # Wait (up to) the retransmit interval duration for an ACK before re-attempting, resending immediately on request retransmission
                             async with asyncio.timeout(retransmitInterval):
-                                while not isinstance(msg, SipRequest):
-                                    msg = await self.recvQueue.get()
+                                msg = await self.recvQueue.get()
                         except TimeoutError:
                             attempts += 1
+                            self._recordTimeout(attempts)
+
+                    self._recordRtt(sentTime, attempts)
 
                 self.state = States.CONFIRMED
                 # Keep transaction alive to absorb ACK messages from final response retransmissions
@@ -110,8 +115,8 @@ class ServerTransaction(Transaction):
         
     async def nonInvite(self):
         """Manage response to a Non-Invite Sip request."""
-        # Ensure dialog established for Non-Cancel requests
-        if not self.dialog and self.requestMethod != 'Cancel':
+        # Ensure dialog established for requests other than Cancel and Register
+        if not self.dialog and self.requestMethod not in ('CANCEL', 'REGISTER'):
             raise ValueError('Missing dialog.')
         
         self.state = States.TRYING
@@ -1,6 +1,8 @@
 # 1st Party
 from .dialog import Dialog
 from .transaction import Transaction
+from .serverTransaction import ServerTransaction
+from Utils.callQueue import CallQueue
 
 # Standard Library
 import asyncio
@@ -12,6 +14,7 @@ class SessionManager():
         self.isActiveDialog: asyncio.Event = asyncio.Event()
         self.answerCall: asyncio.Event = asyncio.Event()
         self.sessionStart: asyncio.Event = asyncio.Event()
+        self.callQueue: CallQueue = CallQueue()
 
 
     def setActiveDialog(self, dialog):
@@ -27,14 +30,25 @@ class SessionManager():
         
 
     def busy(self):
-        return bool(self.activeInvite or self.activeDialog)
+        # The line stays busy after being handed to a queued caller, until that caller's session ends
+        return bool(self.activeInvite or self.activeDialog or self.callQueue.reserved)
     
     def answerIncomingCall(self):
-        self.answerCall.set()
-        self.answerCall.clear()
-
-    async def waitForAnswer(self):
-        await self.answerCall.wait()
+        # Latched until cleanup, the answer may come before the user agent starts waiting for it (e.g. on a standby connection)
+        if isinstance(self.activeInvite, ServerTransaction):
+            self.answerCall.set()
+
+    async def waitForAnswer(self, cancelled):
+        """Wait for the call to be answered, returning False if the cancelled event is set first."""
+        answer = asyncio.create_task(self.answerCall.wait())
+        cancel = asyncio.create_task(cancelled.wait())
+        try:
+            await asyncio.wait((answer, cancel), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            answer.cancel()
+            cancel.cancel()
+
+        return not cancelled.is_set()
 
     async def waitForSession(self):
         await self.sessionStart.wait()
@@ -43,4 +57,6 @@ class SessionManager():
         self.activeInvite = None
         self.activeDialog = None
         self.answerCall.clear()
-        self.sessionStart.clear()
\ No newline at end of file
+        self.sessionStart.clear()
+        # Hand the line straight to the next queued caller
+        self.callQueue.handoff()
\ No newline at end of file
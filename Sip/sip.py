@@ -2,6 +2,7 @@
 from .transport import Transport
 from .messageHandler import MessageHandler
 from .userAgent import UserAgent
+from .transaction import Transaction
 
 # Standard Library
 import asyncio
@@ -15,6 +16,19 @@ class Sip(UserAgent):
     async def run(self):
         loop = asyncio.get_event_loop()
         _, self.transport = await loop.create_datagram_endpoint(
-        lambda: Transport(self.publicIP, handleMsgCallback=self.messageHandler.route),
+        lambda: Transport(self.publicIP, handleMsgCallback=self.messageHandler.route, admissionControl=self.sessionManager.admissionControl,
+                          preferTcp=self.sessionManager.transport == 'tcp'),
         local_addr=("0.0.0.0", self.publicPort),
-        )
\ No newline at end of file
+        )
+        # TCP is always accepted, for peers sending requests too large for UDP
+        await self.transport.listenTcp("0.0.0.0", self.publicPort)
+
+    def stats(self):
+        """Return counters describing SIP traffic screened by the transport and handled statelessly, the learned per-peer timers and fork answer times."""
+        stats = {'stateless': self.messageHandler.statelessResponder.stats(), 'peers': Transaction.rttEstimator.stats(), 'fork': self.forkStats.stats()}
+        if self.transport:
+            stats['transport'] = self.transport.stats()
+        if self.transport and self.transport.admissionControl:
+            stats['admission'] = self.transport.admissionControl.stats()
+
+        return stats
\ No newline at end of file
@@ -1,27 +1,36 @@
 # Standard Library
 from enum import Enum
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import re
-from datetime import datetime
 
 SIP_DEFAULT_PORT = 5060
 SIP_VERSION = 'SIP/2.0'
 TRANSPORT_PROTOCOL = 'UDP'
+RELIABLE_TRANSPORT_PROTOCOL = 'TCP'
+URI_PATTERN = re.compile(r'<?sips?:(?:(?P<user>[^@:;>]+)(?::[^@;>]*)?@)?(?P<host>\[[^\]]+\]|[^:;>]+)(?::(?P<port>[0-9]+))?(?P<params>[^>]*)>?')
 
 class StatusCodes(Enum):
     """Enum class of Sip response status codes."""
     TRYING = (100, 'Trying')
     RINGING = (180, 'Ringing')
+    QUEUED = (182, 'Queued')
     OK = (200, 'OK')
     MULTIPLE_CHOICES = (300, 'Multiple Choices')
     MOVED_PERMANENTLY = (301, 'Moved Permanently')
     MOVED_TEMPORARILY = (302, 'Moved Temporarily')
     USE_PROXY = (305, 'Use Proxy')
     BAD_REQUEST = (400, 'Bad Request')
+    UNAUTHORIZED = (401, 'Unauthorized')
     FORBIDDEN = (403, 'Forbidden')
+    NOT_FOUND = (404, 'Not Found')
+    METHOD_NOT_ALLOWED = (405, 'Method Not Allowed')
     REQUEST_TIMEOUT = (408, 'Request Timeout')
+    INTERVAL_TOO_BRIEF = (423, 'Interval Too Brief')
+    CALL_DOES_NOT_EXIST = (481, 'Call/Transaction Does Not Exist')
     BUSY_HERE = (486, 'Busy Here')
     REQUEST_TERMINATED = (487, 'Request Terminated')
+    NOT_ACCEPTABLE_HERE = (488, 'Not Acceptable Here')
+    SERVICE_UNAVAILABLE = (503, 'Service Unavailable')
     SERVER_TIMEOUT = (504, 'Server Time-out')
 
     def __init__(self, code, reasonPhrase):
@@ -44,6 +53,15 @@ class StatusCodes(Enum):
         """Return whether the status code is final."""
         return 200 <= self.code <= 699
 
+def parseURI(uri):
+    """Split a SIP URI (optionally enclosed in angle brackets) into its user, host, port and parameter string. Port is None if not included."""
+    match = URI_PATTERN.search(uri)
+    if not match:
+        raise ValueError('Invalid SIP URI.')
+
+    port = match.group('port')
+    return match.group('user'), match.group('host'), int(port) if port else None, match.group('params')
+
 class SipMessageFactory():
     """Factory class that creates an object of the Sip Message subclass."""
     @staticmethod
@@ -70,6 +88,12 @@ class SipMessage():
     seqNum: int
     body: str
     additionalHeaders: dict
+    # Address the message was received from, set by the transport
+    sourceAddress: tuple = field(default=None, kw_only=True, compare=False)
+    # Stream connection the message was received on, responses to a request are sent back over it
+    connection: object = field(default=None, kw_only=True, compare=False, repr=False)
+    # Transport protocol advertised in the Via header
+    viaTransport: str = field(default=TRANSPORT_PROTOCOL, kw_only=True, compare=False)
 
     @classmethod
     def fromStr(cls, message):
@@ -77,6 +101,7 @@ class SipMessage():
         head, body = message.split("\r\n\r\n")
         startLine, *headers = head.split('\r\n')
         additionalHeaders = {}
+        viaTransport = TRANSPORT_PROTOCOL
 
         # Parse mandatory header URIs and parameters, maintain dict of non-mandatory headers
         for header in headers:
@@ -84,7 +109,8 @@ class SipMessage():
             match label:
                 case 'Via':
                     # TODO add support for multiple Via headers
-                    content = content.removeprefix(f'{SIP_VERSION}/{TRANSPORT_PROTOCOL} ')
+                    sentProtocol, content = content.split(' ', 1)
+                    viaTransport = sentProtocol.rsplit('/', 1)[-1].upper()
                     address, paramStr = content.split(';', 1)
                     ip, port = address.split(':')
                     viaAddress = (ip, int(port))
@@ -109,7 +135,7 @@ class SipMessage():
                     additionalHeaders[label] = content
 
         # Construct and return a Sip message
-        return cls(method, viaAddress, viaParams, fromURI, fromParams, toURI, toParams, callID, seqNum, body, additionalHeaders)
+        return cls(method, viaAddress, viaParams, fromURI, fromParams, toURI, toParams, callID, seqNum, body, additionalHeaders, viaTransport=viaTransport)
     
     def __str__(self):
         """Returns string representation of a Sip message. Holds shared logic for child classes."""
@@ -117,7 +143,7 @@ class SipMessage():
         msg = ''
         viaIP, viaPort = self.viaAddress
         # Construct mandatory header contents from URIs and parameters
-        headers['Via'] = f'{SIP_VERSION}/{TRANSPORT_PROTOCOL} {viaIP}:{viaPort}' + ''.join(f';{k}={v}' for k, v in self.viaParams.items())
+        headers['Via'] = f'{SIP_VERSION}/{self.viaTransport} {viaIP}:{viaPort}' + ''.join(f';{k}={v}' for k, v in self.viaParams.items())
         headers['From'] = self.fromURI + ''.join(f';{k}={v}' for k, v in self.fromParams.items())
         headers['To'] = self.toURI + ''.join(f';{k}={v}' for k, v in self.toParams.items())
         headers['Call-ID'] = self.callID
@@ -158,41 +184,11 @@ class SipMessage():
     def getDialogID(self):
         """Calculate the Sip messages' dialog ID. To be implemented by child class."""
 
-    def parseSDP(self):
-        """Retrieve RTP and RTCP ports from Session Description Protocol if they exist."""
-        rtpPort, rtcpPort = None, None
-        # Regex search for matching media description
-        match = re.match('^m=audio (?P<port>[0-9]+)', self.body)
-        if match and 'port' in match.groupdict():
-            rtpPort = int(match.group('port'))
-        # Regex search for matching media attribute
-        match = re.match('^a=rtcp:(?P<port>[0-9]+)', self.body)
-        if match and 'port' in match.groupdict():
-            rtcpPort = int(match.group('port'))
-
-        return rtpPort, rtcpPort
-    
-    @staticmethod
-    def _buildSDP(localAddress, port):
-        """Generates and returns a suitable SDP body."""
-        # RFC 4566 recommends timestamps for session ID and version (Section 5.2)
-        sessionID = datetime.now().timestamp()
-        sessionVersion = sessionID
-        sdp = f"""v=0
-o=Hotline {sessionID} {sessionVersion} IN IP4 {localAddress}\r
-s=SIP Call\r
-c=IN IP4 {localAddress}\r
-t=0 0\r
-m=audio {port} RTP/AVP 120\r
-a=sendrecv\r
-a=rtpmap:120 opus/48000/2\r
-a=ptime:20\r\n"""
-        return sdp
-    
     @staticmethod
     def strIsRequest(message):
         """Returns whether the specified message is a request."""
-        return bool(re.match('^(INVITE|ACK|BYE|CANCEL|REGISTER|OPTIONS)\\s+sip:[^\\s]+?\\s+SIP/2\\.0', message))
+        # Any token is a valid method (RFC 3261 Section 25.1), unsupported methods are answered with 405 Method Not Allowed
+        return bool(re.match("^[A-Za-z0-9.!%*_+`'~-]+\\s+sip:[^\\s]+?\\s+SIP/2\\.0", message))
     
     @staticmethod
     def strIsResponse(message):
@@ -203,6 +199,8 @@ a=ptime:20\r\n"""
 class SipRequest(SipMessage):
     """Dataclass representation of a Sip request."""
     targetAddress: tuple
+    # User part of the Request-URI, i.e. the number dialed by the handset
+    requestUser: str = field(default=None, kw_only=True, compare=False)
 
     @classmethod
     def fromStr(cls, message):
@@ -210,18 +208,13 @@ class SipRequest(SipMessage):
         baseMsg = SipMessage.fromStr(message)
         method, requestURI, version = message.split(' ', 2)
 
-        # Determine if the port is included in request URI
-        match = re.match('sips?:(?P<user>.*@)?(?P<ip>[^@: ]+)(:?)(?P<port>[0-9]+)?', requestURI)
-        if match and 'ip' in match.groupdict():
-            targetIP = match.group('ip')
-            targetPort = int(match.group('port')) if 'port' in match.groupdict() else SIP_DEFAULT_PORT
-        else:
-            raise ValueError('Invalid Request URI.')
-
-        targetAddress = (targetIP, targetPort)
+        # Default to the SIP port when it is not included in the request URI
+        requestUser, targetIP, targetPort, _ = parseURI(requestURI)
+        targetAddress = (targetIP, targetPort or SIP_DEFAULT_PORT)
         # Construct and return a request obj
         return cls(method, baseMsg.viaAddress, baseMsg.viaParams, baseMsg.fromURI, baseMsg.fromParams, baseMsg.toURI, baseMsg.toParams, 
-                   baseMsg.callID, baseMsg.seqNum, baseMsg.body, baseMsg.additionalHeaders, targetAddress)
+                   baseMsg.callID, baseMsg.seqNum, baseMsg.body, baseMsg.additionalHeaders, targetAddress, viaTransport=baseMsg.viaTransport,
+                   requestUser=requestUser)
 
     @classmethod
     def ackFromResponse(cls, response):
@@ -229,21 +222,17 @@ class SipRequest(SipMessage):
         if 'Contact' not in response.additionalHeaders:
             raise ValueError('Response missing Contact header.')
 
-        match = re.match('<sips?:(?P<user>.*@)?(?P<ip>[^@:]+):(?P<port>[0-9]+)?>', response.additionalHeaders['Contact'])
-        if match and 'ip' in match.groupdict():
-            targetIP = match.group('ip')
-            targetPort = int(match.group('port')) if 'port' in match.groupdict() else SIP_DEFAULT_PORT 
-            targetAddress = (targetIP, targetPort)
-        else:
-            raise ValueError('Invalid Contact URI')
+        _, targetIP, targetPort, _ = parseURI(response.additionalHeaders['Contact'])
+        targetAddress = (targetIP, targetPort or SIP_DEFAULT_PORT)
 
         return cls('ACK', response.viaAddress, response.viaParams, response.fromURI, response.fromParams, response.toURI, response.toParams,
-                   response.callID, response.seqNum, "", response.additionalHeaders, targetAddress)
+                   response.callID, response.seqNum, "", response.additionalHeaders, targetAddress, viaTransport=response.viaTransport)
     
     def __str__(self):
         """Returns string representation of a Sip request."""
         targetIP, targetPort = self.targetAddress
-        requestLine = f'{self.method} sip:{targetIP}:{targetPort} {SIP_VERSION}\r\n'
+        userInfo = f'{self.requestUser}@' if self.requestUser else ''
+        requestLine = f'{self.method} sip:{userInfo}{targetIP}:{targetPort} {SIP_VERSION}\r\n'
         # Add request line to base message string
         return requestLine + super().__str__()
     
@@ -283,13 +272,14 @@ class SipResponse(SipMessage):
 
         # Construct and return a response obj
         return cls(baseMsg.method, baseMsg.viaAddress, baseMsg.viaParams, baseMsg.fromURI, baseMsg.fromParams, baseMsg.toURI, baseMsg.toParams, 
-                   baseMsg.callID, baseMsg.seqNum, baseMsg.body, baseMsg.additionalHeaders, statusCode)
+                   baseMsg.callID, baseMsg.seqNum, baseMsg.body, baseMsg.additionalHeaders, statusCode, viaTransport=baseMsg.viaTransport)
         
     @classmethod
     def fromRequest(cls, request, statusCode):
         """Constructs a response object from an existing request object."""
         return cls(request.method, request.viaAddress, request.viaParams, request.fromURI, request.fromParams, request.toURI, request.toParams,
-                   request.callID, request.seqNum, request.body, request.additionalHeaders, statusCode)
+                   request.callID, request.seqNum, request.body, request.additionalHeaders, statusCode, viaTransport=request.viaTransport,
+                   connection=request.connection)
 
     def __str__(self):
         """Returns string representation of a Sip response."""
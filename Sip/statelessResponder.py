@@ -0,0 +1,73 @@
+# 1st Party
+from .sipMessage import SipRequest, SipResponse, StatusCodes
+from .dialog import Dialog
+from .transaction import Transaction
+
+# Standard Library
+import random
+from collections.abc import Callable
+
+ALLOWED_METHODS = ('INVITE', 'ACK', 'BYE', 'CANCEL', 'OPTIONS', 'REGISTER')
+CAPABILITY_HEADERS = {'Allow': ', '.join(ALLOWED_METHODS), 'Accept': 'application/sdp', 'Accept-Language': 'en'}
+
+class StatelessResponder():
+    """Answer OPTIONS keepalives and absorb stray retransmissions without allocating transactions."""
+    def __init__(self, sendToTransport):
+        self.sendToTransport: Callable = sendToTransport
+        # A fixed To tag keeps responses to retransmitted requests identical
+        self._toTag: str = hex(random.getrandbits(32))[2:]
+        self.counters: dict = {'options': 0, 'absorbedAcks': 0, 'reAcked': 0, 'strayResponses': 0, 'unknownDialogs': 0, 'methodNotAllowed': 0}
+
+    def handle(self, msgObj):
+        """Answer or absorb a message matching no transaction, returning whether it was handled."""
+        if isinstance(msgObj, SipRequest):
+            match msgObj.method:
+                case 'OPTIONS':
+                    self.counters['options'] += 1
+                    self._respond(msgObj, StatusCodes.OK, CAPABILITY_HEADERS)
+
+                case 'ACK':
+                    # ACKs for 2xx responses are end-to-end and require no action
+                    self.counters['absorbedAcks'] += 1
+
+                case 'BYE' if not Dialog.getDialog(msgObj.getDialogID()):
+                    # Retransmission of a BYE whose dialog has already been terminated
+                    self.counters['unknownDialogs'] += 1
+                    self._respond(msgObj, StatusCodes.CALL_DOES_NOT_EXIST)
+
+                case 'CANCEL' if not Transaction.getTransaction(msgObj.getTransactionID().replace('CANCEL', 'INVITE')):
+                    self.counters['unknownDialogs'] += 1
+                    self._respond(msgObj, StatusCodes.CALL_DOES_NOT_EXIST)
+
+                case method if method not in ALLOWED_METHODS:
+                    self.counters['methodNotAllowed'] += 1
+                    self._respond(msgObj, StatusCodes.METHOD_NOT_ALLOWED, CAPABILITY_HEADERS)
+
+                case _:
+                    return False
+
+        elif isinstance(msgObj, SipResponse):
+            # Retransmitted 2xx responses outlive the invite client transaction and must each be acknowledged (RFC 3261 Section 13.2.2.4)
+            if msgObj.method == 'INVITE' and msgObj.statusCode.isSuccessful() and Dialog.getDialog(msgObj.getDialogID()):
+                self.counters['reAcked'] += 1
+                ack = SipRequest.ackFromResponse(msgObj)
+                self.sendToTransport(ack, ack.targetAddress)
+            else:
+                self.counters['strayResponses'] += 1
+
+        else:
+            return False
+
+        return True
+
+    def stats(self):
+        """Return a copy of the stateless handling counters."""
+        return dict(self.counters)
+
+    def _respond(self, request, statusCode, additionalHeaders=None):
+        """Send a response built directly from the request."""
+        toParams = request.toParams if 'tag' in request.toParams else dict(request.toParams, tag=self._toTag)
+        response = SipResponse(request.method, request.viaAddress, request.viaParams, request.fromURI, request.fromParams, request.toURI, toParams,
+                               request.callID, request.seqNum, '', dict(additionalHeaders or {}), statusCode, viaTransport=request.viaTransport,
+                               connection=request.connection)
+        self.sendToTransport(response, request.viaAddress)
@@ -1,9 +1,12 @@
 # 1st Party
 from .dialog import Dialog
+from .rttEstimator import RttEstimator
+from Utils import metrics
 
 # Standard Library
 import asyncio
 import random
+import time
 from collections.abc import Callable
 from enum import Enum
 
@@ -27,6 +30,7 @@ class Transaction:
 
     # Static Vars
     _transactions: dict = {}
+    rttEstimator: RttEstimator = RttEstimator()
 
     def __init__(self, notifyTU, sendToTransport, requestMethod, localAddress, remoteAddress, dialog):
         self.notifyTU: Callable = notifyTU
@@ -43,12 +47,26 @@ class Transaction:
         self.callID: str = None
         self.branch: str = None
         self.sequence: int = None
-            
+        # Group of parallel INVITEs the transaction belongs to, if forked
+        self.fork = None
+        # Retransmission interval learned from the remote peer's round trip time (transaction timeouts still use the default T1)
+        self.t1: float = Transaction.rttEstimator.getT1(remoteAddress)
+
     def terminate(self):
         """Terminate the current session and remove from transactions list."""
         self.state = States.TERMINATED
         del self._transactions[self.id]
 
+    def _recordRtt(self, sentTime, attempts):
+        """Sample the remote peer's round trip time, unless the message was retransmitted and the sample would be ambiguous."""
+        if attempts == 0:
+            Transaction.rttEstimator.sample((self.remoteIP, self.remotePort), time.monotonic() - sentTime)
+
+    def _recordTimeout(self, attempts):
+        """Back off the remote peer's learned T1 on the first retransmission of a transaction."""
+        if attempts == 1:
+            Transaction.rttEstimator.backoff((self.remoteIP, self.remotePort))
+
     def _genTag(self):
         """Generates and returns a suitable SIP from/to tag."""
         return hex(int(random.getrandbits(32)))[2:]
@@ -56,4 +74,6 @@ class Transaction:
     @staticmethod
     def getTransaction(id):
         """Returns a transaction with matching ID from transactions list or None if one does not exist."""
-        return Transaction._transactions.get(id, None)
\ No newline at end of file
+        return Transaction._transactions.get(id, None)
+
+metrics.registry.gauge('redtelephone_sip_transactions', 'Live SIP transactions.', function=lambda: len(Transaction._transactions))
@@ -1,33 +1,100 @@
 # Standard Library
 import asyncio
+import re
+import socket
+import time
 from typing import Callable
 
 # 1st Party
-from .sipMessage import SipMessageFactory
+from .sipMessage import SipMessageFactory, SipRequest, TRANSPORT_PROTOCOL, RELIABLE_TRANSPORT_PROTOCOL
+from .admission import AdmissionControl, Verdicts
+from Utils import metrics
+
+# Requests larger than this are sent over TCP to avoid IP fragmentation (RFC 3261 Section 18.1.1)
+MTU_THRESHOLD = 1300
+# Idle pooled connections are closed after this many seconds
+IDLE_TIMEOUT = 300
+# Accepted connections beyond this many pooled connections are closed straight away
+MAX_TCP_CONNECTIONS = 256
+MAX_MESSAGE_SIZE = 65535
+CONTENT_LENGTH_PATTERN = re.compile(rb'^(?:Content-Length|l)[ \t]*:[ \t]*([0-9]+)', re.IGNORECASE | re.MULTILINE)
+
+SIP_MESSAGES = metrics.registry.counter('redtelephone_sip_messages_total', 'SIP messages by direction, transport, method and response status.',
+                                        ('direction', 'transport', 'method', 'status'))
 
 class Transport():
-    """Manage UDP transport for sending/receiving of SIP messages."""
-    def __init__(self, port, handleMsgCallback):
+    """Manage UDP and TCP transport for sending/receiving of SIP messages. UDP is used unless a request is too large or TCP is preferred."""
+    def __init__(self, port, handleMsgCallback, admissionControl=None, preferTcp=False):
         self.port: int = port
         self.handleMsgCallback: Callable = handleMsgCallback
+        self.admissionControl: AdmissionControl = admissionControl
+        self.preferTcp: bool = preferTcp
         self._transport: asyncio.DatagramTransport = None
+        self._server: asyncio.Server = None
+        # Pooled TCP connections keyed by the address they were opened to or accepted from, reused across transactions
+        self._connections: dict = {}
 
     def connection_made(self, transport):
         """Configure transport on connection established."""
         self._transport = transport
 
+    async def listenTcp(self, host, port):
+        """Accept SIP over TCP on the specified address."""
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(lambda: TcpConnection(self), host, port)
+
     def send(self, msgObj, addr):
-        """Send a Sip message to the specified address"""
-        data = str(msgObj).encode('utf-8')
-        self._transport.sendto(data, addr)
+        """Send a Sip message to the specified address. Returns whether it was sent over a reliable transport."""
+        connection = self._connections.get(addr)
+        # Requests switch to TCP when too large for a datagram, responses follow the transport of their request
+        if isinstance(msgObj, SipRequest):
+            reliable = bool(connection) or self.preferTcp
+            self._setTransport(msgObj, RELIABLE_TRANSPORT_PROTOCOL if reliable else TRANSPORT_PROTOCOL)
+            data = str(msgObj).encode('utf-8')
+            if not reliable and len(data) > MTU_THRESHOLD:
+                reliable = True
+                self._setTransport(msgObj, RELIABLE_TRANSPORT_PROTOCOL)
+                data = str(msgObj).encode('utf-8')
+        else:
+            reliable = msgObj.viaTransport == RELIABLE_TRANSPORT_PROTOCOL
+            # Responses go back over the connection their request arrived on, or a new one to the Via address if it closed (RFC 3261 Section 18.2.2)
+            if msgObj.connection and not msgObj.connection.closed:
+                connection = msgObj.connection
+            data = str(msgObj).encode('utf-8')
+
+        if reliable:
+            (connection or self._connect(addr)).write(data)
+        else:
+            self._transport.sendto(data, addr)
         print(data)
+        _countMessage('tx', reliable, msgObj)
+
+        return reliable
 
     def datagram_received(self, data, addr):
         """Convert datagram to Sip message and pass to callback function."""
+        self.receive(data, addr, lambda response: self._transport.sendto(response, addr))
+
+    def receive(self, data, addr, reply, connection=None):
+        """Screen, parse and dispatch a single message received over either transport."""
+        # Screen raw messages before spending any time decoding or parsing them
+        if self.admissionControl:
+            verdict = self.admissionControl.check(data, addr)
+            if verdict == Verdicts.REJECT:
+                response = self.admissionControl.buildRejection(data)
+                if response:
+                    reply(response)
+                return
+            elif verdict == Verdicts.DROP:
+                return
+
         try:
             msg = data.decode('utf-8')
             msgObj = SipMessageFactory.fromStr(msg)
-            asyncio.create_task(self.handleMsgCallback(msgObj, addr))
+            msgObj.sourceAddress = addr
+            msgObj.connection = connection
+            _countMessage('rx', connection is not None, msgObj)
+            self.handleMsgCallback(msgObj, addr)
         except Exception as e:
             pass
 
@@ -41,4 +108,158 @@ class Transport():
 
     def stop(self):
         """Gracefully shutdown transport."""
-        self._transport.close()
\ No newline at end of file
+        self._transport.close()
+        if self._server:
+            self._server.close()
+        for connection in set(self._connections.values()):
+            connection.close()
+
+    def stats(self):
+        """Return the number of pooled TCP connections."""
+        return {'tcpConnections': len(set(self._connections.values()))}
+
+    def accepting(self):
+        """Return whether another inbound TCP connection may be accepted."""
+        return len(self._connections) < MAX_TCP_CONNECTIONS
+
+    def addConnection(self, connection):
+        """Add a connection to the pool under its peer address."""
+        self._connections[connection.peer] = connection
+
+    def removeConnection(self, connection):
+        """Remove a closed connection from the pool."""
+        connection.closed = True
+        if self._connections.get(connection.peer) is connection:
+            del self._connections[connection.peer]
+
+    def _connect(self, addr):
+        """Open a pooled connection to the peer. Writes are buffered until the connection is established."""
+        connection = TcpConnection(self, addr)
+        self.addConnection(connection)
+        asyncio.create_task(connection.open())
+        return connection
+
+    @staticmethod
+    def _setTransport(msgObj, protocol):
+        """Advertise the transport protocol in the Via header, and in the Contact URI if it is not UDP."""
+        msgObj.viaTransport = protocol
+        contact = msgObj.additionalHeaders.get('Contact')
+        if protocol != TRANSPORT_PROTOCOL and contact and 'transport=' not in contact:
+            # Headers may be shared with the message this one was built from
+            msgObj.additionalHeaders = dict(msgObj.additionalHeaders, Contact=contact.replace('>', f';transport={protocol.lower()}>', 1))
+
+def _countMessage(direction, reliable, msgObj):
+    """Helper method to count a sent or received message."""
+    status = '' if isinstance(msgObj, SipRequest) else msgObj.statusCode.code
+    SIP_MESSAGES.labels(direction, RELIABLE_TRANSPORT_PROTOCOL if reliable else TRANSPORT_PROTOCOL, msgObj.method, status).inc()
+
+class TcpConnection(asyncio.Protocol):
+    """A keep-alive SIP over TCP connection, framing the stream into messages by their Content-Length."""
+    def __init__(self, sipTransport, peer=None):
+        self.sipTransport: Transport = sipTransport
+        self.peer: tuple = peer
+        self.closed: bool = False
+        # Monotonic time until which a registration is bound to the connection, it is not closed for being idle before then
+        self.boundUntil: float = 0
+        self._transport: asyncio.Transport = None
+        self._buffer: bytearray = bytearray()
+        self._pending: list = []
+        self._idleHandle: asyncio.TimerHandle = None
+
+    async def open(self):
+        """Connect to the peer, dropping the connection from the pool on failure."""
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.create_connection(lambda: self, *self.peer)
+        except OSError:
+            self.sipTransport.removeConnection(self)
+
+    def connection_made(self, transport):
+        """Enable keep-alives and flush writes buffered while connecting."""
+        self._transport = transport
+        if self.peer is None:
+            self.peer = transport.get_extra_info('peername')[:2]
+            if not self.sipTransport.accepting():
+                transport.abort()
+                return
+            self.sipTransport.addConnection(self)
+
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        for data in self._pending:
+            transport.write(data)
+        self._pending.clear()
+        self._resetIdle()
+
+    def write(self, data):
+        """Write a message to the connection, or buffer it until connected."""
+        if self._transport:
+            self._transport.write(data)
+            self._resetIdle()
+        else:
+            self._pending.append(data)
+
+    def data_received(self, data):
+        """Split the stream into messages and pass each to the SIP transport."""
+        self._buffer += data
+        self._resetIdle()
+        while True:
+            # Skip CRLF keep-alives between messages, answering a double CRLF ping with a single CRLF pong (RFC 5626 Section 4.4.1)
+            stripped = self._buffer.lstrip(b'\r\n')
+            if len(stripped) != len(self._buffer):
+                if self._buffer.startswith(b'\r\n\r\n') and self._transport:
+                    self._transport.write(b'\r\n')
+                del self._buffer[:len(self._buffer) - len(stripped)]
+
+            headerEnd = self._buffer.find(b'\r\n\r\n')
+            if headerEnd == -1:
+                if len(self._buffer) > MAX_MESSAGE_SIZE:
+                    self.close()
+                return
+
+            # Content-Length is mandatory over stream transports (RFC 3261 Section 18.3)
+            match = CONTENT_LENGTH_PATTERN.search(self._buffer, 0, headerEnd)
+            length = headerEnd + 4 + (int(match.group(1)) if match else 0)
+            if length > MAX_MESSAGE_SIZE:
+                self.close()
+                return
+            elif len(self._buffer) < length:
+                return
+
+            message = bytes(self._buffer[:length])
+            del self._buffer[:length]
+            self.sipTransport.receive(message, self.peer, self.write, self)
+
+    def connection_lost(self, exc):
+        """Remove the connection from the pool."""
+        if self._idleHandle:
+            self._idleHandle.cancel()
+        self._transport = None
+        self.sipTransport.removeConnection(self)
+
+    def close(self):
+        """Close the connection."""
+        if self._transport:
+            self._transport.close()
+        else:
+            self.sipTransport.removeConnection(self)
+
+    def bind(self, until):
+        """Keep the connection open until the specified monotonic time, the source port of a registration over it is unreachable otherwise."""
+        self.boundUntil = max(self.boundUntil, until)
+
+    def _resetIdle(self):
+        """Restart the idle timer."""
+        if self._idleHandle:
+            self._idleHandle.cancel()
+        self._idleHandle = asyncio.get_running_loop().call_later(IDLE_TIMEOUT, self._onIdle)
+
+    def _onIdle(self):
+        """Close the idle connection, or wait for the registration bound to it to expire."""
+        remaining = self.boundUntil - time.monotonic()
+        if remaining > 0:
+            self._idleHandle = asyncio.get_running_loop().call_later(remaining, self._onIdle)
+        else:
+            self.close()
@@ -1,5 +1,5 @@
 # 1st Party Library
-from .sipMessage import SipRequest, SipResponse, StatusCodes
+from .sipMessage import SipRequest, SipResponse, StatusCodes, SIP_DEFAULT_PORT, parseURI
 from .transport import Transport
 from .transaction import Transaction, States
 from .clientTransaction import ClientTransaction
@@ -8,11 +8,17 @@ from .dialog import Dialog
 from .exceptions import InviteError
 from Utils.events import EventHandler
 from .sessionManager import SessionManager
+from .fork import Fork, ForkStats, Outcomes
+from Utils.callQueue import DEFAULT_PRIORITY
+from . import sdp
+from Utils import tracing
 
 # Standard Library
 import asyncio
 
 TRANSACTION_USER_TIMEOUT = 20
+# Queue priority of each Priority header value (RFC 3261 Section 20.26), lower values are served first
+PRIORITY_HEADER_VALUES = {'emergency': 0, 'urgent': 1, 'normal': 2, 'non-urgent': 3}
 
 class UserAgent:
     def __init__(self, transport, publicAddress, sessionManager):
@@ -22,6 +28,7 @@ class UserAgent:
         self.publicIP, self.publicPort = publicAddress
         self.eventHandler: EventHandler = EventHandler()
         self.sessionManager: SessionManager = sessionManager
+        self.forkStats: ForkStats = ForkStats()
 
     async def invite(self, address, port):
         print("Attempting to initiate a call with {}:{}".format(address, port))
@@ -33,7 +40,83 @@ class UserAgent:
         
         return dialog
 
+    async def inviteAny(self, targets):
+        """Invite each target in turn until one answers, failing over only when a target times out or is unavailable (RFC 3263 Section 4.3)."""
+        for address, port in targets:
+            print("Attempting to initiate a call with {}:{}".format(address, port))
+            transaction = ClientTransaction(self.notify, self.transport.send, "INVITE", (self.publicIP, self.publicPort), (address, port))
+            try:
+                dialog = await transaction.invite()
+            except (ConnectionError, TimeoutError):
+                dialog = None
+                if transaction.state != States.TERMINATED:
+                    transaction.terminate()
+
+            if dialog:
+                return dialog
+            # A definitive rejection (e.g. busy) ends the call rather than trying the next target
+            elif transaction.lastResponse and transaction.lastResponse.statusCode != StatusCodes.SERVICE_UNAVAILABLE:
+                break
+
+        raise InviteError('Failed to establish a dialog.')
+
+    async def fork(self, targets):
+        """Send INVITEs to every target in parallel, keep the dialog of the first to answer and cancel or end the others."""
+        print("Attempting to initiate a call with {}".format(', '.join(f'{address}:{port}' for address, port in targets)))
+        transactions = [ClientTransaction(self.notify, self.transport.send, "INVITE", (self.publicIP, self.publicPort), target) for target in targets]
+        fork = Fork(transactions)
+        self.sessionManager.activeInvite = fork
+
+        tasks = {asyncio.create_task(transaction.invite()): transaction for transaction in transactions}
+        pending = set(tasks)
+        while pending and not fork.winner:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                transaction = tasks[task]
+                dialog = task.result() if not task.exception() else None
+
+                if dialog and fork.answer(transaction, dialog):
+                    self.forkStats.record((transaction.remoteIP, transaction.remotePort), Outcomes.WON, fork.elapsed())
+                elif dialog:
+                    # Answered at the same moment as the winner
+                    self.forkStats.record((transaction.remoteIP, transaction.remotePort), Outcomes.LOST, fork.elapsed())
+                    asyncio.create_task(self.bye(dialog))
+                else:
+                    self.forkStats.record((transaction.remoteIP, transaction.remotePort), Outcomes.FAILED)
+
+        # Cancel targets that are still ringing, and end any call answered after the winner
+        if pending:
+            asyncio.create_task(self._releaseForkLosers(fork, {task: tasks[task] for task in pending}))
+
+        if not fork.winner:
+            raise InviteError('Failed to establish a dialog.')
+
+        return fork.dialog
+
+    async def _releaseForkLosers(self, fork, tasks):
+        """Cancel the remaining INVITEs of a fork and send BYE to any that were answered regardless."""
+        await asyncio.gather(*[self.cancel(transaction) for transaction in tasks.values()], return_exceptions=True)
+
+        for task, transaction in tasks.items():
+            try:
+                dialog = await task
+            except Exception:
+                dialog = None
+
+            if dialog:
+                self.forkStats.record((transaction.remoteIP, transaction.remotePort), Outcomes.LOST, fork.elapsed())
+                await self.bye(dialog)
+            else:
+                self.forkStats.record((transaction.remoteIP, transaction.remotePort), Outcomes.CANCELLED)
+
     async def cancel(self, inviteTransaction):
+        # Cancel every ringing target of a forked call
+        if isinstance(inviteTransaction, Fork):
+            inviteTransaction.cancelled = True
+            await asyncio.gather(*[self.cancel(transaction) for transaction in inviteTransaction.transactions], return_exceptions=True)
+            self.sessionManager.cleanup()
+            return
+
         print("Cancelling call.")
         if inviteTransaction.state == States.CALLING:
             transactionTimeout = 64 * Transaction.T1
@@ -49,19 +132,32 @@ class UserAgent:
 
     async def bye(self, dialog):
         print("Ending call")
-        _, remoteIP, remotePort = dialog.remoteTarget.strip('<>').split(':', 2)
-        # TODO add proper regex instead of this hack for removing username
-        try:
-            username, remoteIP = remoteIP.split('@')
-        except:
-            pass
-
-        remotePort = int(remotePort)
+        _, remoteIP, remotePort, _ = parseURI(dialog.remoteTarget)
+        remotePort = remotePort or SIP_DEFAULT_PORT
 
         transaction = ClientTransaction(self.notify, self.transport.send, "BYE", (self.publicIP, self.publicPort), (remoteIP, remotePort), dialog)
         byeTask = asyncio.create_task(transaction.nonInvite('BYE'))
         await byeTask
 
+    async def _waitInQueue(self, transaction, msg):
+        """Queue an INVITE while the line is busy, returning whether the line was handed to it (486 Busy Here if the queue is full)."""
+        callQueue = self.sessionManager.callQueue
+        priority = PRIORITY_HEADER_VALUES.get(msg.additionalHeaders.get('Priority', '').strip().lower(), DEFAULT_PRIORITY)
+        ticket = callQueue.enqueue(transaction, priority)
+        if not ticket:
+            response = transaction.buildResponse(StatusCodes(486, 'Busy Here'))
+            await transaction.recvQueue.put(response)
+            return False
+
+        response = transaction.buildResponse(StatusCodes.QUEUED)
+        await transaction.recvQueue.put(response)
+        # Ringing prompts the handset to play ringback while the caller waits
+        if self.sessionManager.queueRingback:
+            response = transaction.buildResponse(StatusCodes.RINGING)
+            await transaction.recvQueue.put(response)
+
+        return await callQueue.wait(ticket)
+
     async def createTransaction(self, msg):
         dialog = Dialog.getDialog(msg.getDialogID())
         transaction = ServerTransaction(self.notify, self.transport.send, msg, (self.publicIP, self.publicPort), dialog)
@@ -81,43 +177,78 @@ class UserAgent:
             match msg.method:
                 case 'INVITE':
                     viaIP, viaPort = msg.viaAddress
-                    
-                    if self.sessionManager.busy():
-                        response = transaction.buildResponse(StatusCodes(486, 'Busy Here'))
+
+                    if not self.sessionManager.addressFilter.allowed(viaIP):
+                        response = transaction.buildResponse(StatusCodes(403, 'Forbidden'))
                         await transaction.recvQueue.put(response)
+                        return
 
-                    elif viaIP in self.sessionManager.addressFilter.getAddresses():
-                        self.sessionManager.activeInvite = transaction
-                        response = transaction.buildResponse(StatusCodes(180, 'Ringing'))
+                    # Route the dialed number before anything joins voice
+                    route = self.sessionManager.dialPlan.lookup(msg.requestUser or '')
+                    if route is None:
+                        response = transaction.buildResponse(StatusCodes.NOT_FOUND)
+                        await transaction.recvQueue.put(response)
+                        return
+
+                    # Negotiate media before alerting anyone, an INVITE without an offer receives ours in the 200 OK
+                    try:
+                        media = sdp.negotiate(sdp.parse(msg.body)) if msg.body.strip() else None
+                    except (sdp.SdpError, ValueError):
+                        response = transaction.buildResponse(StatusCodes.NOT_ACCEPTABLE_HERE, {'Warning': '305 - "Incompatible media format"'})
                         await transaction.recvQueue.put(response)
+                        return
 
-                        # Call relevant event handler
-                        await self.eventHandler.dispatch('inbound_call')
+                    # Trace the call's setup, tasks created from here on (e.g. event listeners joining voice) continue the trace
+                    tracing.startTrace('inbound_call', number=msg.requestUser)
 
-                        # Await an event signaling the call has been answered
-                        async with asyncio.timeout(TRANSACTION_USER_TIMEOUT):
-                            try:
-                                await self.sessionManager.waitForAnswer()
-                            except TimeoutError:
-                                response = transaction.buildResponse(StatusCodes(504, 'Server Time-out'))
-                                transaction.recvQueue.put(response)
+                    # Wait behind callers already queued, even if the line just became free
+                    if self.sessionManager.busy() or self.sessionManager.callQueue.waiting():
+                        with tracing.span('queued'):
+                            if not await self._waitInQueue(transaction, msg):
                                 return
-                            
-                        response = transaction.buildResponse(StatusCodes(200, 'OK'))
 
-                        # TODO create a function for automatically building a Dialog from a transaction?
-                        remoteTarget = msg.additionalHeaders['Contact']
-                        transaction.dialog = Dialog(transaction.callID, transaction.toTag, f"sip:IPCall@{transaction.localIP}:{transaction.localPort}", 0, transaction.fromTag, f"sip:{transaction.remoteIP}:{transaction.remotePort}", remoteTarget, transaction.sequence)
+                    self.sessionManager.activeInvite = transaction
+                    response = transaction.buildResponse(StatusCodes(180, 'Ringing'))
+                    await transaction.recvQueue.put(response)
+
+                    # Call relevant event handler
+                    await self.eventHandler.dispatch('inbound_call', route)
 
+                    # Await an event signaling the call has been answered, or a CANCEL (which has already been responded to and freed the line)
+                    try:
+                        with tracing.span('wait_for_answer'):
+                            async with asyncio.timeout(TRANSACTION_USER_TIMEOUT):
+                                answered = await self.sessionManager.waitForAnswer(transaction.cancelled)
+                    except TimeoutError:
+                        response = transaction.buildResponse(StatusCodes(504, 'Server Time-out'))
                         await transaction.recvQueue.put(response)
-                        await self.sessionManager.buildSession(transaction.dialog)
+                        # Free the line for the next caller, unless it has already been handed on
+                        if self.sessionManager.activeInvite is transaction:
+                            self.sessionManager.cleanup()
+                        tracing.endTrace(error='answer timeout')
+                        return
 
-                        # Call relevant event handler
-                        await self.eventHandler.dispatch('inbound_call_accepted')
+                    if not answered:
+                        tracing.endTrace(error='cancelled')
+                        return
 
+                    if media:
+                        body = sdp.renderAnswer(transaction.localIP, sdp.DEFAULT_MEDIA_PORT, media)
                     else:
-                        response = transaction.buildResponse(StatusCodes(403, 'Forbidden'))
-                        await transaction.recvQueue.put(response)
+                        body = sdp.renderOffer(transaction.localIP, sdp.DEFAULT_MEDIA_PORT)
+                    response = transaction.buildResponse(StatusCodes(200, 'OK'), body=body)
+
+                    # TODO create a function for automatically building a Dialog from a transaction?
+                    remoteTarget = msg.additionalHeaders['Contact']
+                    transaction.dialog = Dialog(transaction.callID, transaction.toTag, f"sip:IPCall@{transaction.localIP}:{transaction.localPort}", 0, transaction.fromTag, f"sip:{transaction.remoteIP}:{transaction.remotePort}", remoteTarget, transaction.sequence)
+                    transaction.dialog.media = media
+
+                    await transaction.recvQueue.put(response)
+                    tracing.record('sip_response', status=response.statusCode.code)
+                    await self.sessionManager.buildSession(transaction.dialog)
+
+                    # Call relevant event handler
+                    await self.eventHandler.dispatch('inbound_call_accepted')
 
                 case 'BYE':
                     response = transaction.buildResponse(StatusCodes(200, 'OK'))
@@ -137,9 +268,17 @@ class UserAgent:
 
                         response = inviteTransaction.buildResponse(StatusCodes(487, 'Request Terminated'))
                         await inviteTransaction.recvQueue.put(response)
+                        inviteTransaction.cancelled.set()
 
-                        self.sessionManager.cleanup()
-                        await self.eventHandler.dispatch('inbound_call_ended')
+                        # A queued caller hanging up leaves the current session untouched, only the ringing caller holds the line
+                        if not self.sessionManager.callQueue.remove(inviteTransaction) and self.sessionManager.activeInvite is inviteTransaction:
+                            self.sessionManager.cleanup()
+                            await self.eventHandler.dispatch('inbound_call_ended')
+
+                case 'REGISTER':
+                    statusCode, headers = self.sessionManager.registrar.register(msg)
+                    response = transaction.buildResponse(statusCode, headers)
+                    await transaction.recvQueue.put(response)
 
                 case 'ACK':
                     pass
@@ -150,22 +289,30 @@ class UserAgent:
         elif isinstance(msg, SipResponse):
             match msg.method:
                 case 'INVITE':
-                    self.sessionManager.activeInvite = transaction
+                    tracing.record('sip_response', status=msg.statusCode.code, target=f'{transaction.remoteIP}:{transaction.remotePort}')
+                    # A forked call is tracked as a whole by the session manager
+                    if not transaction.fork:
+                        self.sessionManager.activeInvite = transaction
                     if msg.statusCode.isSuccessful():
                         # Create a new dialog
                         transaction.dialog = Dialog(msg.callID, msg.fromParams['tag'], msg.fromURI, msg.seqNum, msg.toParams['tag'], msg.toURI, msg.additionalHeaders['Contact'].strip('<>'))
-                        # Get media ports from Session Description Protocol
-                        self.remoteRtpPort, self.remoteRtcpPort = msg.parseSDP()
+                        # Get the media address and codec from the answer, falling back to the dialog's address if it cannot be negotiated
+                        try:
+                            transaction.dialog.media = sdp.negotiate(sdp.parse(msg.body))
+                        except (sdp.SdpError, ValueError):
+                            pass
                         # Ack response
                         ack = SipRequest.ackFromResponse(msg)
                         self.transport.send(ack, ack.targetAddress)
 
                 case 'BYE':
                     transaction.dialog.terminate()
-                    self.sessionManager.cleanup()
+                    # Calls released by a fork never became the active session
+                    if transaction.dialog is self.sessionManager.activeDialog:
+                        self.sessionManager.cleanup()
                 case 'CANCEL':
-                    pass
-                    self.sessionManager.cleanup()
+                    if not transaction.fork:
+                        self.sessionManager.cleanup()
                 case _:
                     print('Unsupported response method')
 
@@ -1,54 +1,156 @@
+# 1st Party
+from .dnsResolver import DnsResolver
+
+# Standard Library
 import asyncio
+import time
 import socket
-import concurrent.futures
+from ipaddress import ip_address, ip_network
+
+# Bounds applied to record TTLs when scheduling domain refreshes
+MIN_REFRESH_INTERVAL = 30
+MAX_REFRESH_INTERVAL = 3600
+RETRY_INTERVAL = 60
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'
+
+class AddressSnapshot():
+    """Immutable set of allowed IPs and networks answering membership queries in constant time."""
+    __slots__ = ('addresses', '_prefixes')
 
-RESOLVE_INTERVAL = 300
+    def __init__(self, addresses=(), networks=()):
+        self.addresses: frozenset = frozenset(addresses)
+        # Group networks by IP version and prefix length so each group is a single masked set lookup
+        groups = {}
+        for network in networks:
+            key = (network.version, int(network.netmask))
+            groups.setdefault(key, set()).add(int(network.network_address))
+        self._prefixes: tuple = tuple((version, mask, frozenset(values)) for (version, mask), values in groups.items())
+
+    def contains(self, address):
+        """Return whether the IP is an allowed address or falls within an allowed network."""
+        if address in self.addresses or (address.startswith('::ffff:') and address[7:] in self.addresses):
+            return True
+        if not self._prefixes:
+            return False
+
+        # Convert to an integer with inet_pton, which is considerably cheaper than the ipaddress module
+        try:
+            if ':' in address:
+                packed = socket.inet_pton(socket.AF_INET6, address.split('%', 1)[0])
+                # Match IPv4 peers seen through a dual-stack socket against IPv4 entries
+                if packed.startswith(IPV4_MAPPED_PREFIX):
+                    version, packed = 4, packed[12:]
+                else:
+                    version = 6
+            else:
+                version, packed = 4, socket.inet_pton(socket.AF_INET, address)
+        except OSError:
+            return False
+
+        value = int.from_bytes(packed)
+        for prefixVersion, mask, values in self._prefixes:
+            if prefixVersion == version and value & mask in values:
+                return True
+
+        return False
 
 class AddressFilter():
-    """Maintain a list of allowed IPs and domains."""
-    def __init__(self, addresses):
-        self._addressSet: set = set()
-        self._addressMap: dict = {}
+    """Maintain a list of allowed IPs, networks and domains."""
+    def __init__(self, addresses, resolver=None):
+        self._resolver: DnsResolver = resolver or DnsResolver()
+        self._staticAddresses: set = set()
+        self._staticNetworks: set = set()
+        self._domains: dict = {}
+        self._refreshTimes: dict = {}
+        self._dynamicAddresses: dict = {}
+        self._snapshot: AddressSnapshot = AddressSnapshot()
         self.initialized: asyncio.Event = asyncio.Event()
 
         for address in addresses:
-            if _isIP(address):
-                self._addressSet.add(address)
+            address = address.strip()
+            if not address:
+                continue
+
+            network = _parseNetwork(address)
+            if network is None:
+                self._domains[address.lower()] = frozenset()
+                self._refreshTimes[address.lower()] = 0
+            elif network.num_addresses == 1:
+                self._staticAddresses.add(str(network.network_address))
             else:
-                self._addressMap[address] = None
+                self._staticNetworks.add(network)
+
+        self._rebuild()
+        if not self._domains:
+            self.initialized.set()
 
     async def run(self):
-        """Retrieve domain IP addresses every RESOLVE_INTERVAL seconds."""
-        while self._addressMap:
-            await self.resolveDomains()
-            await asyncio.sleep(RESOLVE_INTERVAL)
-
-    async def resolveDomains(self):
-        """Query DNS for the current IP of each domain in _addressMap and update their value."""
-        # Run queries in a thread pool to prevent blocking.
-        loop = asyncio.get_running_loop()
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers=5)
-        futures = [loop.run_in_executor(executor, _updateHostname, domainName) for domainName in self._addressMap.keys()]
-        results = await asyncio.gather(*futures)
-
-        for domainName, address in results:
-            self._addressMap[domainName] = address
+        """Refresh each domain as its DNS records expire."""
+        while self._domains:
+            now = time.monotonic()
+            due = [domainName for domainName, refreshTime in self._refreshTimes.items() if refreshTime <= now]
+            if due:
+                await self.resolveDomains(due)
+
+            await asyncio.sleep(max(0, min(self._refreshTimes.values()) - time.monotonic()))
+
+    async def resolveDomains(self, domainNames=None):
+        """Query DNS for every address of each domain and schedule the next refresh from the record TTLs."""
+        domainNames = list(domainNames or self._domains.keys())
+        results = await asyncio.gather(*[self._resolver.resolveAddresses(domainName) for domainName in domainNames], return_exceptions=True)
+
+        changed = False
+        now = time.monotonic()
+        for domainName, records in zip(domainNames, results):
+            # Keep the last known addresses of a domain that failed to resolve
+            if isinstance(records, Exception) or not records:
+                self._refreshTimes[domainName] = now + RETRY_INTERVAL
+                continue
+            elif isinstance(records, BaseException):
+                raise records
+
+            addresses = frozenset(str(ip_address(record.data)) for record in records)
+            ttl = min(record.ttl for record in records)
+            self._refreshTimes[domainName] = now + min(max(ttl, MIN_REFRESH_INTERVAL), MAX_REFRESH_INTERVAL)
+
+            if addresses != self._domains[domainName]:
+                self._domains[domainName] = addresses
+                changed = True
+
+        # Only publish a new snapshot when the resolved addresses actually changed
+        if changed:
+            self._rebuild()
 
         self.initialized.set()
 
+    def setDynamic(self, source, addresses):
+        """Replace the set of IPs allowed on behalf of a dynamic source (e.g. registered handsets)."""
+        addresses = frozenset(addresses)
+        if addresses != self._dynamicAddresses.get(source):
+            self._dynamicAddresses[source] = addresses
+            self._rebuild()
+
+    def allowed(self, address):
+        """Return whether the IP is allowed, using the current snapshot."""
+        return self._snapshot.contains(address)
+
     def getAddresses(self):
-        """Return a list of IPs in _addressSet and _addressMap."""
-        result = self._addressSet.copy()
-        for address in self._addressMap.values():
-            if (address):
-                result.add(address)
-
-        return result
-    
-def _updateHostname(domainName):
-    """Helper method to return the domainName and the result of its DNS query."""
-    return domainName, socket.gethostbyname(domainName)
-
-def _isIP(address):
-    """Crude helper method to determine if the address is an IP."""
-    return address.replace('.', '').isnumeric()
\ No newline at end of file
+        """Return the set of individually allowed IPs (excluding networks)."""
+        return self._snapshot.addresses
+
+    def _rebuild(self):
+        """Publish a new snapshot from the static entries, resolved domains and dynamic sources."""
+        addresses = set(self._staticAddresses)
+        for domainAddresses in self._domains.values():
+            addresses.update(domainAddresses)
+        for dynamicAddresses in self._dynamicAddresses.values():
+            addresses.update(dynamicAddresses)
+
+        self._snapshot = AddressSnapshot(addresses, self._staticNetworks)
+
+def _parseNetwork(address):
+    """Helper method to parse an IP address or CIDR prefix, returning None for domain names."""
+    try:
+        return ip_network(address, strict=False)
+    except ValueError:
+        return None
@@ -0,0 +1,95 @@
+import asyncio
+import bisect
+import itertools
+import time
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from enum import Enum
+
+DEFAULT_PRIORITY = 2
+
+class Orderings(Enum):
+    """Enum class of the orders in which waiting callers are served."""
+    FIFO = 'fifo'
+    PRIORITY = 'priority'
+
+@dataclass
+class Ticket:
+    """Data class representing a caller waiting for the line."""
+    caller: object
+    priority: int
+    onPosition: Callable = None
+    enqueuedAt: float = field(default_factory=time.monotonic)
+    future: asyncio.Future = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+
+class CallQueue():
+    """Queue callers while the line is busy, handing the line to the next waiter as soon as the current session ends."""
+    def __init__(self, depth=0, ordering=Orderings.FIFO):
+        self.depth: int = depth
+        self.ordering: Orderings = ordering
+        # Waiters sorted by (priority, arrival), lower values are served first
+        self._waiters: list = []
+        self._arrivals = itertools.count()
+        # Waiter the line was handed to, holding it until its session ends
+        self.reserved: Ticket = None
+        self.counters: dict = {'served': 0, 'abandoned': 0, 'rejected': 0}
+        self._totalWait: float = 0
+
+    def enqueue(self, caller, priority=DEFAULT_PRIORITY, onPosition=None):
+        """Add a caller to the queue, returning its ticket or None if the queue is full."""
+        if len(self._waiters) >= self.depth:
+            self.counters['rejected'] += 1
+            return None
+
+        ticket = Ticket(caller, priority if self.ordering == Orderings.PRIORITY else DEFAULT_PRIORITY, onPosition)
+        entry = (ticket.priority, next(self._arrivals), ticket)
+        bisect.insort(self._waiters, entry, key=lambda entry: entry[:2])
+        self._notifyPositions(self._waiters.index(entry))
+        return ticket
+
+    async def wait(self, ticket):
+        """Wait until the line is handed to the ticket's caller. Returns False if the caller left the queue first."""
+        return await ticket.future
+
+    def remove(self, caller):
+        """Remove a waiting caller from the queue, returning whether it was waiting."""
+        for index, (_, _, ticket) in enumerate(self._waiters):
+            if ticket.caller == caller:
+                del self._waiters[index]
+                self.counters['abandoned'] += 1
+                ticket.future.set_result(False)
+                self._notifyPositions(index)
+                return True
+
+        return False
+
+    def handoff(self):
+        """Release the line, handing it to the next waiter if there is one."""
+        self.reserved = None
+        while self._waiters:
+            _, _, ticket = self._waiters.pop(0)
+            # Skip waiters that gave up without leaving the queue
+            if ticket.future.done():
+                continue
+
+            self.reserved = ticket
+            self.counters['served'] += 1
+            self._totalWait += time.monotonic() - ticket.enqueuedAt
+            ticket.future.set_result(True)
+            self._notifyPositions(0)
+            break
+
+    def waiting(self):
+        """Return the number of callers waiting for the line."""
+        return len(self._waiters)
+
+    def stats(self):
+        """Return the queue length along with served, abandoned and rejected callers and the mean wait (seconds) of served callers."""
+        served = self.counters['served']
+        return dict(self.counters, waiting=len(self._waiters), meanWait=self._totalWait / served if served else None)
+
+    def _notifyPositions(self, start):
+        """Helper method to tell every waiter from the start index onward its (1-based) position in the queue."""
+        for position, (_, _, ticket) in enumerate(self._waiters[start:], start + 1):
+            if ticket.onPosition:
+                ticket.onPosition(position)
@@ -1,3 +1,6 @@
+# 1st Party
+from Sip.admission import OverloadResponses
+
 # Standard Library
 from configparser import ConfigParser
 from aiohttp import ClientSession
@@ -12,6 +15,17 @@ REQUIRED_FIELDS = {
     'Timezone': ['UtcOffset']
 }
 IP_DISCOVERY_ENDPOINT = 'https://checkip.amazonaws.com/'
+DEFAULT_FLOOD_SOURCE_RATE = 5
+DEFAULT_FLOOD_GLOBAL_RATE = 50
+DEFAULT_FLOOD_OVERLOAD_RESPONSE = '503'
+DEFAULT_REGISTRAR_REALM = 'redtelephone'
+DEFAULT_SIP_TRANSPORT = 'udp'
+DEFAULT_QUEUE_DEPTH = 0
+DEFAULT_QUEUE_ORDERING = 'fifo'
+DEFAULT_METRICS_HOST = '127.0.0.1'
+DEFAULT_GATEWAY_ENCODING = 'json'
+DEFAULT_CALL_TRIGGER = 'mention'
+DEFAULT_SHARD_COUNT = 'auto'
 
 class Config():
     """Manage user configurable settings."""
@@ -19,15 +33,34 @@ class Config():
         self.publicIP: str = None
         self.voipAddress: str = None
         self.voipAllowList: list = []
+        self.voipForkAddresses: list = []
+        self.voipTransport: str = None
         self.discordBotToken: str = None
         self.discordGuildID: str = None
         self.discordVoiceChannelID: str = None
         self.discordTextChannelID: str = None
+        self.discordGatewayEncoding: str = None
+        self.discordCallTrigger: str = None
+        self.discordShardCount: int = None
+        self.discordSessionFile: str = None
+        self.discordVoiceStandby: bool = None
         self.welcomeMessage: str = None
         self.incomingCallMessage: str = None
         self.utcOffset: int = None
         self.hourlyCallLimit: int = None
         self.doNotDisturbTimes: list = []
+        self.floodSourceRate: float = None
+        self.floodGlobalRate: float = None
+        self.floodOverloadResponse: str = None
+        self.registrarRealm: str = None
+        self.registrarAccounts: dict = {}
+        self.dialPlanRoutes: dict = {}
+        self.queueDepth: int = None
+        self.queueOrdering: str = None
+        self.queueRingback: bool = None
+        self.traceFile: str = None
+        self.metricsPort: int = None
+        self.metricsHost: str = None
 
     async def load(self, filename=DEFAULT_CONFIG_FILE):
         """Load configuration file values into object properties."""
@@ -50,22 +83,52 @@ class Config():
         self.publicIP = config.get('Server', 'PublicIP')
         self.voipAddress = config.get('VoIP', 'Address')
         self.voipAllowList = config.getcsv('VoIP', 'AllowList')
+        self.voipForkAddresses = [address.strip() for address in config.getcsv('VoIP', 'ForkAddresses', fallback='')]
+        self.voipTransport = config.get('VoIP', 'Transport', fallback=DEFAULT_SIP_TRANSPORT).lower()
         self.discordBotToken = config.get('Discord', 'BotToken')
         self.discordGuildID = config.get('Discord', 'HomeGuildID')
         self.discordVoiceChannelID = config.get('Discord', 'HomeVoiceChannelID')
         self.discordTextChannelID = config.get('Discord', 'HomeTextChannelID')
+        self.discordGatewayEncoding = config.get('Discord', 'GatewayEncoding', fallback=DEFAULT_GATEWAY_ENCODING).lower()
+        self.discordCallTrigger = config.get('Discord', 'CallTrigger', fallback=DEFAULT_CALL_TRIGGER).lower()
+        shardCount = config.get('Discord', 'ShardCount', fallback=DEFAULT_SHARD_COUNT).lower()
+        self.discordShardCount = None if shardCount == 'auto' else int(shardCount)
+        self.discordSessionFile = config.get('Discord', 'SessionFile', fallback='') or None
+        self.discordVoiceStandby = config.getboolean('Discord', 'VoiceStandby', fallback=False)
         self.welcomeMessage = config.get('Messages', 'Welcome')
         self.incomingCallMessage = config.get('Messages', 'IncomingCall')
         self.utcOffset = config.getint('Timezone', 'UtcOffset')
         self.hourlyCallLimit = config.getint('Call Preferences', 'HourlyCallLimit', fallback=0)
         self.doNotDisturbTimes = config.getlist('Call Preferences', 'DoNotDisturb')
+        self.floodSourceRate = config.getfloat('Flood Protection', 'SourceRate', fallback=DEFAULT_FLOOD_SOURCE_RATE)
+        self.floodGlobalRate = config.getfloat('Flood Protection', 'GlobalRate', fallback=DEFAULT_FLOOD_GLOBAL_RATE)
+        self.floodOverloadResponse = config.get('Flood Protection', 'OverloadResponse', fallback=DEFAULT_FLOOD_OVERLOAD_RESPONSE).lower()
+        if self.floodOverloadResponse not in [response.value for response in OverloadResponses]:
+            raise Exception(f'Invalid parameter "OverloadResponse" in [Flood Protection] section in config.ini: expected one of '
+                            f'{", ".join(response.value for response in OverloadResponses)}, got "{self.floodOverloadResponse}"')
+        self.registrarRealm = config.get('Registrar', 'Realm', fallback=DEFAULT_REGISTRAR_REALM)
+        self.registrarAccounts = config.getlist('Registrar', 'Accounts', fallback={}) or {}
+        self.dialPlanRoutes = config.getlist('Dial Plan', 'Routes', fallback={}) or {}
+        self.queueDepth = config.getint('Call Queue', 'Depth', fallback=DEFAULT_QUEUE_DEPTH)
+        self.queueOrdering = config.get('Call Queue', 'Ordering', fallback=DEFAULT_QUEUE_ORDERING).lower()
+        self.queueRingback = config.getboolean('Call Queue', 'Ringback', fallback=True)
+        self.traceFile = config.get('Diagnostics', 'TraceFile', fallback='') or None
+        self.metricsPort = config.getint('Diagnostics', 'MetricsPort', fallback=0) or None
+        self.metricsHost = config.get('Diagnostics', 'MetricsHost', fallback=DEFAULT_METRICS_HOST)
 
         # Retrieve public IP if field set to "auto"
         if self.publicIP == 'auto':
             self.publicIP = await self._getPublicIP()
 
-        # Allow list includes the VoIP phone address by default
-        self.voipAllowList.append(self.voipAddress)
+        # Allow list includes the VoIP phone address and forked handsets by default, registrar usernames are allowed once registered instead
+        for address in [self.voipAddress, *self.voipForkAddresses]:
+            host = address.rsplit(':', 1)[0] if address.count(':') == 1 else address
+            if host not in self.registrarAccounts:
+                self.voipAllowList.append(host)
+
+        # Every dialed number reaches the home channels unless a dial plan is configured
+        if not self.dialPlanRoutes:
+            self.dialPlanRoutes = {'*': [self.discordGuildID, self.discordVoiceChannelID, self.discordTextChannelID]}
 
         # Convert falsey int of 0 to None
         if not self.hourlyCallLimit:
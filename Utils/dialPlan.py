@@ -0,0 +1,86 @@
+from dataclasses import dataclass
+
+WILDCARD_DIGIT = 'X'
+WILDCARD_SUFFIX = '*'
+# Stand-ins for any digit, and any character, that does not appear literally in the patterns
+_OTHER_DIGIT = object()
+_OTHER_CHAR = object()
+
+@dataclass(frozen=True)
+class Route:
+    """Data class representing the Discord channels a dialed number is routed to."""
+    guildID: str
+    voiceChannelID: str
+    textChannelID: str
+
+class _State():
+    """A state of the compiled dial plan automaton."""
+    __slots__ = ('transitions', 'anyDigit', 'anyChar', 'route')
+
+    def __init__(self):
+        self.transitions: dict = {}
+        self.anyDigit: _State = None
+        self.anyChar: _State = None
+        self.route: Route = None
+
+class DialPlan():
+    """Route dialed numbers to Discord channels. Patterns are exact numbers, may use X to match any single digit and may end with * to match any suffix."""
+    def __init__(self, routes):
+        self.patterns: dict = dict(routes)
+        self._start: _State = self._compile(list(self.patterns.items()))
+
+    def lookup(self, number):
+        """Return the route of the most specific pattern matching the number, or None if it matches no pattern."""
+        state = self._start
+        for char in number:
+            state = state.transitions.get(char) or (state.anyDigit if char.isdigit() else state.anyChar)
+            if state is None:
+                return None
+
+        return state.route
+
+    @staticmethod
+    def _compile(patterns):
+        """Compile the patterns into a deterministic prefix trie, so a lookup visits a single state per dialed character."""
+        # An exact match beats a wildcard match, then the pattern with the most literal characters, then configuration order
+        ranks = [(pattern.endswith(WILDCARD_SUFFIX), WILDCARD_DIGIT in pattern, -sum(char not in (WILDCARD_DIGIT, WILDCARD_SUFFIX) for char in pattern), order)
+                 for order, (pattern, _) in enumerate(patterns)]
+        literals = {char for pattern, _ in patterns for char in pattern if char not in (WILDCARD_DIGIT, WILDCARD_SUFFIX)}
+
+        def advance(positions, char):
+            """Return the pattern positions reached by consuming a character."""
+            reached = set()
+            for index, position in positions:
+                pattern = patterns[index][0]
+                if position == len(pattern):
+                    continue
+                token = pattern[position]
+                if token == WILDCARD_SUFFIX:
+                    reached.add((index, position))
+                elif token == char or token == WILDCARD_DIGIT and (char is _OTHER_DIGIT or isinstance(char, str) and char.isdigit()):
+                    reached.add((index, position + 1))
+            return frozenset(reached)
+
+        # Subset construction, each state is the set of (pattern, position) pairs still able to match
+        states = {}
+        def build(positions):
+            if positions in states:
+                return states[positions]
+
+            state = states[positions] = _State()
+            accepted = [index for index, position in positions
+                        if position == len(patterns[index][0]) or patterns[index][0][position] == WILDCARD_SUFFIX]
+            if accepted:
+                state.route = patterns[min(accepted, key=lambda index: ranks[index])][1]
+
+            for char, attribute in ((_OTHER_DIGIT, 'anyDigit'), (_OTHER_CHAR, 'anyChar')):
+                nextPositions = advance(positions, char)
+                if nextPositions:
+                    setattr(state, attribute, build(nextPositions))
+            for char in literals:
+                nextPositions = advance(positions, char)
+                if nextPositions:
+                    state.transitions[char] = build(nextPositions)
+            return state
+
+        return build(frozenset((index, 0) for index in range(len(patterns))))
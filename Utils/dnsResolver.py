@@ -0,0 +1,377 @@
+# Standard Library
+import asyncio
+import socket
+import random
+import struct
+import time
+from dataclasses import dataclass, replace
+from enum import IntEnum
+from typing import Any
+
+RESOLV_CONF = '/etc/resolv.conf'
+DNS_PORT = 53
+QUERY_TIMEOUT = 2
+QUERY_ATTEMPTS = 2
+# TTL assigned to results from the system resolver, which does not expose record TTLs
+SYSTEM_RESOLVER_TTL = 300
+# Negative TTL used when a response lacks an SOA record
+DEFAULT_NEGATIVE_TTL = 60
+MAX_CNAME_DEPTH = 8
+MAX_CACHE_ENTRIES = 1024
+MAX_POINTER_JUMPS = 64
+
+HEADER_FORMAT = '!HHHHHH'
+HEADER_SIZE = 12
+FLAG_RECURSION_DESIRED = 0x0100
+FLAG_TRUNCATED = 0x0200
+CLASS_IN = 1
+
+class RecordTypes(IntEnum):
+    """Enum class of supported DNS record types."""
+    A = 1
+    CNAME = 5
+    SOA = 6
+    AAAA = 28
+    SRV = 33
+    NAPTR = 35
+
+class ResponseCodes(IntEnum):
+    """Enum class of DNS response codes."""
+    NOERROR = 0
+    FORMERR = 1
+    SERVFAIL = 2
+    NXDOMAIN = 3
+    NOTIMP = 4
+    REFUSED = 5
+
+class DnsError(Exception):
+    """Indicates a DNS query could not be answered."""
+    pass
+
+@dataclass(frozen=True)
+class Record:
+    """Data class representing a single resource record."""
+    name: str
+    type: int
+    ttl: int
+    data: Any
+
+@dataclass(frozen=True)
+class SrvData:
+    """Data class representing the data of an SRV record (RFC 2782)."""
+    priority: int
+    weight: int
+    port: int
+    target: str
+
+@dataclass(frozen=True)
+class NaptrData:
+    """Data class representing the data of a NAPTR record (RFC 3403)."""
+    order: int
+    preference: int
+    flags: str
+    service: str
+    regexp: str
+    replacement: str
+
+@dataclass(frozen=True)
+class Answer:
+    """Data class representing the records answering a query. TTL holds the negative caching TTL when no records exist."""
+    records: tuple
+    rcode: ResponseCodes
+    ttl: int
+
+class DnsResolver():
+    """Minimal asynchronous stub resolver that returns every record of a query along with its TTL, caching answers until they expire."""
+    def __init__(self, nameservers=None):
+        self.nameservers: list = nameservers if nameservers is not None else _readNameservers()
+        # Maps (name, record type) to the expiry time of the cached answer and the answer itself. Includes negative answers.
+        self._cache: dict = {}
+        # Queries in flight, shared by concurrent callers asking the same question
+        self._pending: dict = {}
+        self.counters: dict = {'hits': 0, 'misses': 0, 'coalesced': 0}
+
+    async def query(self, name, recordType):
+        """Return the records of the specified type from the cache, or query the nameservers if they are not cached."""
+        key = (name.rstrip('.').lower(), recordType)
+        now = time.monotonic()
+        cached = self._cache.get(key)
+        if cached and cached[0] > now:
+            self.counters['hits'] += 1
+            return _withRemainingTTL(cached[1], int(cached[0] - now))
+
+        pending = self._pending.get(key)
+        if pending:
+            self.counters['coalesced'] += 1
+        else:
+            self.counters['misses'] += 1
+            pending = self._pending[key] = asyncio.ensure_future(self._lookup(key, name, recordType))
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+
+        # Shielded so a cancelled caller does not cancel the query for everyone else
+        return await asyncio.shield(pending)
+
+    def stats(self):
+        """Return cache hit, miss and coalesced query counts along with the cache size."""
+        return dict(self.counters, entries=len(self._cache))
+
+    async def _lookup(self, key, name, recordType):
+        """Query the nameservers and cache the answer for its TTL. Failures are not cached."""
+        answer = await self._queryNameservers(name, recordType)
+        if answer.ttl > 0:
+            if len(self._cache) >= MAX_CACHE_ENTRIES:
+                self._evict()
+            self._cache[key] = (time.monotonic() + answer.ttl, answer)
+
+        return answer
+
+    def _evict(self):
+        """Remove expired answers, or the oldest answer if none have expired."""
+        now = time.monotonic()
+        for key in [key for key, (expiresAt, _) in self._cache.items() if expiresAt <= now]:
+            del self._cache[key]
+
+        if len(self._cache) >= MAX_CACHE_ENTRIES:
+            del self._cache[next(iter(self._cache))]
+
+    async def _queryNameservers(self, name, recordType):
+        """Query the configured nameservers for records of the specified type, following CNAME chains."""
+        if not self.nameservers:
+            return await self._querySystem(name, recordType)
+
+        lastError = None
+        for _ in range(QUERY_ATTEMPTS):
+            for nameserver in self.nameservers:
+                try:
+                    response = await self._queryUDP(nameserver, name, recordType)
+                    if _parseHeader(response)[1] & FLAG_TRUNCATED:
+                        response = await self._queryTCP(nameserver, name, recordType)
+                    return _parseAnswer(response, name, recordType)
+                except (OSError, TimeoutError, EOFError, DnsError) as e:
+                    lastError = e
+
+        raise DnsError(f'Failed to resolve {name}: {lastError}')
+
+    async def resolveAddresses(self, name):
+        """Return every A and AAAA record of the specified name."""
+        answers = await asyncio.gather(self.query(name, RecordTypes.A), self.query(name, RecordTypes.AAAA), return_exceptions=True)
+        records = []
+        for answer in answers:
+            if isinstance(answer, Answer):
+                records.extend(answer.records)
+
+        if not records and all(isinstance(answer, Exception) for answer in answers):
+            raise answers[0]
+
+        return records
+
+    async def _queryUDP(self, nameserver, name, recordType):
+        """Send a query to the nameserver over UDP and return the raw response."""
+        query = _buildQuery(random.getrandbits(16), name, recordType)
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(lambda: _QueryProtocol(query), remote_addr=(nameserver, DNS_PORT))
+        try:
+            transport.sendto(query)
+            async with asyncio.timeout(QUERY_TIMEOUT):
+                return await protocol.response
+        finally:
+            transport.close()
+
+    async def _queryTCP(self, nameserver, name, recordType):
+        """Send a query to the nameserver over TCP and return the raw response."""
+        query = _buildQuery(random.getrandbits(16), name, recordType)
+        async with asyncio.timeout(QUERY_TIMEOUT):
+            reader, writer = await asyncio.open_connection(nameserver, DNS_PORT)
+            try:
+                writer.write(struct.pack('!H', len(query)) + query)
+                length, = struct.unpack('!H', await reader.readexactly(2))
+                response = await reader.readexactly(length)
+            finally:
+                writer.close()
+
+        if not _matchesQuery(response, query):
+            raise DnsError('Response does not match the query.')
+        return response
+
+    async def _querySystem(self, name, recordType):
+        """Fall back to the system resolver when no nameservers are configured."""
+        family = {RecordTypes.A: socket.AF_INET, RecordTypes.AAAA: socket.AF_INET6}.get(recordType)
+        if family is None:
+            raise DnsError(f'Record type {recordType} unsupported by the system resolver.')
+
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.getaddrinfo(name, None, family=family, type=socket.SOCK_DGRAM)
+        except socket.gaierror:
+            return Answer((), ResponseCodes.NXDOMAIN, DEFAULT_NEGATIVE_TTL)
+
+        addresses = dict.fromkeys(sockaddr[0] for *_, sockaddr in results)
+        records = tuple(Record(name, recordType, SYSTEM_RESOLVER_TTL, address) for address in addresses)
+        return Answer(records, ResponseCodes.NOERROR, SYSTEM_RESOLVER_TTL if records else DEFAULT_NEGATIVE_TTL)
+
+class _QueryProtocol(asyncio.DatagramProtocol):
+    """Datagram protocol resolving a future with the first response from the nameserver matching the query, other datagrams are dropped."""
+    def __init__(self, query):
+        self.query: bytes = query
+        self.nameserver: tuple = None
+        self.response: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.nameserver = transport.get_extra_info('peername')
+
+    def datagram_received(self, data, addr):
+        if addr == self.nameserver and _matchesQuery(data, self.query) and not self.response.done():
+            self.response.set_result(data)
+
+    def error_received(self, e):
+        if not self.response.done():
+            self.response.set_exception(e)
+
+def _readNameservers(filename=RESOLV_CONF):
+    """Helper method to read nameserver addresses from resolv.conf."""
+    nameservers = []
+    try:
+        with open(filename) as file:
+            for line in file:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    nameservers.append(fields[1])
+    except OSError:
+        pass
+
+    return nameservers
+
+def _buildQuery(queryID, name, recordType):
+    """Helper method to encode a recursive query for a single question."""
+    header = struct.pack(HEADER_FORMAT, queryID, FLAG_RECURSION_DESIRED, 1, 0, 0, 0)
+    return header + _encodeName(name) + struct.pack('!HH', recordType, CLASS_IN)
+
+def _encodeName(name):
+    """Helper method to encode a domain name as a sequence of length prefixed labels."""
+    encoded = b''
+    for label in name.rstrip('.').split('.'):
+        if label:
+            encoded += bytes([len(label)]) + label.encode('idna')
+
+    return encoded + b'\x00'
+
+def _decodeName(data, offset):
+    """Helper method to decode a (possibly compressed) domain name. Returns the name and the offset following it."""
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = data[offset]
+        # Compression pointer
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > MAX_POINTER_JUMPS:
+                raise DnsError('Compression loop in response.')
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+        elif length == 0:
+            offset += 1
+            break
+        else:
+            labels.append(data[offset + 1:offset + 1 + length].decode('ascii', errors='replace'))
+            offset += 1 + length
+
+    return '.'.join(labels), end if end is not None else offset
+
+def _decodeCharacterString(data, offset):
+    """Helper method to decode a length prefixed character string. Returns the string and the offset following it."""
+    length = data[offset]
+    return data[offset + 1:offset + 1 + length].decode('ascii', errors='replace'), offset + 1 + length
+
+def _withRemainingTTL(answer, ttl):
+    """Helper method to copy a cached answer with its TTLs reduced to the time remaining until it expires."""
+    return Answer(tuple(replace(record, ttl=min(record.ttl, ttl)) for record in answer.records), answer.rcode, ttl)
+
+def _parseHeader(data):
+    """Helper method to unpack the fixed size message header."""
+    try:
+        return struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+    except struct.error as e:
+        raise DnsError(f'Malformed response: {e}')
+
+def _matchesQuery(data, query):
+    """Helper method to check that a response carries the query's ID and echoes its question. Names compare case insensitively."""
+    question = query[HEADER_SIZE:]
+    return (len(data) >= HEADER_SIZE + len(question) and data[:2] == query[:2] and data[4:6] == query[4:6]
+            and data[HEADER_SIZE:HEADER_SIZE + len(question)].lower() == question.lower())
+
+def _parseRecordData(data, offset, length, recordType):
+    """Helper method to decode the data of a record, returning None for unsupported types."""
+    match recordType:
+        case RecordTypes.A:
+            return socket.inet_ntop(socket.AF_INET, data[offset:offset + length])
+        case RecordTypes.AAAA:
+            return socket.inet_ntop(socket.AF_INET6, data[offset:offset + length])
+        case RecordTypes.CNAME:
+            return _decodeName(data, offset)[0]
+        case RecordTypes.SRV:
+            priority, weight, port = struct.unpack('!HHH', data[offset:offset + 6])
+            return SrvData(priority, weight, port, _decodeName(data, offset + 6)[0].lower())
+        case RecordTypes.NAPTR:
+            order, preference = struct.unpack('!HH', data[offset:offset + 4])
+            offset += 4
+            flags, offset = _decodeCharacterString(data, offset)
+            service, offset = _decodeCharacterString(data, offset)
+            regexp, offset = _decodeCharacterString(data, offset)
+            return NaptrData(order, preference, flags.lower(), service.upper(), regexp, _decodeName(data, offset)[0].lower())
+        case RecordTypes.SOA:
+            _, offset = _decodeName(data, offset)
+            _, offset = _decodeName(data, offset)
+            # Negative caching TTL is held in the MINIMUM field
+            return struct.unpack('!IIIII', data[offset:offset + 20])[4]
+        case _:
+            return None
+
+def _parseAnswer(data, name, recordType):
+    """Helper method to extract the records of the requested type from a response, raising DnsError if it is malformed or an error."""
+    _, flags, qdCount, anCount, nsCount, _ = _parseHeader(data)
+    rcode = flags & 0x000F
+    if rcode not in (ResponseCodes.NOERROR, ResponseCodes.NXDOMAIN):
+        reason = ResponseCodes(rcode).name if rcode <= max(ResponseCodes) else f'rcode {rcode}'
+        raise DnsError(f'Nameserver responded with {reason}.')
+
+    try:
+        return _parseRecords(data, name, recordType, ResponseCodes(rcode), qdCount, anCount + nsCount)
+    except (struct.error, IndexError, ValueError) as e:
+        raise DnsError(f'Malformed response: {e}')
+
+def _parseRecords(data, name, recordType, rcode, qdCount, rrCount):
+    """Helper method to collect the records of the requested type, following CNAME chains."""
+    offset = HEADER_SIZE
+    for _ in range(qdCount):
+        _, offset = _decodeName(data, offset)
+        offset += 4
+
+    # Collect answer and authority records
+    records = []
+    for _ in range(rrCount):
+        recordName, offset = _decodeName(data, offset)
+        rType, rClass, ttl, length = struct.unpack('!HHIH', data[offset:offset + 10])
+        offset += 10
+        value = _parseRecordData(data, offset, length, rType)
+        offset += length
+        if value is not None:
+            records.append(Record(recordName.lower(), rType, ttl, value))
+
+    # Follow CNAMEs from the queried name to the canonical name
+    target = name.rstrip('.').lower()
+    for _ in range(MAX_CNAME_DEPTH):
+        alias = next((r.data for r in records if r.type == RecordTypes.CNAME and r.name == target), None)
+        if alias is None:
+            break
+        target = alias.lower()
+
+    matches = tuple(r for r in records if r.type == recordType and r.name == target)
+    if matches:
+        return Answer(matches, rcode, min(r.ttl for r in matches))
+
+    # Negative caching TTL is the lesser of the SOA TTL and its MINIMUM field (RFC 2308 Section 5)
+    soa = next((r for r in records if r.type == RecordTypes.SOA), None)
+    negativeTTL = min(soa.ttl, soa.data) if soa else DEFAULT_NEGATIVE_TTL
+    return Answer((), rcode, negativeTTL)
@@ -1,8 +1,13 @@
 from collections import defaultdict
 import asyncio
 
+from Utils import metrics
+
 class EventHandler:
     """Handle listeners and dispatching of events."""
+    # Dispatched listener tasks that have not finished, referenced so they are not garbage collected mid-run
+    _pending: set = set()
+
     def __init__(self):
         self.events: dict = defaultdict(list)
 
@@ -10,6 +15,10 @@ class EventHandler:
         """Register an event listener."""
         self.events[eventName].append(callback)
 
+    def hasListener(self, eventName):
+        """Return whether any listener is registered for the event."""
+        return eventName in self.events
+
     def event(self, func):
         """Register an event listener through a function decorator."""
         async def wrapper(*args, **kwargs):
@@ -27,7 +36,11 @@ class EventHandler:
             for callback in self.events[eventName]:
                 # Run asynchronous code as task
                 if asyncio.iscoroutinefunction(callback):
-                    asyncio.create_task(callback(*args))
+                    task = asyncio.create_task(callback(*args))
+                    EventHandler._pending.add(task)
+                    task.add_done_callback(EventHandler._pending.discard)
                 # Run synchronous code normally
                 else:
-                    callback(*args)
\ No newline at end of file
+                    callback(*args)
+
+metrics.registry.gauge('redtelephone_event_dispatch_pending', 'Dispatched event listeners that have not finished.', function=lambda: len(EventHandler._pending))
@@ -0,0 +1,266 @@
+import asyncio
+import bisect
+import math
+import re
+from collections.abc import Callable
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+REQUEST_TIMEOUT = 5
+_INVALID_NAME_CHARS = re.compile(r'[^a-zA-Z0-9_]')
+
+class _CounterValue():
+    """A single counter time series."""
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value: float = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class _GaugeValue():
+    """A single gauge time series."""
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value: float = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+class _HistogramValue():
+    """A single histogram time series. Bucket counts are kept per bucket and accumulated when rendered."""
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets: tuple = buckets
+        self.counts: list = [0] * (len(buckets) + 1)
+        self.sum: float = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+class Metric():
+    """A metric family, unlabelled or with a time series per combination of label values. Recording takes no locks, it only ever runs on the event loop."""
+    TYPE = 'untyped'
+
+    def __init__(self, name, help, labelNames=()):
+        self.name: str = name
+        self.help: str = help
+        self.labelNames: tuple = tuple(labelNames)
+        self._children: dict = {}
+        # Unlabelled metrics record straight into their only time series
+        if not self.labelNames:
+            self._default = self._children[()] = self._newValue()
+
+    def labels(self, *labelValues):
+        """Return the time series of the label values, callers on a hot path should keep a reference to it."""
+        key = tuple(str(value) for value in labelValues)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelNames):
+                raise ValueError(f'{self.name} expects labels {self.labelNames}')
+            child = self._children[key] = self._newValue()
+
+        return child
+
+    def samples(self):
+        """Yield the (name suffix, labels, value) samples of every time series."""
+        for key, child in list(self._children.items()):
+            yield '', dict(zip(self.labelNames, key)), child.value
+
+    def _newValue(self):
+        raise NotImplementedError
+
+class Counter(Metric):
+    """A monotonically increasing count."""
+    TYPE = 'counter'
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+    def _newValue(self):
+        return _CounterValue()
+
+class Gauge(Metric):
+    """A value that may go up and down, or be read from a function when scraped."""
+    TYPE = 'gauge'
+
+    def __init__(self, name, help, labelNames=(), function=None):
+        super().__init__(name, help, labelNames)
+        self.function: Callable = function
+
+    def set(self, value):
+        self._default.value = value
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+    def dec(self, amount=1):
+        self._default.value -= amount
+
+    def samples(self):
+        if self.function:
+            yield '', {}, self.function()
+        else:
+            yield from super().samples()
+
+    def _newValue(self):
+        return _GaugeValue()
+
+class Histogram(Metric):
+    """Observations counted into cumulative buckets, along with their sum and count."""
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets: tuple = tuple(sorted(buckets))
+        super().__init__(name, help, labelNames)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            labels = dict(zip(self.labelNames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                yield '_bucket', labels | {'le': _formatValue(bound)}, cumulative
+            yield '_sum', labels, child.sum
+            yield '_count', labels, cumulative
+
+    def _newValue(self):
+        return _HistogramValue(self.buckets)
+
+class Registry():
+    """Hold the process's metrics and render them in the Prometheus text exposition format."""
+    def __init__(self):
+        self._metrics: dict = {}
+        self._collectors: dict = {}
+
+    def counter(self, name, help, labelNames=()):
+        """Return the named counter, registering it on first use."""
+        return self._register(Counter, name, help, labelNames)
+
+    def gauge(self, name, help, labelNames=(), function=None):
+        """Return the named gauge, registering it on first use. A function gauge is read when scraped."""
+        gauge = self._register(Gauge, name, help, labelNames)
+        gauge.function = function or gauge.function
+        return gauge
+
+    def histogram(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        """Return the named histogram, registering it on first use."""
+        return self._register(Histogram, name, help, labelNames, buckets=buckets)
+
+    def collector(self, name, help, statsFunction):
+        """Export the numeric values of an existing stats() dictionary as a gauge, labelled by their (dotted) key."""
+        self._collectors[name] = (help, statsFunction)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f'# HELP {metric.name} {_escapeHelp(metric.help)}')
+            lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            for suffix, labels, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{_formatLabels(labels)} {_formatValue(value)}')
+
+        for name, (help, statsFunction) in list(self._collectors.items()):
+            lines.append(f'# HELP {name} {_escapeHelp(help)}')
+            lines.append(f'# TYPE {name} gauge')
+            for key, value in _flatten(statsFunction()):
+                lines.append(f'{name}{_formatLabels({"key": key})} {_formatValue(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metricClass, name, help, labelNames, **kwargs):
+        """Helper method to return an existing metric or register a new one."""
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = metricClass(_INVALID_NAME_CHARS.sub('_', name), help, labelNames, **kwargs)
+        elif not isinstance(metric, metricClass):
+            raise ValueError(f'Metric {name} is already registered as a {metric.TYPE}')
+
+        return metric
+
+class MetricsServer():
+    """Serve the registry's metrics over HTTP for Prometheus to scrape."""
+    def __init__(self, registry, port, host=DEFAULT_HOST):
+        self.registry: Registry = registry
+        self.host: str = host
+        self.port: int = port
+        self._server: asyncio.Server = None
+
+    async def run(self):
+        """Serve metrics until cancelled."""
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        """Answer a single HTTP request, GET /metrics returns the metrics and anything else is not found."""
+        try:
+            async with asyncio.timeout(REQUEST_TIMEOUT):
+                requestLine = await reader.readline()
+                # Discard the request headers
+                while (await reader.readline()).strip():
+                    pass
+
+            method, path, *_ = requestLine.decode('latin-1').split() + ['', '']
+            if method == 'GET' and path.split('?', 1)[0] == '/metrics':
+                status, body = '200 OK', self.registry.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body)
+            await writer.drain()
+        except (TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+registry = Registry()
+
+def _flatten(stats, prefix=''):
+    """Helper method to yield the (dotted key, value) pairs of the numeric values in a nested stats dictionary."""
+    for key, value in stats.items():
+        key = f'{prefix}{getattr(key, "name", key)}'
+        if isinstance(value, dict):
+            yield from _flatten(value, f'{key}.')
+        elif isinstance(value, (int, float)):
+            yield key, value
+
+def _formatLabels(labels):
+    """Helper method to render a label set."""
+    if not labels:
+        return ''
+
+    return '{' + ','.join(f'{name}="{_escapeLabel(value)}"' for name, value in labels.items()) + '}'
+
+def _escapeLabel(value):
+    """Helper method to escape a label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _formatValue(value):
+    """Helper method to render a sample value."""
+    if value == math.inf:
+        return '+Inf'
+    elif value == -math.inf:
+        return '-Inf'
+    elif value != value:
+        return 'NaN'
+
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+def _escapeHelp(help):
+    """Helper method to escape a HELP line."""
+    return help.replace('\\', '\\\\').replace('\n', '\\n')
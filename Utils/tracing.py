@@ -0,0 +1,129 @@
+import contextvars
+import json
+import math
+import os
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+SUMMARY_SAMPLES = 200
+PERCENTILES = (50, 90, 99)
+
+class Span():
+    """A timed step of a traced call. Root spans cover the call's entire setup."""
+    __slots__ = ('name', 'traceID', 'spanID', 'parent', 'root', 'attributes', 'startTime', 'start', 'end', 'children')
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name: str = name
+        self.parent: Span = parent
+        self.root: Span = parent.root if parent else self
+        self.traceID: str = parent.traceID if parent else os.urandom(16).hex()
+        self.spanID: str = os.urandom(8).hex()
+        self.attributes: dict = attributes or {}
+        self.startTime: float = time.time()
+        self.start: float = time.perf_counter()
+        self.end: float = None
+        # Finished spans of the trace, exported together when the root span ends
+        self.children: list = [] if parent is None else None
+
+    def duration(self):
+        """Return the span's duration in milliseconds, or None if it has not ended."""
+        return (self.end - self.start) * 1000 if self.end is not None else None
+
+    def toDict(self):
+        """Return the span in the JSON-lines export format."""
+        return {'traceId': self.traceID, 'spanId': self.spanID, 'parentSpanId': self.parent.spanID if self.parent else None, 'name': self.name,
+                'startTime': self.startTime, 'durationMs': self.duration(), 'attributes': self.attributes}
+
+class Tracer():
+    """Collect spans of traced calls, export them to a JSON-lines file and summarise their latency."""
+    def __init__(self, filename=None):
+        self.filename: str = filename
+        self._durations: dict = defaultdict(lambda: deque(maxlen=SUMMARY_SAMPLES))
+
+    def finish(self, span, event=False):
+        """End a span, exporting the whole trace once its root span ends. Events are summarised by their offset into the trace rather than their duration."""
+        if span.end is not None:
+            return
+
+        span.end = span.start if event else time.perf_counter()
+        self._durations[span.name].append((span.start - span.root.start) * 1000 if event else span.duration())
+        span.root.children.append(span)
+        if span is span.root:
+            self._export(span.children)
+
+    def summary(self):
+        """Return the count and latency percentiles (milliseconds) of each span and event name."""
+        result = {}
+        for name, durations in self._durations.items():
+            ordered = sorted(durations)
+            result[name] = {'count': len(ordered)} | {f'p{p}': ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)] for p in PERCENTILES}
+
+        return result
+
+    def _export(self, spans):
+        """Append the spans of a finished trace to the sink file, one JSON object per line."""
+        if not self.filename:
+            return
+
+        try:
+            with open(self.filename, 'a') as file:
+                file.write(''.join(json.dumps(span.toDict()) + '\n' for span in spans))
+        except OSError as e:
+            print(f'Failed to export trace: {e}')
+
+tracer = Tracer()
+_currentSpan: contextvars.ContextVar = contextvars.ContextVar('currentSpan', default=None)
+
+def configure(filename):
+    """Set the JSON-lines file traces are exported to (None disables export)."""
+    tracer.filename = filename
+
+def current():
+    """Return the active span of the current context, or None if the context is not traced."""
+    return _currentSpan.get()
+
+def startTrace(name, **attributes):
+    """Start a new trace in the current context, returning its root span. Tasks created from this context inherit the trace."""
+    span = Span(name, attributes=attributes)
+    _currentSpan.set(span)
+    return span
+
+def endTrace(span=None, **attributes):
+    """End the trace of the specified (or current) span, adding any attributes to its root span."""
+    span = span or current()
+    if span:
+        span.root.attributes.update(attributes)
+        tracer.finish(span.root)
+
+@contextmanager
+def span(name, parent=None, **attributes):
+    """Time a step of the current (or parent's) trace. Does nothing outside of a traced context."""
+    parent = parent or current()
+    if parent is None or parent.root.end is not None:
+        yield None
+        return
+
+    child = Span(name, parent, attributes)
+    token = _currentSpan.set(child)
+    try:
+        yield child
+    finally:
+        _currentSpan.reset(token)
+        tracer.finish(child)
+
+def record(name, parent=None, **attributes):
+    """Record an instantaneous event in the current (or parent's) trace."""
+    parent = parent or current()
+    if parent is not None and parent.root.end is None:
+        tracer.finish(Span(name, parent, attributes), event=True)
+
+def contextOf(span):
+    """Return a copy of the current context with the span active, for tasks that should continue its trace."""
+    context = contextvars.copy_context()
+    context.run(_currentSpan.set, span)
+    return context
+
+def summary():
+    """Return the latency percentiles of every traced step."""
+    return tracer.summary()
@@ -5,27 +5,41 @@ from voip import Voip
 from Utils.doNotDisturb import DoNotDisturb
 from Utils.callLog import CallLog
 from Utils.config import Config
+from Utils.dialPlan import DialPlan, Route
+from Utils.callQueue import CallQueue, Orderings
 from Sip.exceptions import InviteError
+from Sip.admission import OverloadResponses
+from Utils import tracing, metrics
 
 # Standard Library
 import sys
 import asyncio
 import logging
 import os
+import time
 from datetime import timedelta, timezone
 
 LOGGING = True
 
+ANSWER_LATENCY = metrics.registry.histogram('redtelephone_call_answer_seconds', 'Time from a call being placed or received to its audio being relayed, by direction and whether the standby voice connection carried it.',
+                                            ('direction', 'mode'), buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20))
+
 async def main():
     # Load config.ini settings
     config = Config()
     await config.load()
 
     # Initialize main services
-    client = Client(token=config.discordBotToken)
-    voip = Voip(config.publicIP, allowList=config.voipAllowList)
+    client = Client(token=config.discordBotToken, encoding=config.discordGatewayEncoding, commands=config.discordCallTrigger == 'command',
+                    shardCount=config.discordShardCount, sessionFile=config.discordSessionFile,
+                    standbyChannel=(config.discordGuildID, config.discordVoiceChannelID) if config.discordVoiceStandby else None)
+    voip = Voip(config.publicIP, allowList=config.voipAllowList, sourceRate=config.floodSourceRate, globalRate=config.floodGlobalRate,
+                overloadResponse=OverloadResponses(config.floodOverloadResponse), accounts=config.registrarAccounts, realm=config.registrarRealm,
+                transport=config.voipTransport, dialPlan=DialPlan({pattern: Route(*ids) for pattern, ids in config.dialPlanRoutes.items()}),
+                callQueue=CallQueue(config.queueDepth, Orderings(config.queueOrdering)), queueRingback=config.queueRingback)
 
     # Initialize utilities
+    tracing.configure(config.traceFile)
     currentTimeZone = timezone(timedelta(hours=config.utcOffset))
     doNotDisturb = DoNotDisturb(config.doNotDisturbTimes, tz=currentTimeZone)
     callLog = CallLog(config.hourlyCallLimit, tz=currentTimeZone)
@@ -39,6 +53,8 @@ async def main():
     @client.eventHandler.event
     async def on_bot_mention(msgData):
         """When the bot is mentioned in a text channel, join the message author's current voice channel and call the VoIP handset."""
+        # Trace the call's setup, ended once audio is proxied (calls that are never placed are not exported)
+        tracing.startTrace('outbound_call', guild=msgData['guild_id'])
         voiceServerID, voiceChannelID = await client.fetchVoiceState(msgData['author']['id'], msgData['guild_id'])
         _, botVoiceChannelID = await client.fetchVoiceState(client.gateway.userID)
 
@@ -49,40 +65,114 @@ async def main():
             elif callLog.callLimitExceeded():
                 client.createMessage(f'`The hourly call limit was exceeded, you may try again at: {callLog.nextAllowedTime()}`', msgData['channel_id'])
 
-            elif botVoiceChannelID:
-                client.createMessage('`The line is already in use.`', msgData['channel_id'])
+            elif (botVoiceChannelID and not client.standby) or voip.busy() or voip.callQueue.waiting():
+                channelID = msgData['channel_id']
+                ticket = voip.callQueue.enqueue(msgData['author']['id'],
+                                                onPosition=lambda position: client.createMessage(f'`The line is in use, you are number {position} in the queue.`', channelID))
+                if not ticket:
+                    client.createMessage('`The line is already in use.`', channelID)
+                    return
+
+                with tracing.span('queued'):
+                    served = await voip.callQueue.wait(ticket)
+                if served:
+                    # The user may have left voice while waiting
+                    voiceServerID, voiceChannelID = await client.fetchVoiceState(msgData['author']['id'], msgData['guild_id'])
+                    if voiceServerID and voiceChannelID:
+                        await placeCall(voiceServerID, voiceChannelID, channelID)
+                    else:
+                        voip.cleanup()
 
             else:
-                try:
-                    result = await asyncio.gather(client.joinVoice(voiceServerID, voiceChannelID), voip.call(config.voipAddress))
-                    callLog.record()
-                except InviteError as e:
-                    client.createMessage('`Failed to initiate a call.`', msgData['channel_id'])
-                    await client.leaveVoice()
+                await placeCall(voiceServerID, voiceChannelID, msgData['channel_id'])
         else:
             client.createMessage('`User must be in a voice channel to initiate a call.`', msgData['channel_id'])
 
+    # Start time, direction and voice connection mode of the call being connected, reported once its audio is relayed
+    answerTiming = {}
+
+    async def placeCall(voiceServerID, voiceChannelID, textChannelID):
+        """Join the voice channel (unless the standby connection is already there) and call the VoIP handset."""
+        try:
+            if client.standbyReady(voiceServerID, voiceChannelID):
+                answerTiming.update(start=time.monotonic(), direction='outbound', mode='standby')
+                await client.activateStandby()
+                await voip.call(config.voipAddress, *config.voipForkAddresses)
+                callLog.record()
+                await connectCall()
+            else:
+                answerTiming.update(start=time.monotonic(), direction='outbound', mode='cold')
+                result = await asyncio.gather(client.joinVoice(voiceServerID, voiceChannelID), voip.call(config.voipAddress, *config.voipForkAddresses))
+                callLog.record()
+        except InviteError as e:
+            answerTiming.clear()
+            client.createMessage('`Failed to initiate a call.`', textChannelID)
+            await client.leaveVoice()
+            # Free the line for the next caller in the queue
+            voip.cleanup()
+            tracing.endTrace(error=str(e))
+
     @client.eventHandler.event
     async def on_voice_connection_finalized():
-        """Once voice communication to Discord is finalized, answer if the call is incoming and  """
-        # TODO improve the appearance of this code and only run when needed (incoming calls)
+        """Once voice communication to Discord is finalized, connect the call it was joined for. A standby connection waits for a call instead."""
+        if not client.standby:
+            await connectCall()
+
+    # Digits keyed on the handset since the last "#"
+    dialedDigits = []
+
+    async def connectCall():
+        """Answer the call if it is incoming, then relay audio between Discord and the VoIP session once it starts."""
+        # Keypresses of a previous call never carry over
+        dialedDigits.clear()
         voip.answerIncomingCall()
 
         # Wait for an active VoIP session before proxying traffic
-        await voip.waitForSession()
+        with tracing.span('wait_for_session'):
+            await voip.waitForSession()
         # Notify voice gateway that audio packets are starting to be sent
         await client.voiceGateway.updateSpeaking()
         RtpEndpoint.proxy(client.voiceGateway.rtpEndpoint, voip.rtpEndpoint, yCtrl=voip.rtcpEndpoint)
+        # Audio is flowing, the call's setup is complete
+        if answerTiming:
+            ANSWER_LATENCY.labels(answerTiming['direction'], answerTiming['mode']).observe(time.monotonic() - answerTiming['start'])
+            answerTiming.clear()
+        tracing.endTrace()
+
+    @voip.sipEndpoint.eventHandler.event
+    async def on_inbound_call(route):
+        """On an incoming call, answer through the standby connection if it waits in the routed voice channel, or join the channel, and notify guild members with a message."""
+        if client.standbyReady(route.guildID, route.voiceChannelID):
+            answerTiming.update(start=time.monotonic(), direction='inbound', mode='standby')
+            await client.activateStandby()
+            client.createMessage(config.incomingCallMessage, route.textChannelID)
+            await connectCall()
+        else:
+            answerTiming.update(start=time.monotonic(), direction='inbound', mode='cold')
+            await client.joinVoice(route.guildID, route.voiceChannelID)
+            client.createMessage(config.incomingCallMessage, route.textChannelID)
 
     @voip.sipEndpoint.eventHandler.event
-    async def on_inbound_call():
-        """On an incoming call, join the configured discord voice channel and notify guild members with a message."""
-        await client.joinVoice(config.discordGuildID, config.discordVoiceChannelID)
-        client.createMessage(config.incomingCallMessage, config.discordTextChannelID)
+    async def on_dtmf(digit):
+        """Handle handset keypresses during a call: "#" hangs up, a number followed by "#" moves the call to the channels the number routes to."""
+        if digit != '#':
+            dialedDigits.append(digit)
+            return
+
+        number = ''.join(dialedDigits)
+        dialedDigits.clear()
+        if not number:
+            await voip.endCall()
+            # Keys pressed while hanging up belong to no call
+            dialedDigits.clear()
+            await client.leaveVoice()
+        elif route := voip.dialPlan.lookup(number):
+            await client.joinVoice(route.guildID, route.voiceChannelID)
 
     @voip.sipEndpoint.eventHandler.event
     async def on_inbound_call_ended():
-        """When a call is remotely terminated, leave the discord voice channel."""
+        """When a call is remotely terminated, forget its dialed digits and leave the discord voice channel."""
+        dialedDigits.clear()
         await client.leaveVoice()
 
     # Configure logging
@@ -91,7 +181,10 @@ async def main():
         os.environ['WEBSOCKETS_MAX_LOG_SIZE'] = '1000'
 
     # Run main co-routines
-    await asyncio.gather(client.run(), voip.run())
+    services = [client.run(), voip.run()]
+    if config.metricsPort:
+        services.append(metrics.MetricsServer(metrics.registry, config.metricsPort, config.metricsHost).run())
+    await asyncio.gather(*services)
 
 # Entry point
 if __name__ == "__main__":
@@ -100,4 +193,7 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         print('Process interrupted')
     finally:
+        # Summarise the latency of every traced call setup step
+        for name, stats in tracing.summary().items():
+            print(f'{name}: ' + ', '.join(f'{key}={value:.1f}' if isinstance(value, float) else f'{key}={value}' for key, value in stats.items()))
         print('Bot successfully shutdown')
\ No newline at end of file
@@ -1,9 +1,23 @@
+# 1st Party
+from Utils import metrics
+
 # 3rd Party
+import nacl.exceptions
 import nacl.secret
 
 # Standard Library
 import asyncio
 from dataclasses import dataclass
+from typing import Callable
+
+# Telephone-event codes 0-15 (RFC 4733 Section 3.2)
+DTMF_EVENTS = '0123456789*#ABCD'
+DTMF_END_FLAG = 0x80
+
+RTP_PACKETS = metrics.registry.counter('redtelephone_rtp_packets_total', 'RTP and RTCP packets by endpoint and direction.', ('endpoint', 'direction'))
+RTP_BYTES = metrics.registry.counter('redtelephone_rtp_bytes_total', 'RTP and RTCP bytes by endpoint and direction.', ('endpoint', 'direction'))
+RTP_DROPS = metrics.registry.counter('redtelephone_rtp_dropped_total', 'Packets dropped by an endpoint, by reason.', ('endpoint', 'reason'))
+RTP_CRYPTO_FAILURES = metrics.registry.counter('redtelephone_rtp_crypto_failures_total', 'Packets that failed to decrypt, by endpoint.', ('endpoint',))
 
 class PayloadType():
     RTP = 120
@@ -64,6 +78,11 @@ class RtpMessage():
                 self.payload = self.payload[extensionLength * RtpMessage.EXTENSION_SIZE:]
 
     
+    def setPayloadType(self, payloadType):
+        """Rewrite the payload type of an RTP packet, keeping its marker bit."""
+        if self.payloadType == PayloadType.RTP:
+            self.header = self.header[:1] + int.to_bytes(self.header[1] & 0x80 | payloadType, 1) + self.header[2:]
+
     def setSSRC(self, ssrc):
         match self.payloadType:
             case PayloadType.RTP:
@@ -101,34 +120,61 @@ class RtpEndpointProtocol:
 
 
 class RtpEndpoint(RtpEndpointProtocol):
-    def __init__(self, ssrc=None, encrypted=False):
+    def __init__(self, ssrc=None, encrypted=False, payloadType=None, dtmfPayloadType=None, onDtmf=None, name='rtp', publicAddress=None):
         super().__init__()
 
         self.ssrc = ssrc
         self.encrypted = encrypted
+        # Payload type the remote end expects audio in, relayed packets are rewritten to it (each leg may number the codec differently)
+        self.payloadType: int = payloadType
         self._nonceCount = 0
 
+        # Negotiated telephone-event payload type, these packets are consumed rather than proxied
+        self.dtmfPayloadType: int = dtmfPayloadType
+        self.onDtmf: Callable = onDtmf
+        self._lastDtmfTimestamp: bytes = None
+
         self._secretBox = None
         self.proxyEndpoint = None
         self.ctrlProxyEndpoint = None
 
+        # External address of the endpoint as seen by the remote end, discovered unless it is already known
         self.publicIP = None
+        self.publicPort = None
         self.recvPublicIP = asyncio.Event()
+        if publicAddress:
+            self.publicIP, self.publicPort = publicAddress
+            self.recvPublicIP.set()
+
+        # Time series are resolved once so the packet path only increments them
+        self.name: str = name
+        self._rxPackets = RTP_PACKETS.labels(name, 'rx')
+        self._rxBytes = RTP_BYTES.labels(name, 'rx')
+        self._txPackets = RTP_PACKETS.labels(name, 'tx')
+        self._txBytes = RTP_BYTES.labels(name, 'tx')
+        self._noKeyDrops = RTP_DROPS.labels(name, 'no_key')
+        self._noPeerDrops = RTP_DROPS.labels(name, 'no_peer')
+        self._sendErrorDrops = RTP_DROPS.labels(name, 'send_error')
+        self._cryptoFailures = RTP_CRYPTO_FAILURES.labels(name)
+        self._truncatedDrops = RTP_DROPS.labels(name, 'truncated')
 
     def connection_made(self, transport):
         super().connection_made(transport)
-        if self.encrypted:
+        if self.encrypted and not self.publicIP:
             # Send IP discovery packet
             self._transport.sendto(int.to_bytes(1, 2) + int.to_bytes(70, 2) + int.to_bytes(self.ssrc, 4) + bytearray(66))
 
     def send(self, msgObj):
         if self.ssrc:
             msgObj.setSSRC(self.ssrc)
+        if self.payloadType is not None:
+            msgObj.setPayloadType(self.payloadType)
 
         if self.encrypted:
             if self._secretBox:
                 self.encrypt(msgObj)
             else:
+                self._noKeyDrops.value += 1
                 return
         else:
             # Grandstream HT801 doesn't support RTP header extensions.
@@ -136,22 +182,44 @@ class RtpEndpoint(RtpEndpointProtocol):
         
         if self._transport:
             try:
-                self._transport.sendto(msgObj.byteStringify())
+                data = msgObj.byteStringify()
+                self._transport.sendto(data)
+                self._txPackets.value += 1
+                self._txBytes.value += len(data)
             except Exception as e:
+                self._sendErrorDrops.value += 1
                 print(e)
 
     def datagram_received(self, data, addr):
+        self._rxPackets.value += 1
+        self._rxBytes.value += len(data)
+
         if not self.publicIP and self.isPacketDiscoveryResponse(data):
-            self.publicIP = self.parsePacketDiscoveryIP(data)
+            self.publicIP, self.publicPort = self.parsePacketDiscoveryAddress(data)
             self.recvPublicIP.set()
             return
+
+        # Too short to carry an RTP header
+        if len(data) < RtpMessage.DEFAULT_HEADER_SIZE:
+            self._truncatedDrops.value += 1
+            return
+
+        # A single byte comparison keeps telephone-events out of the voice path
+        if self.dtmfPayloadType is not None and data[1] & 0x7F == self.dtmfPayloadType:
+            self.handleTelephoneEvent(data)
+            return
         
         msgObj = RtpMessage(data, self.encrypted)
 
         if self.encrypted:
             if self._secretBox:
-                self.decrypt(msgObj)
+                try:
+                    self.decrypt(msgObj)
+                except nacl.exceptions.CryptoError:
+                    self._cryptoFailures.value += 1
+                    return
             else:
+                self._noKeyDrops.value += 1
                 return
 
         if msgObj.payloadType == PayloadType.RCTP and self.ctrlProxyEndpoint:
@@ -160,6 +228,27 @@ class RtpEndpoint(RtpEndpointProtocol):
         elif self.proxyEndpoint:
             self.proxyEndpoint.send(msgObj)
 
+        else:
+            self._noPeerDrops.value += 1
+
+    def handleTelephoneEvent(self, data):
+        """Report each RFC 4733 telephone-event once, on the first of its redundant end packets."""
+        headerLength = RtpMessage.DEFAULT_HEADER_SIZE + (data[0] & 0x0F) * RtpMessage.CSRC_SIZE
+        # Skip the header extension, whose length is counted in 32-bit words
+        if data[0] & 0x10 and len(data) >= headerLength + RtpMessage.EXTENSION_SIZE:
+            headerLength += RtpMessage.EXTENSION_SIZE + int.from_bytes(data[headerLength + 2:headerLength + 4]) * RtpMessage.EXTENSION_SIZE
+
+        if len(data) < headerLength + 4:
+            return
+
+        event, flags = data[headerLength], data[headerLength + 1]
+        # Every packet of an event, including its retransmitted end packets, shares the event's RTP timestamp
+        timestamp = data[4:8]
+        if flags & DTMF_END_FLAG and timestamp != self._lastDtmfTimestamp and event < len(DTMF_EVENTS):
+            self._lastDtmfTimestamp = timestamp
+            if self.onDtmf:
+                self.onDtmf(DTMF_EVENTS[event])
+
     # TODO create child class for Discord specific operations?
     def isPacketDiscoveryResponse(self, data):
         if int.from_bytes(data[0:2]) == 2 and int.from_bytes(data[2:4]) == 70 and int.to_bytes(self.ssrc, 4) == data[4:8]:
@@ -167,9 +256,10 @@ class RtpEndpoint(RtpEndpointProtocol):
         else:
             return False
         
-    def parsePacketDiscoveryIP(self, data):
-        encodedIP, _ = data[8:].split(b'\x00', 1)
-        return encodedIP.decode('utf-8')
+    def parsePacketDiscoveryAddress(self, data):
+        # A null padded 64 byte address followed by a big-endian port, which may differ from the local port behind NAT
+        encodedIP, _ = data[8:72].split(b'\x00', 1)
+        return encodedIP.decode('utf-8'), int.from_bytes(data[72:74])
 
     def encrypt(self, msgObj):
         self._nonceCount += 1
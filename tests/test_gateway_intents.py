@@ -0,0 +1,42 @@
+# 1st Party
+from Discord.client import Client
+from Discord.gateway import Gateway, GUILD_BYTES, Intents
+
+# Standard Library
+import asyncio
+import json
+
+def profileGateway(commands):
+    """Return the intents and a gateway built from the listeners of a client using mentions or slash commands."""
+    async def build():
+        client = Client('token', commands=commands)
+        await client.api.session.close()
+        gateway = Gateway('token', client.gatewayEventHandler.dispatch, compress=False, hasListener=client.gatewayEventHandler.hasListener)
+        return Intents(gateway.intents()), gateway
+
+    return asyncio.run(build())
+
+def event(t, d):
+    """Encode a dispatch event the way Discord orders its fields."""
+    return json.dumps({'t': t, 's': 1, 'op': 0, 'd': d}, separators=(',', ':')).encode()
+
+def test_mention_profile_receives_messages():
+    intents, _ = profileGateway(commands=False)
+    assert intents == Intents.GUILDS | Intents.GUILD_VOICE_STATES | Intents.GUILD_MESSAGES
+
+def test_command_profile_drops_messages():
+    intents, _ = profileGateway(commands=True)
+    assert intents == Intents.GUILDS | Intents.GUILD_VOICE_STATES
+
+def test_received_bytes_by_guild():
+    _, gateway = profileGateway(commands=True)
+    message = event('VOICE_STATE_UPDATE', {'guild_id': '41', 'channel_id': '7', 'user_id': '9', 'session_id': 'x'})
+    before = GUILD_BYTES.labels('41').value
+    gateway.received(message, gateway.codec.peek(message))
+    assert GUILD_BYTES.labels('41').value - before == len(message)
+
+    # A message that concerns no guild is attributed to the empty label
+    message = event('RESUMED', {})
+    before = GUILD_BYTES.labels('').value
+    gateway.received(message, gateway.codec.peek(message))
+    assert GUILD_BYTES.labels('').value - before == len(message)
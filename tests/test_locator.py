@@ -0,0 +1,133 @@
+# 1st Party
+from Sip.locator import SipLocator
+from Utils import dnsResolver
+from Utils.dnsResolver import DnsResolver, RecordTypes
+
+# Standard Library
+import asyncio
+import socket
+import struct
+
+RCODE_NXDOMAIN = 3
+
+def encodeName(name):
+    """Encode a domain name as uncompressed labels."""
+    return b''.join(bytes([len(label)]) + label.encode() for label in name.split('.') if label) + b'\x00'
+
+def characterString(value):
+    """Encode a length prefixed character string."""
+    return bytes([len(value)]) + value.encode()
+
+def srv(priority, weight, port, target):
+    """Build the type and data of an SRV record."""
+    return RecordTypes.SRV, struct.pack('!HHH', priority, weight, port) + encodeName(target)
+
+def naptr(order, preference, service, replacement):
+    """Build the type and data of a terminal NAPTR record pointing to an SRV name."""
+    return RecordTypes.NAPTR, struct.pack('!HH', order, preference) + characterString('s') + characterString(service) + characterString('') + encodeName(replacement)
+
+def a(address):
+    """Build the type and data of an A record."""
+    return RecordTypes.A, socket.inet_aton(address)
+
+class StubNameserver(asyncio.DatagramProtocol):
+    """Answer queries from a zone of name -> [(record type, rdata)], counting the queries received per (name, type)."""
+    def __init__(self, zone, ttl):
+        self.zone = zone
+        self.ttl = ttl
+        self.queries = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        labels, offset = [], 12
+        while data[offset]:
+            labels.append(data[offset + 1:offset + 1 + data[offset]].decode())
+            offset += 1 + data[offset]
+        name = '.'.join(labels).lower()
+        recordType, = struct.unpack('!H', data[offset + 1:offset + 3])
+        question = data[12:offset + 5]
+        self.queries[(name, recordType)] = self.queries.get((name, recordType), 0) + 1
+
+        records = [rdata for rType, rdata in self.zone.get(name, []) if rType == recordType]
+        rcode = 0 if name in self.zone else RCODE_NXDOMAIN
+        answers = b''.join(encodeName(name) + struct.pack('!HHIH', recordType, 1, self.ttl, len(rdata)) + rdata for rdata in records)
+        header = data[:2] + struct.pack('!HHHHH', 0x8180 | rcode, 1, len(records), 0, 0)
+        self.transport.sendto(header + question + answers, addr)
+
+ZONE = {
+    'example.test': [naptr(20, 10, 'SIP+D2T', '_sip._tcp.example.test'), naptr(10, 10, 'SIP+D2U', '_sip._udp.example.test')],
+    '_sip._udp.example.test': [srv(20, 0, 5070, 'backup.example.test'), srv(10, 0, 5062, 'primary.example.test')],
+    '_sip._tcp.example.test': [srv(10, 0, 5080, 'tcp.example.test')],
+    'primary.example.test': [a('192.0.2.1')],
+    'backup.example.test': [a('192.0.2.2')],
+    'tcp.example.test': [a('192.0.2.3')],
+    # No NAPTR records, located through the default SRV name
+    'srv-only.test': [a('192.0.2.9')],
+    '_sip._udp.srv-only.test': [srv(10, 0, 5064, 'primary.example.test')],
+    # Neither NAPTR nor SRV records, located through its A record on the default port
+    'a-only.test': [a('192.0.2.4')],
+}
+
+async def withNameserver(monkeypatch, test, ttl=60):
+    """Run a test coroutine against a resolver that queries a stub nameserver on localhost."""
+    loop = asyncio.get_running_loop()
+    transport, nameserver = await loop.create_datagram_endpoint(lambda: StubNameserver(ZONE, ttl), local_addr=('127.0.0.1', 0))
+    monkeypatch.setattr(dnsResolver, 'DNS_PORT', transport.get_extra_info('sockname')[1])
+    try:
+        return await test(DnsResolver(['127.0.0.1']), nameserver)
+    finally:
+        transport.close()
+
+def test_naptr_srv_a_ordering(monkeypatch):
+    async def test(resolver, nameserver):
+        return await SipLocator(resolver).locate('example.test')
+
+    # The lowest order NAPTR is followed, and its SRV targets are ordered by priority
+    assert asyncio.run(withNameserver(monkeypatch, test)) == [('192.0.2.1', 5062), ('192.0.2.2', 5070)]
+
+def test_tcp_transport_follows_d2t(monkeypatch):
+    async def test(resolver, nameserver):
+        return await SipLocator(resolver, transport='tcp').locate('example.test')
+
+    assert asyncio.run(withNameserver(monkeypatch, test)) == [('192.0.2.3', 5080)]
+
+def test_fallback_from_naptr_to_srv(monkeypatch):
+    async def test(resolver, nameserver):
+        return await SipLocator(resolver).locate('srv-only.test')
+
+    assert asyncio.run(withNameserver(monkeypatch, test)) == [('192.0.2.1', 5064)]
+
+def test_fallback_from_srv_to_a(monkeypatch):
+    async def test(resolver, nameserver):
+        return await SipLocator(resolver).locate('a-only.test')
+
+    assert asyncio.run(withNameserver(monkeypatch, test)) == [('192.0.2.4', 5060)]
+
+def test_explicit_port_skips_naptr_and_srv(monkeypatch):
+    async def test(resolver, nameserver):
+        return await SipLocator(resolver).locate('a-only.test', 5099), set(nameserver.queries)
+
+    targets, queries = asyncio.run(withNameserver(monkeypatch, test))
+    assert targets == [('192.0.2.4', 5099)]
+    assert queries == {('a-only.test', RecordTypes.A)}
+
+def test_cache_ttl(monkeypatch):
+    async def test(resolver, nameserver):
+        locator = SipLocator(resolver)
+        first = await locator.locate('example.test')
+        queries = dict(nameserver.queries)
+        # Every record is answered from the cache until its TTL expires
+        second = await locator.locate('example.test')
+        cached = dict(nameserver.queries)
+        answer = await resolver.query('primary.example.test', RecordTypes.A)
+        await asyncio.sleep(1.1)
+        await locator.locate('example.test')
+        return first, second, queries, cached, answer, nameserver.queries
+
+    first, second, queries, cached, answer, expired = asyncio.run(withNameserver(monkeypatch, test, ttl=1))
+    assert first == second
+    assert cached == queries
+    assert answer.ttl <= 1
+    assert all(expired[key] == count + 1 for key, count in queries.items())
@@ -4,8 +4,15 @@ from Sip.transaction import Transaction
 from Sip.dialog import Dialog
 from rtp import RtpEndpoint
 from Utils.addressFilter import AddressFilter
+from Utils.dnsResolver import DnsResolver, DnsError
 from Sip.exceptions import InviteError
 from Sip.sessionManager import SessionManager
+from Sip.admission import AdmissionControl, OverloadResponses, SOURCE_RATE, GLOBAL_RATE
+from Sip.registrar import Registrar, DEFAULT_REALM
+from Sip.locator import SipLocator
+from Utils.dialPlan import DialPlan
+from Utils.callQueue import CallQueue
+from Utils import tracing, metrics
 
 # Standard Library
 import asyncio
@@ -14,27 +21,62 @@ from os import urandom
 DEFAULT_SIP_PORT = 5060
 DEFAULT_RTP_PORT = 5004
 DEFAULT_RTCP_PORT = 5005
+DEFAULT_TRANSPORT = 'udp'
 
 class Voip(SessionManager):
     """Manages the VoIP service."""
-    def __init__(self, publicIP, sipPort=DEFAULT_SIP_PORT, rtpPort=DEFAULT_RTP_PORT, rtcpPort=DEFAULT_RTCP_PORT, allowList=[]):
+    def __init__(self, publicIP, sipPort=DEFAULT_SIP_PORT, rtpPort=DEFAULT_RTP_PORT, rtcpPort=DEFAULT_RTCP_PORT, allowList=None,
+                 sourceRate=SOURCE_RATE, globalRate=GLOBAL_RATE, overloadResponse=OverloadResponses.REJECT, accounts=None, realm=DEFAULT_REALM,
+                 transport=DEFAULT_TRANSPORT, dialPlan=None, callQueue=None, queueRingback=True):
         super().__init__()
         self.sipPort: int = sipPort
         self.rtpPort: int = rtpPort
         self.rtcpPort: int = rtcpPort or rtpPort + 1
-        self.remoteRtpPort: int = None
-        self.remoteRtcpPort: int = None
-        self.addressFilter: AddressFilter = AddressFilter(allowList)
+        self.transport: str = transport
+        self.dialPlan: DialPlan = dialPlan or DialPlan({})
+        self.callQueue: CallQueue = callQueue or CallQueue()
+        self.queueRingback: bool = queueRingback
+        # A single resolver shares its cache between the allow list and call targets
+        self.resolver: DnsResolver = DnsResolver()
+        self.locator: SipLocator = SipLocator(self.resolver, transport)
+        self.addressFilter: AddressFilter = AddressFilter(allowList or [], self.resolver)
+        self.admissionControl: AdmissionControl = AdmissionControl(self.addressFilter, sourceRate, globalRate, overloadResponse)
+        # Registered handsets are allowed to place calls from whichever address they registered from
+        self.registrar: Registrar = Registrar(accounts or {}, realm, onChange=lambda: self.addressFilter.setDynamic('registrar', self.registrar.addresses()))
         self.sipEndpoint: Sip = Sip((publicIP, self.sipPort), self)
         self.rtpEndpoint: RtpEndpoint = None
         self.rtcpEndpoint: RtpEndpoint = None
+        # Dispatches of handset keypresses that have not finished, referenced so they are not garbage collected mid-run
+        self._dtmfTasks: set = set()
+
+        # Export the existing counters alongside the registry's metrics
+        metrics.registry.collector('redtelephone_sip_stats', 'SIP transport, admission, stateless handling, peer timer and fork statistics.', self.sipEndpoint.stats)
+        metrics.registry.collector('redtelephone_call_queue_stats', 'Call queue statistics.', self.callQueue.stats)
+        metrics.registry.collector('redtelephone_dns_stats', 'DNS cache statistics.', self.resolver.stats)
     
     async def run(self):
-        await asyncio.gather(self.sipEndpoint.run(), self.addressFilter.run())
+        await asyncio.gather(self.sipEndpoint.run(), self.addressFilter.run(), self.registrar.run())
     
-    async def call(self, remoteIP):
+    async def call(self, *remoteAddresses):
+        """Call a handset, or fork the call to several handsets in parallel and connect the first to answer."""
+        # Every registered contact of an address-of-record rings in parallel, the DNS targets of a host are instead tried in turn
+        registered = {address: self.registrar.lookup(address) for address in remoteAddresses}
+        bindings = [binding for addresses in registered.values() for binding in addresses]
+        hosts = [address for address, addresses in registered.items() if not addresses]
+        with tracing.span('locate', hosts=hosts):
+            candidates = [targets for targets in await asyncio.gather(*[self._locate(host) for host in hosts]) if targets]
+
+        forkTargets = list(dict.fromkeys(bindings + [targets[0] for targets in candidates]))
         try:
-            dialog = await self.sipEndpoint.invite(remoteIP, self.sipPort)
+            with tracing.span('sip_invite', targets=len(forkTargets) or len(candidates)):
+                if len(forkTargets) > 1:
+                    dialog = await self.sipEndpoint.fork(forkTargets)
+                elif candidates:
+                    dialog = await self.sipEndpoint.inviteAny(candidates[0])
+                elif bindings:
+                    dialog = await self.sipEndpoint.invite(*bindings[0])
+                else:
+                    raise InviteError('Failed to resolve any target.')
         except InviteError:
             raise
 
@@ -48,20 +90,25 @@ class Voip(SessionManager):
             await self.sipEndpoint.cancel(self.activeInvite)
 
     async def buildSession(self, dialog):
-        remoteIP = dialog.getRemoteIP()
-        remoteRtpPort = self.remoteRtpPort or self.rtpPort
-        remoteRtcpPort = self.remoteRtcpPort or self.rtcpPort
+        # Send media to the negotiated connection address and ports, which may differ from the signalling address
+        if dialog.media:
+            remoteIP, remoteRtpPort, remoteRtcpPort = dialog.media.address, dialog.media.rtpPort, dialog.media.rtcpPort
+        else:
+            remoteIP, remoteRtpPort, remoteRtcpPort = dialog.getRemoteIP(), self.rtpPort, self.rtcpPort
         ssrc = Voip.genSSRC()
 
+        payloadType = dialog.media.payloadType if dialog.media else None
+        dtmfPayloadType = dialog.media.dtmfPayloadType if dialog.media else None
+
         loop = asyncio.get_event_loop()
         _, self.rtpEndpoint = await loop.create_datagram_endpoint(
-        lambda: RtpEndpoint(ssrc, encrypted=False),
+        lambda: RtpEndpoint(ssrc, encrypted=False, payloadType=payloadType, dtmfPayloadType=dtmfPayloadType, onDtmf=self._dispatchDtmf, name='handset'),
         local_addr=("0.0.0.0", self.rtpPort),
         remote_addr=(remoteIP, remoteRtpPort)
         )
 
         _, self.rtcpEndpoint = await loop.create_datagram_endpoint(
-            lambda: RtpEndpoint(ssrc, encrypted=False),
+            lambda: RtpEndpoint(ssrc, encrypted=False, name='handset_rtcp'),
             local_addr=('0.0.0.0', self.rtcpPort),
             remote_addr=(remoteIP, remoteRtcpPort)
             )
@@ -79,7 +126,20 @@ class Voip(SessionManager):
             self.rtcpEndpoint.stop()
 
         self.rtpEndpoint, self.rtcpEndpoint = None, None
-        self.remoteRtpPort, self.remoteRtcpPort = None, None
+
+    def _dispatchDtmf(self, digit):
+        """Dispatch a handset keypress to the dtmf event listeners."""
+        task = asyncio.create_task(self.sipEndpoint.eventHandler.dispatch('dtmf', digit))
+        self._dtmfTasks.add(task)
+        task.add_done_callback(self._dtmfTasks.discard)
+
+    async def _locate(self, address):
+        """Return the targets of an "host[:port]" string in the order they should be tried, or an empty list if it cannot be resolved."""
+        host, _, port = address.partition(':')
+        try:
+            return await self.locator.locate(host, int(port) if port else None)
+        except (DnsError, ValueError):
+            return []
 
     @staticmethod
     def genSSRC():